@@ -0,0 +1,210 @@
+import argparse
+import json
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+import psutil
+
+from download_watcher import is_temp_download
+from html_store import HTML_SEGMENTS_DIRNAME, HtmlSegmentReader
+from mock_cej import add_mock_arguments, get_mock_options, start_mock_server
+from utils import logger
+
+BASE_DIR = os.path.realpath(os.path.dirname(__file__))
+SAMPLE_INTERVAL = 1.0
+IGNORED_FILE_NAMES = {"link.txt"}
+
+
+def get_tree_rss(process):
+    # resident memory of the scraper and every chrome/chromedriver it started
+    rss = 0
+    try:
+        processes = [process] + process.children(recursive=True)
+    except psutil.Error:
+        return 0
+    for proc in processes:
+        try:
+            rss += proc.memory_info().rss
+        except psutil.Error:
+            pass
+    return rss
+
+
+def count_files(root, suffix=None):
+    count = 0
+    for _, _, file_names in os.walk(root):
+        for file_name in file_names:
+            if file_name in IGNORED_FILE_NAMES or is_temp_download(file_name):
+                continue
+            if suffix is None or file_name.endswith(suffix):
+                count += 1
+    return count
+
+
+def count_output(data_dir):
+    # (case pages, documents) saved under data_dir, whatever the HTML_STORAGE
+    cases = documents = 0
+    if not os.path.isdir(data_dir):
+        return cases, documents
+    for year in os.listdir(data_dir):
+        year_dir = os.path.join(data_dir, year)
+        if not year.isdigit() or not os.path.isdir(year_dir):
+            continue
+        cases += count_files(os.path.join(year_dir, "raw_html"), ".txt")
+        documents += count_files(os.path.join(year_dir, "downloaded_files"))
+    cases += len(HtmlSegmentReader(os.path.join(data_dir, HTML_SEGMENTS_DIRNAME)))
+    return cases, documents
+
+
+def read_stage_summary(metrics_path):
+    # the last summary line the scraper's metrics wrote
+    summary = None
+    if not os.path.exists(metrics_path):
+        return None
+    with open(metrics_path) as fp:
+        for line in fp:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if "summary" in record:
+                summary = record["summary"]
+    return summary
+
+
+def run_benchmark(year, location, duration, workers, work_dir, server, extra_env):
+    """
+    Run scrape.py against the mock server for duration seconds, or until it
+    finishes, and return its throughput and memory use.
+    """
+    data_dir = os.path.join(work_dir, "data")
+    metrics_path = os.path.join(work_dir, "metrics.jsonl")
+    env = {
+        **os.environ,
+        "CEJ_BASE_URL": server.base_url,
+        "CAPTCHA_BACKEND": "mock",
+        "DATA_DIR": data_dir,
+        "PROGRESS_DB_PATH": os.path.join(work_dir, "progress.sqlite3"),
+        "METRICS_PATH": metrics_path,
+        "METRICS_INTERVAL": "5",
+        "NUMBER_OF_WORKERS": str(workers),
+        **extra_env,
+    }
+    command = [sys.executable, os.path.join(BASE_DIR, "scrape.py"), "-y", str(year)]
+    command += ["-l", location]
+    logger.info(f"running {' '.join(command)} against {server.base_url}")
+
+    started = time.time()
+    process = subprocess.Popen(command, env=env, cwd=BASE_DIR)
+    ps_process = psutil.Process(process.pid)
+    rss_samples = []
+    try:
+        while process.poll() is None and time.time() - started < duration:
+            rss_samples.append(get_tree_rss(ps_process))
+            time.sleep(SAMPLE_INTERVAL)
+    finally:
+        if process.poll() is None:
+            # same as ctrl-c, so the scraper can close its drivers and metrics
+            process.send_signal(signal.SIGINT)
+            try:
+                process.wait(timeout=60)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+    elapsed = time.time() - started
+
+    cases, documents = count_output(data_dir)
+    summary = read_stage_summary(metrics_path) or {}
+    minutes = elapsed / 60
+    peak_rss = max(rss_samples, default=0)
+    return {
+        "year": year,
+        "location": location,
+        "workers": workers,
+        "elapsed": round(elapsed, 1),
+        "exit_code": process.returncode,
+        "cases": cases,
+        "documents": documents,
+        "cases_per_minute": round(cases / minutes, 2),
+        "documents_per_minute": round(documents / minutes, 2),
+        "peak_rss_mb": round(peak_rss / 2**20, 1),
+        "peak_rss_mb_per_worker": round(peak_rss / 2**20 / workers, 1),
+        "mean_rss_mb": round(sum(rss_samples) / max(1, len(rss_samples)) / 2**20, 1),
+        "server": dict(server.stats),
+        "stages": summary.get("stages"),
+        "counters": summary.get("counters"),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Measure the scraper's throughput against a local CEJ mock"
+    )
+    parser.add_argument("-y", "--year", dest="year", type=int, default=2019)
+    parser.add_argument("-l", "--location", dest="location", default="LIMA")
+    parser.add_argument(
+        "--duration",
+        dest="duration",
+        type=float,
+        default=300,
+        help="seconds to let the scraper run",
+    )
+    parser.add_argument(
+        "--workers",
+        dest="workers",
+        type=int,
+        default=int(os.getenv("NUMBER_OF_WORKERS", 5)),
+    )
+    parser.add_argument(
+        "--work-dir",
+        dest="work_dir",
+        default=None,
+        help="keep the scraped data here instead of a temporary directory",
+    )
+    parser.add_argument(
+        "--env",
+        dest="env",
+        nargs="*",
+        default=[],
+        help="extra NAME=value settings for the scraper, e.g. HTML_STORAGE=segments",
+    )
+    parser.add_argument("--output", dest="output", help="also write the report here")
+    add_mock_arguments(parser)
+    args = parser.parse_args()
+
+    extra_env = dict(setting.split("=", 1) for setting in args.env)
+    server = start_mock_server(**get_mock_options(args))
+    try:
+        if args.work_dir:
+            os.makedirs(args.work_dir, exist_ok=True)
+            report = run_benchmark(
+                args.year,
+                args.location,
+                args.duration,
+                args.workers,
+                args.work_dir,
+                server,
+                extra_env,
+            )
+        else:
+            with tempfile.TemporaryDirectory(prefix="cej-benchmark-") as work_dir:
+                report = run_benchmark(
+                    args.year,
+                    args.location,
+                    args.duration,
+                    args.workers,
+                    work_dir,
+                    server,
+                    extra_env,
+                )
+    finally:
+        server.shutdown()
+
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(report, fp, indent=2)
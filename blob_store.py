@@ -0,0 +1,193 @@
+import argparse
+import hashlib
+import mimetypes
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+
+from utils import logger
+
+BLOB_STORE_DIRNAME = "blobs"
+MANIFEST_FILENAME = "manifest.sqlite3"
+HASH_CHUNK_SIZE = 1024 * 1024
+
+BlobEntry = namedtuple("BlobEntry", ["blob_hash", "size", "mime_type", "filename"])
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS manifest (
+    expediente TEXT NOT NULL,
+    idx INTEGER NOT NULL,
+    href TEXT NOT NULL,
+    blob_hash TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mime_type TEXT,
+    filename TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    PRIMARY KEY (expediente, idx, href)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS manifest_href ON manifest (href);
+"""
+
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as fp:
+        for chunk in iter(lambda: fp.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def link_or_copy(source, target):
+    # hardlinks cost no space, copy when the target is on another file system
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copyfile(source, target)
+
+
+class BlobStore:
+    """
+    Content-addressed store of downloaded documents.
+    Args
+    ----
+    root : str
+        Directory of the store. Blobs live in root/ab/cd/<sha256> and the
+        manifest mapping (expediente, index, href) to a blob in
+        root/manifest.sqlite3.
+
+    The files under downloaded_files are hardlinks to the blobs, so the same
+    resolution reached from several cases is only kept on disk once, and an
+    href whose blob is already present is never downloaded again.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        self._lock = threading.Lock()
+        self._verified = set()
+        self._conn = sqlite3.connect(
+            os.path.join(root, MANIFEST_FILENAME),
+            timeout=30,
+            check_same_thread=False,
+            isolation_level=None,
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(SCHEMA)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def get_blob_path(self, blob_hash):
+        return os.path.join(self.root, blob_hash[:2], blob_hash[2:4], blob_hash)
+
+    def is_verified(self, entry):
+        """
+        Check the blob exists and still hashes to its name, once per process.
+        """
+        if entry.blob_hash in self._verified:
+            return True
+        blob_path = self.get_blob_path(entry.blob_hash)
+        if not os.path.isfile(blob_path) or os.path.getsize(blob_path) != entry.size:
+            return False
+        if hash_file(blob_path) != entry.blob_hash:
+            logger.warning(f"blob {entry.blob_hash} is corrupted, removing it")
+            os.remove(blob_path)
+            return False
+        self._verified.add(entry.blob_hash)
+        return True
+
+    def find(self, href):
+        """
+        Returns the BlobEntry of a verified blob downloaded from href, or None.
+        """
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT blob_hash, size, mime_type, filename FROM manifest "
+                "WHERE href = ? ORDER BY created_at DESC",
+                (href,),
+            ).fetchall()
+        for row in rows:
+            entry = BlobEntry(*row)
+            if self.is_verified(entry):
+                return entry
+        return None
+
+    def record(self, expediente, index, href, entry):
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO manifest (expediente, idx, href, blob_hash, "
+                "size, mime_type, filename, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (expediente, index, href, *entry, time.time()),
+            )
+
+    def add(self, file_path, expediente, index, href):
+        """
+        Move a downloaded file into the store and put a hardlink to its blob
+        in its place. Returns its BlobEntry.
+        """
+        blob_hash = hash_file(file_path)
+        blob_path = self.get_blob_path(blob_hash)
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        if os.path.exists(blob_path):
+            os.remove(file_path)
+        else:
+            os.replace(file_path, blob_path)
+        link_or_copy(blob_path, file_path)
+
+        filename = os.path.basename(file_path)
+        entry = BlobEntry(
+            blob_hash,
+            os.path.getsize(blob_path),
+            mimetypes.guess_type(filename)[0],
+            filename,
+        )
+        self._verified.add(blob_hash)
+        self.record(expediente, index, href, entry)
+        return entry
+
+    def materialize(self, entry, target_dir, expediente, index, href):
+        """
+        Link an existing blob into target_dir and record it for this case.
+        """
+        target_path = os.path.join(target_dir, entry.filename)
+        if not os.path.exists(target_path):
+            link_or_copy(self.get_blob_path(entry.blob_hash), target_path)
+        self.record(expediente, index, href, entry)
+        return target_path
+
+    def get_summary(self):
+        with self._lock:
+            references, blobs, stored_bytes, referenced_bytes = self._conn.execute(
+                "SELECT COUNT(*), COUNT(DISTINCT blob_hash), "
+                "(SELECT COALESCE(SUM(size), 0) FROM "
+                "(SELECT DISTINCT blob_hash, size FROM manifest)), "
+                "COALESCE(SUM(size), 0) FROM manifest"
+            ).fetchone()
+        return {
+            "references": references,
+            "blobs": blobs,
+            "stored_bytes": stored_bytes,
+            "saved_bytes": referenced_bytes - stored_bytes,
+        }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Show how much the blob store of downloaded documents deduplicates"
+    )
+    parser.add_argument(
+        "--root",
+        dest="root",
+        default=os.path.join(
+            os.path.realpath(os.path.dirname(__file__)), "data", BLOB_STORE_DIRNAME
+        ),
+    )
+    args = parser.parse_args()
+    store = BlobStore(args.root)
+    logger.info(store.get_summary())
+    store.close()
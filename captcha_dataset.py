@@ -0,0 +1,145 @@
+import argparse
+import json
+import os
+import struct
+import threading
+import time
+
+from captcha_solver import get_captcha_solver
+from metrics import percentile
+from utils import logger
+
+RECORD_HEADER = struct.Struct(">II")
+
+
+class CaptchaDataset:
+    """
+    Append-only file of captcha images with the answer that was sent and
+    whether the site accepted it.
+    Each record is a header with the lengths of its two parts, a JSON object
+    with the labels and the PNG bytes of the captcha.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        parent_dir = os.path.dirname(path)
+        if parent_dir and not os.path.exists(parent_dir):
+            os.makedirs(parent_dir, exist_ok=True)
+
+    def append(self, image, answer, accepted, backend=None, latency=None):
+        meta = json.dumps(
+            {
+                "ts": time.time(),
+                "answer": answer,
+                "accepted": accepted,
+                "backend": backend,
+                "latency": latency,
+            }
+        ).encode("utf-8")
+        with self._lock:
+            with open(self.path, "ab") as fp:
+                fp.write(RECORD_HEADER.pack(len(meta), len(image)))
+                fp.write(meta)
+                fp.write(image)
+
+    def __iter__(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "rb") as fp:
+            while True:
+                header = fp.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    # end of file, or a record cut short by a crash
+                    return
+                meta_len, image_len = RECORD_HEADER.unpack(header)
+                meta = fp.read(meta_len)
+                image = fp.read(image_len)
+                if len(image) < image_len:
+                    return
+                yield json.loads(meta), image
+
+
+def benchmark(dataset, solver, limit=None):
+    """
+    Replay the captured captchas against a solver.
+    Accepted captchas give the right answer; for rejected ones we only know
+    which answer was wrong, so they only count towards known_wrong.
+    """
+    correct = 0
+    labelled = 0
+    known_wrong = 0
+    unanswered = 0
+    latencies = []
+    for count, (meta, image) in enumerate(dataset):
+        if limit is not None and count >= limit:
+            break
+        started = time.time()
+        text, confidence = solver.solve(image)
+        latencies.append(time.time() - started)
+        if not text:
+            unanswered += 1
+        if meta["accepted"]:
+            labelled += 1
+            if text and text.lower() == str(meta["answer"]).lower():
+                correct += 1
+        elif text and text.lower() == str(meta["answer"]).lower():
+            known_wrong += 1
+
+    accuracy = correct / labelled if labelled else None
+    return {
+        "backend": solver.name,
+        "solved": len(latencies),
+        "labelled": labelled,
+        "accuracy": accuracy,
+        "known_wrong": known_wrong,
+        "unanswered": unanswered,
+        "latency_p50": percentile(latencies, 50),
+        "latency_p95": percentile(latencies, 95),
+        # every wrong answer costs another solve for the same search
+        "cost_per_solved_search": (
+            solver.cost_per_solve / accuracy if accuracy else None
+        ),
+    }
+
+
+def get_stats(dataset):
+    stats = {}
+    for meta, _ in dataset:
+        backend_stats = stats.setdefault(
+            meta.get("backend") or "unknown", {"captchas": 0, "accepted": 0}
+        )
+        backend_stats["captchas"] += 1
+        backend_stats["accepted"] += int(bool(meta["accepted"]))
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Inspect captured captchas and benchmark solver backends on them"
+    )
+    parser.add_argument("command", choices=["stats", "benchmark"])
+    parser.add_argument(
+        "--dataset",
+        dest="dataset",
+        default=os.getenv("CAPTCHA_CAPTURE_PATH"),
+        help="dataset file, defaults to CAPTCHA_CAPTURE_PATH",
+    )
+    parser.add_argument(
+        "--backend",
+        dest="backends",
+        nargs="+",
+        default=["azcaptcha"],
+        help="backends to benchmark, e.g. local azcaptcha local+azcaptcha",
+    )
+    parser.add_argument("--limit", dest="limit", type=int, default=None)
+    args = parser.parse_args()
+    if not args.dataset:
+        parser.error("--dataset or CAPTCHA_CAPTURE_PATH is required")
+
+    dataset = CaptchaDataset(args.dataset)
+    if args.command == "stats":
+        logger.info(get_stats(dataset))
+    else:
+        for backend in args.backends:
+            logger.info(benchmark(dataset, get_captcha_solver(backend), args.limit))
@@ -0,0 +1,59 @@
+import collections
+import concurrent.futures
+import time
+
+from captcha_solver import AzcaptchaSolver, capture_captcha_image
+from metrics import STATUS_FAILED, STATUS_OK, get_metrics
+from utils import logger
+
+CaptchaAnswer = collections.namedtuple(
+    "CaptchaAnswer", ["text", "confidence", "image", "backend", "latency"]
+)
+
+
+class CaptchaService:
+    """
+    Solve captchas in the background and hand out futures.
+    Args
+    ----
+    max_concurrency : int
+        Maximum number of captchas being solved at once across every worker.
+    solver : CaptchaSolver, defaults to AzcaptchaSolver
+        The backend solving the captchas.
+
+    Callers capture the image on their own driver thread, submit it, and only
+    block on the future when the answer is actually needed, so the solver
+    latency overlaps with whatever the browser does in between. Futures
+    resolve to a CaptchaAnswer.
+    """
+
+    def __init__(self, max_concurrency=5, solver=None):
+        self.solver = solver or AzcaptchaSolver()
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_concurrency, thread_name_prefix="captcha"
+        )
+
+    def submit(self, image):
+        return self._executor.submit(self._solve, image)
+
+    def submit_from_driver(self, driver):
+        return self.submit(capture_captcha_image(driver))
+
+    def _solve(self, image):
+        started = time.time()
+        try:
+            text, confidence = self.solver.solve(image)
+        except Exception as e:
+            logger.error(f"captcha solver failed: {e}")
+            text, confidence = None, 0.0
+        latency = time.time() - started
+        get_metrics().observe(
+            "captcha_solve",
+            latency,
+            STATUS_OK if text else STATUS_FAILED,
+            backend=self.solver.name,
+        )
+        return CaptchaAnswer(text, confidence, image, self.solver.name, latency)
+
+    def close(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -1,24 +1,82 @@
+import concurrent.futures
+import io
 import json
 import os
-import random
-import string
+import queue
+import threading
 import time
-import io
 import requests
 from PIL import Image
 from dotenv import load_dotenv
 from selenium.webdriver.common.by import By
 from utils import logger
 
+# imported by import_torch, only the local solver needs it and it is slow to load
+torch = None
 
 load_dotenv()
 
-tries = 0
+CAPTCHA_BACKEND = os.getenv("CAPTCHA_BACKEND", "azcaptcha")
+CAPTCHA_MIN_CONFIDENCE = float(os.getenv("CAPTCHA_MIN_CONFIDENCE", 0.9))
+AZCAPTCHA_COST_PER_SOLVE = float(os.getenv("AZCAPTCHA_COST_PER_SOLVE", 0.001))
+LOCAL_OCR_CHARSET = os.getenv(
+    "CAPTCHA_MODEL_CHARSET", "0123456789abcdefghijklmnopqrstuvwxyz"
+)
+LOCAL_OCR_IMAGE_SIZE = (32, 100)
 
+AZCAPTCHA_IN_URL = "http://azcaptcha.com/in.php"
+AZCAPTCHA_RES_URL = "http://azcaptcha.com/res.php"
+NOT_READY_ANSWERS = ("CAPCHA_NOT_READY", "ERROR_CAPTCHA_UNSOLVABLE")
 
-def azcaptcha_solver_get(captcha_id):
+# azcaptcha usually answers within a few seconds, poll often at first and back off
+FIRST_POLL_DELAY = 1.5
+POLL_INTERVAL = 0.5
+MAX_POLL_INTERVAL = 3
+POLL_TIMEOUT = 60
+
+
+def import_torch():
+    global torch
+    if torch is None:
+        try:
+            import torch as torch_module
+        except ImportError as e:
+            raise RuntimeError(f"the local captcha solver requires torch: {e}")
+        torch = torch_module
+    return torch
+
+
+def capture_captcha_image(driver):
+    try:
+        image = driver.find_element(By.ID, "captcha_image").screenshot_as_png
+        logger.info("captcha image captured")
+        return image
+    except Exception as e:
+        logger.error(f"capture_captcha_image error; {e}")
+        exit(2)
+
+
+def azcaptcha_upload(image):
+    payload = {"method": "post", "key": os.getenv("CAPTCHA_APIKEY"), "json": 1}
+    files = {"file": ("captcha.png", image, "application/octet-stream")}
+    try:
+        res = requests.post(AZCAPTCHA_IN_URL, data=payload, files=files)
+        res_answer = json.loads(res.text)
+    except requests.exceptions.RequestException as e:
+        logger.error(e)
+        raise SystemExit(e)
 
-    azcaptcha_url = "http://azcaptcha.com/res.php"
+    captcha_id = res_answer["request"]
+    if (
+        captcha_id
+        == "ERROR_TODAY_NO_SLOT_AVAILABLE_UPGRAGE_PACKAGE_OR_CHANGE_TO_USE_BALANCE"
+    ):
+        logger.error(f"captcha error: {captcha_id}")
+        os._exit(1)
+    return captcha_id or None
+
+
+def azcaptcha_solver_get(captcha_id):
     params = {
         "key": os.getenv("CAPTCHA_APIKEY"),
         "action": "get",
@@ -26,81 +84,251 @@ def azcaptcha_solver_get(captcha_id):
         "json": 1,
     }
     try:
-        res = requests.get(azcaptcha_url, params=params)
+        res = requests.get(AZCAPTCHA_RES_URL, params=params)
         res_answer = json.loads(res.text)
         captcha_itext = res_answer["request"]
-        logger.info({"captcha_text": captcha_itext})
-        logger.info({"captcha_id": captcha_id})
     except requests.exceptions.RequestException as e:
         raise SystemExit(e)
     if captcha_itext == "ERROR_USER_BALANCE_ZERO":
         raise SystemExit(captcha_itext)
-
-    if (
-        captcha_itext == "CAPCHA_NOT_READY"
-        or captcha_itext == "ERROR_CAPTCHA_UNSOLVABLE"
-    ):
-        global tries
-        tries += 1
-        logger.info(
-            f"captcha_id: {captcha_id} Retrying to get captcha  in 5 seconds..."
-        )
-        time.sleep(5)
-        if tries < 6:
-            return azcaptcha_solver_get(captcha_id)
     return captcha_itext
 
 
+def azcaptcha_poll(captcha_id):
+    """
+    Poll azcaptcha for the answer of an uploaded captcha.
+    The interval starts short and grows, so fast answers are picked up
+    quickly without hammering the service on slow ones.
+    Returns None if there is no answer after POLL_TIMEOUT seconds.
+    """
+    started = time.time()
+    interval = POLL_INTERVAL
+    time.sleep(FIRST_POLL_DELAY)
+    while time.time() - started < POLL_TIMEOUT:
+        captcha_itext = azcaptcha_solver_get(captcha_id)
+        if captcha_itext not in NOT_READY_ANSWERS:
+            logger.info({"captcha_text": captcha_itext})
+            logger.info({"captcha_id": captcha_id})
+            return captcha_itext
+        time.sleep(interval)
+        interval = min(interval * 1.5, MAX_POLL_INTERVAL)
+    logger.warning(f"captcha_id: {captcha_id} not solved in {POLL_TIMEOUT} seconds")
+    return None
+
+
+def azcaptcha_solve(image):
+    captcha_id = azcaptcha_upload(image)
+    if not captcha_id:
+        return None
+    return azcaptcha_poll(captcha_id)
+
+
 def azcaptcha_solver_post(driver):
-    letters = string.ascii_lowercase
-    random_string = "".join(random.choice(letters) for i in range(10))
-    captcha_name = f"image-captcha-{random_string}.png"
-    image_captcha_path = os.path.join(
-        os.path.realpath(os.path.dirname(__file__)), "captcha", captcha_name
-    )
-    # image_captcha_path = fr"{os.path.realpath(os.path.dirname(__file__))}\{os.path.join('captcha', captcha_name)}"
-    try:
-        image = driver.find_element(By.ID, "captcha_image").screenshot_as_png
-        screenshot = Image.open(io.BytesIO(image))
-        screenshot.save(image_captcha_path)
-        logger.info("captcha image saved")
-    except Exception as e:
-        logger.error(f"azcaptcha_solver_post error; {e}")
-        exit(2)
+    return azcaptcha_solve(capture_captcha_image(driver))
 
-    azcaptcha_url = "http://azcaptcha.com/in.php"
-    payload = {"method": "post", "key": os.getenv("CAPTCHA_APIKEY"), "json": 1}
-    try:
-        captcha_image = open(image_captcha_path, "rb")
-        image_to_upload = (
-            os.path.basename(image_captcha_path),
-            captcha_image,
-            "application/octet-stream",
+
+class CaptchaSolver:
+    """
+    A captcha solving backend.
+    solve_batch takes a list of PNG images and returns one (text, confidence)
+    pair per image, text being None when the backend has no answer.
+    """
+
+    name = "base"
+    cost_per_solve = 0.0
+
+    def solve_batch(self, images):
+        raise NotImplementedError
+
+    def solve(self, image):
+        return self.solve_batch([image])[0]
+
+
+class AzcaptchaSolver(CaptchaSolver):
+    name = "azcaptcha"
+    cost_per_solve = AZCAPTCHA_COST_PER_SOLVE
+
+    def solve_batch(self, images):
+        # azcaptcha gives no confidence, an answer is as good as it gets
+        results = []
+        for image in images:
+            text = azcaptcha_solve(image)
+            results.append((text, 1.0 if text else 0.0))
+        return results
+
+
+class LocalOcrSolver(CaptchaSolver):
+    """
+    Offline solver running a TorchScript CTC recognition model on the CPU,
+    e.g. one trained and exported with deep-text-recognition-benchmark.
+    Args
+    ----
+    model_path : str
+        The exported model, taking a (batch, 1, height, width) tensor and
+        returning (batch, steps, len(charset) + 1) logits, 0 being the blank.
+    charset : str
+        Characters of the model's output classes, after the blank.
+    max_batch_size : int
+        Maximum number of images sent to the model in one inference call.
+    batch_window : float
+        Seconds solve waits for images from other threads to join its batch.
+    """
+
+    name = "local"
+
+    def __init__(
+        self,
+        model_path,
+        charset=LOCAL_OCR_CHARSET,
+        image_size=LOCAL_OCR_IMAGE_SIZE,
+        max_batch_size=16,
+        batch_window=0.02,
+    ):
+        import_torch()
+        torch.set_num_threads(max(1, (os.cpu_count() or 2) // 2))
+        self.model = torch.jit.load(model_path, map_location="cpu").eval()
+        self.charset = charset
+        self.image_size = image_size
+        self.max_batch_size = max_batch_size
+        self.batch_window = batch_window
+        self._queue = queue.Queue()
+        self._batcher = threading.Thread(
+            target=self._run_batches, name="captcha-batcher", daemon=True
         )
-    except FileNotFoundError as e:
-        logger.error("file not found")
-        return None
+        self._batcher.start()
 
-    files = {"file": image_to_upload}
+    def preprocess(self, image):
+        height, width = self.image_size
+        img = Image.open(io.BytesIO(image)).convert("L").resize((width, height))
+        tensor = torch.tensor(list(img.getdata()), dtype=torch.float32)
+        tensor = tensor.div(255).sub(0.5).div(0.5)
+        return tensor.view(1, height, width)
 
-    try:
-        res = requests.post(azcaptcha_url, data=payload, files=files)
-        if os.path.isfile(image_captcha_path):
-            captcha_image.close()
-            os.remove(image_captcha_path)
+    def decode(self, probs):
+        # greedy CTC decoding, confidence is the product of the kept step probabilities
+        best_probs, best_classes = probs.max(dim=-1)
+        text = []
+        confidence = 1.0
+        previous = 0
+        for prob, klass in zip(best_probs.tolist(), best_classes.tolist()):
+            if klass != 0 and klass != previous:
+                text.append(self.charset[klass - 1])
+                confidence *= prob
+            previous = klass
+        return "".join(text), confidence
 
-        res_answer = json.loads(res.text)
-        captcha_id = res_answer["request"]
-        if captcha_id:
-            if (
-                captcha_id
-                == "ERROR_TODAY_NO_SLOT_AVAILABLE_UPGRAGE_PACKAGE_OR_CHANGE_TO_USE_BALANCE"
+    def solve_batch(self, images):
+        batch = torch.stack([self.preprocess(image) for image in images])
+        with torch.no_grad():
+            probs = self.model(batch).softmax(dim=-1)
+        return [self.decode(image_probs) for image_probs in probs]
+
+    def solve(self, image):
+        # concurrent callers are grouped into one inference call
+        future = concurrent.futures.Future()
+        self._queue.put((image, future))
+        return future.result()
+
+    def _run_batches(self):
+        while True:
+            pending = [self._queue.get()]
+            deadline = time.time() + self.batch_window
+            while len(pending) < self.max_batch_size:
+                try:
+                    pending.append(
+                        self._queue.get(timeout=max(0, deadline - time.time()))
+                    )
+                except queue.Empty:
+                    break
+            try:
+                results = self.solve_batch([image for image, _ in pending])
+                for (_, future), result in zip(pending, results):
+                    future.set_result(result)
+            except Exception as e:
+                for _, future in pending:
+                    future.set_exception(e)
+
+
+class FallbackSolver(CaptchaSolver):
+    """
+    Try the primary backend first and send the images it is not confident
+    about to the fallback backend.
+    """
+
+    def __init__(self, primary, fallback, min_confidence=0.9):
+        self.primary = primary
+        self.fallback = fallback
+        self.min_confidence = min_confidence
+        self.name = f"{primary.name}+{fallback.name}"
+        self.cost_per_solve = primary.cost_per_solve
+
+    def solve_batch(self, images):
+        results = self.primary.solve_batch(images)
+        retry = [
+            index
+            for index, (text, confidence) in enumerate(results)
+            if not text or confidence < self.min_confidence
+        ]
+        if retry:
+            logger.info(
+                f"{len(retry)} captchas below {self.min_confidence} confidence, "
+                f"asking {self.fallback.name}"
+            )
+            for index, result in zip(
+                retry, self.fallback.solve_batch([images[index] for index in retry])
             ):
-                logger.error(f"captcha error: {captcha_id}")
-                os._exit(1)
-            time.sleep(5)
-            return azcaptcha_solver_get(captcha_id)
-        return None
-    except requests.exceptions.RequestException as e:
-        logger.error(e)
-        raise SystemExit(e)
+                results[index] = result
+        return results
+
+    def solve(self, image):
+        text, confidence = self.primary.solve(image)
+        if text and confidence >= self.min_confidence:
+            return text, confidence
+        logger.info(f"local captcha answer {text} at {confidence:.2f}, falling back")
+        return self.fallback.solve(image)
+
+
+class MockCaptchaSolver(CaptchaSolver):
+    """
+    Reads the answer the local CEJ mock paints into its captchas, for
+    benchmarks against mock_cej.py. latency simulates a remote solver.
+    """
+
+    name = "mock"
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+
+    def solve_batch(self, images):
+        # imported here so the production solvers never load the mock server
+        from mock_cej import read_captcha
+
+        time.sleep(self.latency)
+        results = []
+        for image in images:
+            text = read_captcha(image)
+            results.append((text, 1.0 if text else 0.0))
+        return results
+
+
+def get_captcha_solver(backend=CAPTCHA_BACKEND):
+    # azcaptcha, local, or local+azcaptcha to fall back on low confidence
+    if backend == AzcaptchaSolver.name:
+        return AzcaptchaSolver()
+    if backend == MockCaptchaSolver.name:
+        return MockCaptchaSolver(float(os.getenv("MOCK_CAPTCHA_LATENCY", 0)))
+    if backend not in (
+        LocalOcrSolver.name,
+        f"{LocalOcrSolver.name}+{AzcaptchaSolver.name}",
+    ):
+        raise ValueError(f"unknown captcha backend: {backend}")
+    model_path = os.getenv("CAPTCHA_MODEL_PATH")
+    if not model_path or not os.path.isfile(model_path):
+        raise ValueError(
+            f"the {backend} captcha backend needs CAPTCHA_MODEL_PATH set to an "
+            f"exported model, got {model_path!r}"
+        )
+    local_solver = LocalOcrSolver(model_path)
+    if backend == LocalOcrSolver.name:
+        return local_solver
+    return FallbackSolver(local_solver, AzcaptchaSolver(), CAPTCHA_MIN_CONFIDENCE)
@@ -0,0 +1,324 @@
+import argparse
+import concurrent.futures
+import json
+import os
+import time
+
+import requests
+from bs4 import BeautifulSoup
+from selenium.webdriver.common.by import By
+from selenium.webdriver.support import expected_conditions as EC
+from selenium.webdriver.support.ui import Select
+
+from constants import list_all_comb
+from utils import logger
+from waits import wait_until
+
+METADATA_FILENAME = "cej_metadata.json"
+# bump when the layout of the cache file changes, older caches are crawled again
+METADATA_VERSION = 1
+DEFAULT_METADATA_TTL = 7 * 24 * 3600
+PLACEHOLDER_TEXT = "--SELECCIONAR"
+
+
+class MetadataError(Exception):
+    pass
+
+
+class CejMetadata:
+    """
+    The options of the search form's dropdowns.
+    Args
+    ----
+    locations : list
+        Options of distritoJudicial.
+    years : list
+        Options of anio, most recent first.
+    combos : dict
+        [location, organo, especialidad] combos of the cascade, by the year
+        that was selected while crawling it.
+    crawled_at : float
+        When the dropdowns were read.
+    base_url : str
+        Site they were read from, a cache of another site is not used.
+    """
+
+    def __init__(
+        self,
+        locations,
+        years,
+        combos,
+        crawled_at=None,
+        base_url=None,
+        version=METADATA_VERSION,
+    ):
+        self.locations = list(locations)
+        self.years = list(years)
+        self.combos = {str(year): combos for year, combos in combos.items()}
+        self.crawled_at = crawled_at or time.time()
+        self.base_url = base_url
+        self.version = version
+
+    @classmethod
+    def load(cls, path):
+        # None when there is no usable cache
+        try:
+            with open(path) as fp:
+                data = json.load(fp)
+            return cls(
+                data["locations"],
+                data["years"],
+                data["combos"],
+                data["crawled_at"],
+                data.get("base_url"),
+                data.get("version"),
+            )
+        except FileNotFoundError:
+            return None
+        except (ValueError, KeyError, TypeError) as e:
+            logger.warning(f"ignoring unreadable metadata cache {path}: {e}")
+            return None
+
+    def save(self, path):
+        parent_dir = os.path.dirname(path)
+        if parent_dir:
+            os.makedirs(parent_dir, exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as fp:
+            json.dump(
+                {
+                    "version": self.version,
+                    "crawled_at": self.crawled_at,
+                    "base_url": self.base_url,
+                    "locations": self.locations,
+                    "years": self.years,
+                    "combos": self.combos,
+                },
+                fp,
+                ensure_ascii=False,
+                indent=1,
+            )
+        os.replace(tmp_path, path)
+
+    def get_age(self):
+        return time.time() - self.crawled_at
+
+    def is_fresh(self, ttl, base_url=None):
+        return (
+            self.version == METADATA_VERSION
+            and (base_url is None or self.base_url == base_url)
+            and self.get_age() < ttl
+        )
+
+    def has_year(self, year):
+        return str(year) in self.combos
+
+    def set_combos(self, year, combos):
+        self.combos[str(year)] = [list(combo) for combo in combos]
+
+    def get_combos(self, year=None):
+        """
+        Combos crawled for year. For a year that was not crawled, those of the
+        latest year crawled together with constants.list_all_comb, so courts
+        and specialties that were dropped since are still searched.
+        """
+        combos = self.combos.get(str(year))
+        if combos is not None:
+            return [list(combo) for combo in combos]
+        merged = []
+        seen = set()
+        for combo in (self.combos[max(self.combos)] if self.combos else []) + [
+            list(combo) for combo in list_all_comb
+        ]:
+            if tuple(combo) not in seen:
+                seen.add(tuple(combo))
+                merged.append(list(combo))
+        return merged
+
+
+def get_select_options(soup, select_id):
+    select = soup.find("select", id=select_id)
+    if select is None:
+        return []
+    return [
+        " ".join(option.get_text().split())
+        for option in select.find_all("option")
+        if " ".join(option.get_text().split()) not in ("", PLACEHOLDER_TEXT)
+    ]
+
+
+def fetch_form_options(link, timeout=30):
+    """
+    Read the districts and years of the search form over plain HTTP, both
+    are in the page as served. Returns (locations, years).
+    """
+    try:
+        res = requests.get(link, timeout=timeout)
+        res.raise_for_status()
+    except requests.exceptions.RequestException as e:
+        raise MetadataError(e)
+    soup = BeautifulSoup(res.text, "html.parser")
+    locations = get_select_options(soup, "distritoJudicial")
+    years = sorted(
+        (int(year) for year in get_select_options(soup, "anio") if year.isdigit()),
+        reverse=True,
+    )
+    if not locations or not years:
+        raise MetadataError(f"no distritoJudicial or anio options in {link}")
+    return locations, years
+
+
+def select_and_read(driver, select_id, text, target_id, timeout):
+    """
+    Select text in one dropdown and return the options it loads into the next.
+    """
+    previous = driver.find_elements(By.CSS_SELECTOR, f"#{target_id} option")
+    Select(driver.find_element(By.ID, select_id)).select_by_visible_text(text)
+    if previous:
+        wait_until(driver, EC.staleness_of(previous[0]), timeout)
+    if not wait_until(
+        driver,
+        EC.text_to_be_present_in_element((By.ID, target_id), PLACEHOLDER_TEXT),
+        timeout,
+    ):
+        raise MetadataError(f"{target_id} did not load after selecting {text}")
+    return [
+        option.text
+        for option in Select(driver.find_element(By.ID, target_id)).options
+        if option.text != PLACEHOLDER_TEXT
+    ]
+
+
+def crawl_location(driver, link, location, year, timeout=10):
+    # every [location, organo, especialidad] of one district
+    driver.get(link)
+    if not wait_until(
+        driver,
+        EC.text_to_be_present_in_element((By.ID, "distritoJudicial"), PLACEHOLDER_TEXT),
+        timeout,
+    ):
+        raise MetadataError(f"search form did not load from {link}")
+    Select(driver.find_element(By.ID, "distritoJudicial")).select_by_visible_text(
+        location
+    )
+    organos = select_and_read(
+        driver, "anio", str(year), "organoJurisdiccional", timeout
+    )
+    combos = []
+    for organo in organos:
+        for especialidad in select_and_read(
+            driver, "organoJurisdiccional", organo, "especialidad", timeout
+        ):
+            combos.append([location, organo, especialidad])
+    return combos
+
+
+def crawl_combos(driver_pool, link, locations, year, workers, timeout=10):
+    """
+    Crawl the cascade of every location on up to workers browsers at once.
+    """
+
+    def crawl(location):
+        driver = driver_pool.acquire()
+        try:
+            combos = crawl_location(driver, link, location, year, timeout)
+        except BaseException:
+            # the page may be left anywhere in the cascade, never reuse it
+            driver_pool.discard(driver)
+            raise
+        driver_pool.release(driver)
+        logger.info(f"{location}: {len(combos)} combos")
+        return combos
+
+    combos = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        for location_combos in executor.map(crawl, locations):
+            combos.extend(location_combos)
+    return combos
+
+
+def crawl_metadata(driver_pool, base_url, link, workers, years=None, timeout=10):
+    """
+    Read the districts and years over HTTP, then crawl the combos of years,
+    by default the latest one.
+    """
+    locations, valid_years = fetch_form_options(link)
+    combos = {}
+    for year in years or valid_years[:1]:
+        started = time.time()
+        combos[year] = crawl_combos(
+            driver_pool, link, locations, year, workers, timeout
+        )
+        logger.info(
+            f"{len(combos[year])} combos of {year} crawled "
+            f"in {time.time() - started:.0f}s"
+        )
+    return CejMetadata(locations, valid_years, combos, base_url=base_url)
+
+
+def diff_combos(combos, reference=list_all_comb):
+    # (new, removed): combos only in combos, and only in reference
+    current = {tuple(combo) for combo in combos}
+    known = {tuple(combo) for combo in reference}
+    return (
+        sorted(list(combo) for combo in current - known),
+        sorted(list(combo) for combo in known - current),
+    )
+
+
+def log_diff(metadata):
+    for year in sorted(metadata.combos):
+        new, removed = diff_combos(metadata.get_combos(year))
+        if new or removed:
+            logger.warning(
+                f"{year}: {len(new)} combos not in constants.list_all_comb, "
+                f"{len(removed)} of it no longer offered"
+            )
+        for combo in new:
+            logger.info(f"new combo: {combo}")
+        for combo in removed:
+            logger.info(f"removed combo: {combo}")
+
+
+if __name__ == "__main__":
+    data_dir = os.getenv("DATA_DIR") or os.path.join(
+        os.path.realpath(os.path.dirname(__file__)), "data"
+    )
+    parser = argparse.ArgumentParser(
+        description="Show the cached dropdown metadata and diff it against constants.list_all_comb"
+    )
+    parser.add_argument("command", choices=["show", "diff"])
+    parser.add_argument(
+        "--path",
+        dest="path",
+        default=os.getenv("CEJ_METADATA_PATH")
+        or os.path.join(data_dir, METADATA_FILENAME),
+    )
+    args = parser.parse_args()
+
+    metadata = CejMetadata.load(args.path)
+    if metadata is None:
+        parser.exit(1, f"no metadata cache at {args.path}, run scrape.py first\n")
+    if args.command == "show":
+        print(
+            json.dumps(
+                {
+                    "version": metadata.version,
+                    "base_url": metadata.base_url,
+                    "age_hours": round(metadata.get_age() / 3600, 1),
+                    "locations": len(metadata.locations),
+                    "years": metadata.years,
+                    "combos": {
+                        year: len(combos) for year, combos in metadata.combos.items()
+                    },
+                },
+                indent=2,
+            )
+        )
+    else:
+        for year in sorted(metadata.combos):
+            new, removed = diff_combos(metadata.get_combos(year))
+            for combo in new:
+                print(f"{year}\t+\t{' | '.join(combo)}")
+            for combo in removed:
+                print(f"{year}\t-\t{' | '.join(combo)}")
@@ -0,0 +1,192 @@
+import concurrent.futures
+import hashlib
+import os
+import re
+import threading
+import time
+from collections import namedtuple
+from pathlib import Path
+from urllib.parse import unquote, urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from metrics import get_metrics
+from utils import logger
+
+DownloadJob = namedtuple(
+    "DownloadJob",
+    ["href", "target_download_dir", "cookies", "expediente", "index"],
+    defaults=[None, None],
+)
+
+PART_SUFFIX = ".part"
+CHUNK_SIZE = 64 * 1024
+DEFAULT_FILENAME = "documento"
+
+
+def cookies_to_dict(cookies):
+    # accepts selenium's driver.get_cookies() output as well as a plain dict
+    if isinstance(cookies, dict):
+        return dict(cookies)
+    return {cookie["name"]: cookie["value"] for cookie in cookies or []}
+
+
+def get_part_path(job):
+    # the name is derived from the href so an interrupted download can be resumed
+    digest = hashlib.sha1(job.href.encode("utf-8")).hexdigest()[:16]
+    return os.path.join(job.target_download_dir, f".{digest}{PART_SUFFIX}")
+
+
+def get_filename_from_response(res, href):
+    disposition = res.headers.get("Content-Disposition", "")
+    match = re.search(r"filename\*=(?:UTF-8'')?([^;]+)", disposition, re.IGNORECASE)
+    if match:
+        return os.path.basename(unquote(match.group(1).strip().strip('"')))
+    match = re.search(r'filename="?([^";]+)"?', disposition, re.IGNORECASE)
+    if match:
+        return os.path.basename(match.group(1).strip())
+    return os.path.basename(unquote(urlparse(href).path)) or DEFAULT_FILENAME
+
+
+class DownloadPipeline:
+    """
+    Download documents on a thread pool, decoupled from the browser.
+    Args
+    ----
+    max_in_flight : int
+        Maximum number of downloads queued or running at once. enqueue blocks
+        when the limit is reached, so a fast scraper cannot outrun the disk.
+    max_tries : int
+        How many times a job is attempted before on_failure is called.
+    timeout : int
+        Seconds to wait for the server on each request.
+    on_failure : callable, defaults to None
+        Called with (job, error) once a job has run out of tries.
+    on_success : callable, defaults to None
+        Called with (job, file_path) once a document has been downloaded.
+    """
+
+    def __init__(
+        self,
+        max_in_flight=8,
+        max_tries=4,
+        timeout=60,
+        on_failure=None,
+        on_success=None,
+    ):
+        self.max_in_flight = max_in_flight
+        self.max_tries = max_tries
+        self.timeout = timeout
+        self.on_failure = on_failure
+        self.on_success = on_success
+        self.completed = 0
+        self.failed = 0
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_in_flight, thread_name_prefix="download"
+        )
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def enqueue(
+        self, href, target_download_dir, cookies=None, expediente=None, index=None
+    ):
+        job = DownloadJob(
+            href, target_download_dir, cookies_to_dict(cookies), expediente, index
+        )
+        self._slots.acquire()
+        try:
+            future = self._executor.submit(self._run, job)
+        except RuntimeError:
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda _: self._slots.release())
+        return future
+
+    def close(self, wait=True):
+        self._executor.shutdown(wait=wait)
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions.clear()
+        logger.info(
+            f"download pipeline closed: {self.completed} downloaded, {self.failed} failed"
+        )
+
+    def get_session(self, href):
+        # one pooled session per host, shared by every download thread
+        host = urlparse(href).netloc
+        with self._lock:
+            session = self._sessions.get(host)
+            if session is None:
+                session = requests.Session()
+                adapter = HTTPAdapter(
+                    pool_connections=1, pool_maxsize=self.max_in_flight
+                )
+                session.mount("http://", adapter)
+                session.mount("https://", adapter)
+                self._sessions[host] = session
+            return session
+
+    def _run(self, job):
+        error = None
+        for tries in range(1, self.max_tries + 1):
+            try:
+                with get_metrics().span("download", expediente=job.expediente):
+                    file_path = self.download(job)
+                with self._lock:
+                    self.completed += 1
+                logger.info(f"{os.path.basename(file_path)} downloaded")
+                if self.on_success:
+                    self.on_success(job, file_path)
+                return file_path
+            except (requests.exceptions.RequestException, OSError) as e:
+                error = e
+                logger.info(
+                    f"file not downloaded on try {tries}, {self.max_tries - tries} left: {e}"
+                )
+                time.sleep(tries)
+
+        with self._lock:
+            self.failed += 1
+        if self.on_failure:
+            self.on_failure(job, error)
+        return None
+
+    def download(self, job):
+        if not os.path.exists(job.target_download_dir):
+            Path(job.target_download_dir).mkdir(parents=True, exist_ok=True)
+
+        part_path = get_part_path(job)
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        headers = {"Range": f"bytes={offset}-"} if offset else {}
+
+        session = self.get_session(job.href)
+        with session.get(
+            job.href,
+            cookies=job.cookies,
+            headers=headers,
+            stream=True,
+            timeout=self.timeout,
+        ) as res:
+            if res.status_code == 416 and offset:
+                # the part file already holds the whole document
+                filename = get_filename_from_response(res, job.href)
+            else:
+                res.raise_for_status()
+                filename = get_filename_from_response(res, job.href)
+                mode = "ab" if offset and res.status_code == 206 else "wb"
+                with open(part_path, mode) as fp:
+                    for chunk in res.iter_content(chunk_size=CHUNK_SIZE):
+                        fp.write(chunk)
+
+        file_path = os.path.join(job.target_download_dir, filename)
+        os.replace(part_path, file_path)
+        return file_path
@@ -0,0 +1,138 @@
+import collections
+import ctypes
+import ctypes.util
+import os
+import select
+import struct
+import sys
+import time
+
+from utils import logger
+
+DownloadResult = collections.namedtuple("DownloadResult", ["paths", "size", "duration"])
+
+# names browsers write to while a download is still in progress
+TEMP_SUFFIXES = (".crdownload", ".part", ".tmp", ".download")
+POLL_INTERVAL = 0.05
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+INOTIFY_EVENT = struct.Struct("iIII")
+
+_libc = None
+
+
+def _get_libc():
+    global _libc
+    if _libc is None and sys.platform.startswith("linux"):
+        try:
+            _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            _libc.inotify_init1
+        except (OSError, AttributeError):
+            _libc = False
+    return _libc or None
+
+
+def is_temp_download(file_name):
+    return file_name.startswith(".") or file_name.endswith(TEMP_SUFFIXES)
+
+
+class DownloadWatcher:
+    """
+    Wait for the browser to finish the next downloads into a directory.
+    Args
+    ----
+    directory : str
+        The browser's download directory.
+
+    Create the watcher before navigating to the download link so nothing that
+    happens in between is missed. Files already in the directory are ignored.
+    On Linux the watcher sleeps on inotify events and wakes up as soon as the
+    browser closes or renames the finished file; elsewhere it polls the
+    directory every POLL_INTERVAL seconds.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.started = time.time()
+        self._existing = set(os.listdir(directory))
+        self._fd = None
+        libc = _get_libc()
+        if libc:
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd >= 0 and (
+                libc.inotify_add_watch(
+                    fd, os.fsencode(directory), IN_CLOSE_WRITE | IN_MOVED_TO
+                )
+                >= 0
+            ):
+                self._fd = fd
+            elif fd >= 0:
+                os.close(fd)
+            if self._fd is None:
+                logger.warning(
+                    f"inotify unavailable ({os.strerror(ctypes.get_errno())}), "
+                    "polling for downloads"
+                )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def _finished_files(self):
+        # new files count once no download is in progress next to them, a
+        # link can start more than one download
+        new_files = [
+            file_name
+            for file_name in os.listdir(self.directory)
+            if file_name not in self._existing
+        ]
+        if any(is_temp_download(file_name) for file_name in new_files):
+            return []
+        return [
+            os.path.join(self.directory, file_name)
+            for file_name in sorted(new_files)
+            if os.path.isfile(os.path.join(self.directory, file_name))
+        ]
+
+    def _read_events(self, timeout):
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return
+        try:
+            data = os.read(self._fd, 64 * 1024)
+        except BlockingIOError:
+            return
+        offset = 0
+        while offset < len(data):
+            _, _, _, name_len = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size + name_len
+
+    def wait(self, timeout):
+        """
+        Returns a DownloadResult with every finished file, or None on timeout.
+        """
+        deadline = self.started + timeout
+        while True:
+            paths = self._finished_files()
+            if paths:
+                duration = time.time() - self.started
+                size = sum(os.path.getsize(path) for path in paths)
+                return DownloadResult(paths, size, duration)
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return None
+            if self._fd is not None:
+                # any event in the directory means it is worth looking again
+                self._read_events(remaining)
+            else:
+                time.sleep(min(POLL_INTERVAL, remaining))
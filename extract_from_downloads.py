@@ -0,0 +1,287 @@
+import argparse
+import concurrent.futures
+import os
+import signal
+import sqlite3
+import time
+
+import psutil
+
+from blob_store import hash_file
+from download_watcher import is_temp_download
+from extract_from_html import FORMAT_CSV, FORMAT_PARQUET, BatchWriter
+from utils import logger
+
+BASE_DIR = os.path.realpath(os.path.dirname(__file__))
+CACHE_FILENAME = "extract_from_downloads.sqlite3"
+DOWNLOADS_TABLE = "DF_DOWNLOADS"
+DOWNLOAD_COLUMNS = [
+    "source",
+    "expediente",
+    "index",
+    "file_name",
+    "sha256",
+    "size",
+    "text",
+    "error",
+]
+# files the scraper writes next to the documents
+IGNORED_FILE_NAMES = {"link.txt"}
+DEFAULT_FILE_TIMEOUT = 120
+
+
+class ExtractionTimeout(Exception):
+    pass
+
+
+def raise_timeout(signum, frame):
+    raise ExtractionTimeout()
+
+
+def import_textract():
+    # only in requirements_win.txt, its pinned dependencies clash with the scraper's
+    try:
+        import textract
+    except ImportError as e:
+        raise SystemExit(
+            f"extract_from_downloads.py needs textract and its native dependencies "
+            f"(antiword, pdftotext...), see the README: {e}"
+        )
+    return textract
+
+
+def kill_child_processes():
+    # the antiword/pdftotext/... textract started, the alarm only stops python
+    for child in psutil.Process().children(recursive=True):
+        try:
+            child.kill()
+        except psutil.Error:
+            pass
+
+
+def extract_text(file_path, timeout):
+    """
+    Runs in the worker processes. Returns (text, error); a document that
+    takes longer than timeout seconds is abandoned with an error, and the
+    programs textract started for it are killed.
+    """
+    textract = import_textract()
+    signal.signal(signal.SIGALRM, raise_timeout)
+    signal.alarm(timeout)
+    try:
+        return textract.process(file_path).decode("utf-8", errors="replace"), None
+    except ExtractionTimeout:
+        kill_child_processes()
+        return None, f"timed out after {timeout}s"
+    except Exception as e:
+        return None, f"{type(e).__name__}: {e}"
+    finally:
+        signal.alarm(0)
+
+
+class TextCache:
+    """
+    Extracted text by content hash, plus the hash of every file already
+    seen, keyed by path and mtime/size so unchanged files are not hashed
+    again.
+    """
+
+    def __init__(self, db_path):
+        self._conn = sqlite3.connect(db_path)
+        self._conn.executescript("""
+            CREATE TABLE IF NOT EXISTS texts (
+                sha256 TEXT PRIMARY KEY,
+                text TEXT,
+                error TEXT,
+                extracted_at REAL NOT NULL
+            ) WITHOUT ROWID;
+            CREATE TABLE IF NOT EXISTS files (
+                source TEXT PRIMARY KEY,
+                version TEXT NOT NULL,
+                sha256 TEXT NOT NULL
+            ) WITHOUT ROWID;
+            """)
+
+    def is_file_done(self, source, version):
+        row = self._conn.execute(
+            "SELECT version FROM files WHERE source = ?", (source,)
+        ).fetchone()
+        return row is not None and row[0] == version
+
+    def get_text(self, sha256):
+        # (text, error), or None when the content was never extracted
+        return self._conn.execute(
+            "SELECT text, error FROM texts WHERE sha256 = ?", (sha256,)
+        ).fetchone()
+
+    def add_text(self, sha256, text, error):
+        self._conn.execute(
+            "INSERT OR REPLACE INTO texts (sha256, text, error, extracted_at) "
+            "VALUES (?, ?, ?, ?)",
+            (sha256, text, error, time.time()),
+        )
+
+    def mark_files_done(self, files):
+        with self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO files (source, version, sha256) VALUES (?, ?, ?)",
+                files,
+            )
+
+    def close(self):
+        self._conn.commit()
+        self._conn.close()
+
+
+def iter_downloaded_files(data_dir):
+    # (source, file_path, stat) of every document, found lazily
+    for year in sorted(os.listdir(data_dir)):
+        downloads_dir = os.path.join(data_dir, year, "downloaded_files")
+        if not os.path.isdir(downloads_dir):
+            continue
+        for dir_path, _, file_names in os.walk(downloads_dir):
+            for file_name in file_names:
+                if file_name in IGNORED_FILE_NAMES or is_temp_download(file_name):
+                    continue
+                file_path = os.path.join(dir_path, file_name)
+                source = os.path.relpath(file_path, data_dir).replace(os.sep, "/")
+                yield source, file_path, os.stat(file_path)
+
+
+def get_download_record(source, sha256, size, text, error):
+    # documents live in downloaded_files/<expediente>_<index>/
+    subfolder = source.split("/")[-2]
+    expediente, _, index = subfolder.rpartition("_")
+    return {
+        "source": source,
+        "expediente": expediente or subfolder,
+        "index": int(index) if index.isdigit() else None,
+        "file_name": source.split("/")[-1],
+        "sha256": sha256,
+        "size": size,
+        "text": text,
+        "error": error,
+    }
+
+
+def extract(
+    files,
+    cache,
+    batch_writer,
+    max_workers=None,
+    batch_size=500,
+    timeout=DEFAULT_FILE_TIMEOUT,
+):
+    """
+    Extract the text of new documents on a process pool.
+    Files seen before with the same mtime and size are skipped, and a file
+    whose content was already extracted under another name reuses the cached
+    text. Records are written in batches of batch_size.
+    """
+    max_workers = max_workers or os.cpu_count() or 1
+    max_pending = max_workers * 2
+    pending = {}
+    records = []
+    done_files = []
+    extracted = cached = skipped = failed = 0
+
+    def flush():
+        batch_writer.write(DOWNLOADS_TABLE, records)
+        records.clear()
+        cache.mark_files_done(done_files)
+        done_files.clear()
+
+    def add(source, version, sha256, size, text, error):
+        records.append(get_download_record(source, sha256, size, text, error))
+        done_files.append((source, version, sha256))
+        if len(records) >= batch_size:
+            flush()
+
+    def collect(done):
+        nonlocal extracted, failed
+        for future in done:
+            source, version, sha256, size = pending.pop(future)
+            text, error = future.result()
+            cache.add_text(sha256, text, error)
+            if error:
+                failed += 1
+                logger.warning(f"could not extract {source}: {error}")
+            else:
+                extracted += 1
+            add(source, version, sha256, size, text, error)
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        for source, file_path, stat in files:
+            version = f"{stat.st_mtime_ns}:{stat.st_size}"
+            if cache.is_file_done(source, version):
+                skipped += 1
+                continue
+            sha256 = hash_file(file_path)
+            known = cache.get_text(sha256)
+            if known:
+                cached += 1
+                add(source, version, sha256, stat.st_size, *known)
+                continue
+            future = executor.submit(extract_text, file_path, timeout)
+            pending[future] = (source, version, sha256, stat.st_size)
+            if len(pending) >= max_pending:
+                done, _ = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                collect(done)
+        collect(concurrent.futures.wait(pending).done)
+    flush()
+    logger.info(
+        f"{extracted} documents extracted, {cached} from cache, "
+        f"{skipped} unchanged, {failed} failed"
+    )
+    return extracted, cached, skipped, failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Extract the text of the downloaded pdf/doc files"
+    )
+    parser.add_argument(
+        "--data-dir", dest="data_dir", default=os.path.join(BASE_DIR, "data")
+    )
+    parser.add_argument(
+        "--output-dir",
+        dest="output_dir",
+        default=os.path.join(BASE_DIR, "data_cleaned"),
+    )
+    parser.add_argument(
+        "--format",
+        dest="output_format",
+        choices=[FORMAT_CSV, FORMAT_PARQUET],
+        default=FORMAT_CSV,
+    )
+    parser.add_argument("--workers", dest="workers", type=int, default=None)
+    parser.add_argument("--batch-size", dest="batch_size", type=int, default=500)
+    parser.add_argument(
+        "--timeout",
+        dest="timeout",
+        type=int,
+        default=DEFAULT_FILE_TIMEOUT,
+        help="seconds allowed for each document",
+    )
+    args = parser.parse_args()
+    import_textract()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    cache = TextCache(os.path.join(args.output_dir, CACHE_FILENAME))
+    batch_writer = BatchWriter(
+        args.output_dir, args.output_format, {DOWNLOADS_TABLE: DOWNLOAD_COLUMNS}
+    )
+    try:
+        extract(
+            iter_downloaded_files(args.data_dir),
+            cache,
+            batch_writer,
+            args.workers,
+            args.batch_size,
+            args.timeout,
+        )
+    finally:
+        batch_writer.close()
+        cache.close()
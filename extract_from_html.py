@@ -0,0 +1,397 @@
+import argparse
+import concurrent.futures
+import csv
+import os
+import re
+import sqlite3
+import time
+import unicodedata
+from datetime import datetime
+
+from bs4 import BeautifulSoup
+
+from html_store import HTML_SEGMENTS_DIRNAME, HtmlSegmentReader, get_html_key
+from http_fetcher import get_element_text
+from utils import logger
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+BASE_DIR = os.path.realpath(os.path.dirname(__file__))
+MANIFEST_FILENAME = "extract_from_html.sqlite3"
+
+FORMAT_CSV = "csv"
+FORMAT_PARQUET = "parquet"
+
+CASE_COLUMNS = [
+    "source",
+    "expediente",
+    "organo_jurisdiccional",
+    "distrito_judicial",
+    "juez",
+    "especialista_legal",
+    "fecha_de_inicio",
+    "proceso",
+    "observacion",
+    "especialidad",
+    "materias",
+    "estado",
+    "etapa_procesal",
+    "fecha_conclusion",
+    "ubicacion",
+    "motivo_conclusion",
+    "sumilla",
+]
+PARTE_COLUMNS = [
+    "source",
+    "expediente",
+    "parte",
+    "tipo_de_persona",
+    "apellido_paterno_razon_social",
+    "apellido_materno",
+    "nombres",
+]
+RESOLUCION_COLUMNS = [
+    "source",
+    "expediente",
+    "index",
+    "fecha_de_resolucion",
+    "resolucion",
+    "tipo_de_notificacion",
+    "acto",
+    "fojas",
+    "proveido",
+    "sumilla",
+    "descripcion_de_usuario",
+    "download_href",
+]
+TABLES = {
+    "DF_CASES": CASE_COLUMNS,
+    "DF_PARTES": PARTE_COLUMNS,
+    "DF_RESOLUCIONES": RESOLUCION_COLUMNS,
+}
+DATE_COLUMNS = {"fecha_de_inicio", "fecha_conclusion", "fecha_de_resolucion"}
+INT_COLUMNS = {"index", "fojas", "size"}
+
+
+def get_column_name(label):
+    # "Órgano Jurisdiccional:" -> organo_jurisdiccional, "Materia(s):" -> materias
+    label = unicodedata.normalize("NFKD", label)
+    label = "".join(c for c in label if not unicodedata.combining(c)).lower()
+    label = label.replace("n°", "").replace("(s)", "s").replace("/", " ")
+    return "_".join(re.findall(r"[a-z0-9]+", label))
+
+
+def to_date(value):
+    # CEJ shows dates as dd/mm/yyyy, sometimes followed by the time
+    for date_format in ("%d/%m/%Y %H:%M", "%d/%m/%Y"):
+        try:
+            return datetime.strptime(value, date_format).date().isoformat()
+        except ValueError:
+            continue
+    return value or None
+
+
+def to_int(value):
+    digits = re.sub(r"\D", "", value or "")
+    return int(digits) if digits else None
+
+
+def get_leaf_texts(tag):
+    # texts of the innermost divs, in document order
+    return [
+        get_element_text(div) for div in tag.find_all("div") if div.find("div") is None
+    ]
+
+
+def get_label_values(tag, columns):
+    """
+    Pair every "Label:" cell with the cell after it and keep the labels that
+    are known columns, converted to their type.
+    """
+    record = {}
+    texts = get_leaf_texts(tag)
+    for label, value in zip(texts, texts[1:]):
+        if not label.endswith(":"):
+            continue
+        column = get_column_name(label)
+        if column not in columns or column in record:
+            continue
+        if column in DATE_COLUMNS:
+            value = to_date(value)
+        elif column in INT_COLUMNS:
+            value = to_int(value)
+        record[column] = value or None
+    return record
+
+
+def parse_case_page(source, html):
+    """
+    Returns the case, partes and resoluciones records of a saved detail page.
+    """
+    soup = BeautifulSoup(html, "html.parser")
+    case_fields = [
+        get_element_text(tag)
+        for tag in soup.find_all("div", attrs={"class": "celdaGrid celdaGridXe"})
+    ]
+    expediente = case_fields[0] if case_fields else None
+
+    case = dict.fromkeys(CASE_COLUMNS)
+    grid = soup.find(id="gridRE") or soup
+    case.update(get_label_values(grid, CASE_COLUMNS))
+    case["source"] = source
+    case["expediente"] = expediente
+
+    partes = []
+    for row in soup.find_all("div", attrs={"class": "partes"}):
+        texts = [text for text in get_leaf_texts(row) if text]
+        # the header row repeats the column names
+        if not texts or get_column_name(texts[0]) == "parte":
+            continue
+        parte = dict.fromkeys(PARTE_COLUMNS)
+        parte.update(zip(PARTE_COLUMNS[2:], texts))
+        parte["source"] = source
+        parte["expediente"] = expediente
+        partes.append(parte)
+
+    resoluciones = []
+    panels = soup.find_all(
+        "div", class_=lambda c: c and ("divResolPar" in c or "divResolImpar" in c)
+    )
+    for index, panel in enumerate(panels, 1):
+        resolucion = dict.fromkeys(RESOLUCION_COLUMNS)
+        resolucion.update(get_label_values(panel, RESOLUCION_COLUMNS))
+        link = panel.find("a", class_="aDescarg")
+        resolucion["source"] = source
+        resolucion["expediente"] = expediente
+        resolucion["index"] = index
+        resolucion["download_href"] = link.get("href") if link else None
+        resoluciones.append(resolucion)
+
+    return {"DF_CASES": [case], "DF_PARTES": partes, "DF_RESOLUCIONES": resoluciones}
+
+
+def parse_saved_page(source, file_path=None, html=None):
+    # runs in the worker processes, pages on disk are read there as well
+    if html is None:
+        with open(file_path, encoding="utf-8", errors="replace") as fp:
+            html = fp.read()
+    return source, parse_case_page(source, html)
+
+
+class ExtractManifest:
+    """
+    Version of every page already extracted: mtime and size for files, the
+    write timestamp for pages in a segment store.
+    """
+
+    def __init__(self, db_path):
+        self._conn = sqlite3.connect(db_path)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS extracted ("
+            "source TEXT PRIMARY KEY, version TEXT NOT NULL, extracted_at REAL NOT NULL"
+            ") WITHOUT ROWID"
+        )
+
+    def is_extracted(self, source, version):
+        row = self._conn.execute(
+            "SELECT version FROM extracted WHERE source = ?", (source,)
+        ).fetchone()
+        return row is not None and row[0] == version
+
+    def mark_extracted(self, versions):
+        now = time.time()
+        with self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO extracted (source, version, extracted_at) "
+                "VALUES (?, ?, ?)",
+                [(source, version, now) for source, version in versions],
+            )
+
+    def close(self):
+        self._conn.close()
+
+
+class BatchWriter:
+    """
+    Append records to one CSV or Parquet file per table, a batch at a time.
+    tables maps each table name to its columns.
+    """
+
+    def __init__(self, output_dir, output_format, tables=TABLES):
+        if output_format == FORMAT_PARQUET and pyarrow is None:
+            raise RuntimeError("parquet output requires pyarrow")
+        self.output_dir = output_dir
+        self.output_format = output_format
+        self.tables = tables
+        self._parquet_writers = {}
+        os.makedirs(output_dir, exist_ok=True)
+
+    def write(self, table, records):
+        if not records:
+            return
+        columns = self.tables[table]
+        if self.output_format == FORMAT_CSV:
+            path = os.path.join(self.output_dir, table + ".csv")
+            is_new = not os.path.exists(path)
+            with open(path, "a", newline="", encoding="utf-8") as fp:
+                writer = csv.DictWriter(fp, fieldnames=columns)
+                if is_new:
+                    writer.writeheader()
+                writer.writerows(records)
+            return
+
+        schema = pyarrow.schema(
+            [
+                (
+                    column,
+                    pyarrow.int64() if column in INT_COLUMNS else pyarrow.string(),
+                )
+                for column in columns
+            ]
+        )
+        writer = self._parquet_writers.get(table)
+        if writer is None:
+            # a new file per run, parquet files cannot be appended to
+            path = os.path.join(
+                self.output_dir, f"{table}-{time.strftime('%Y%m%d%H%M%S')}.parquet"
+            )
+            writer = pyarrow.parquet.ParquetWriter(path, schema)
+            self._parquet_writers[table] = writer
+        writer.write_table(pyarrow.Table.from_pylist(records, schema=schema))
+
+    def close(self):
+        for writer in self._parquet_writers.values():
+            writer.close()
+        self._parquet_writers.clear()
+
+
+def iter_raw_html_files(data_dir):
+    # (source, version, file_path, html) of every page file, found lazily
+    for year in sorted(os.listdir(data_dir)):
+        raw_html_dir = os.path.join(data_dir, year, "raw_html")
+        if not os.path.isdir(raw_html_dir):
+            continue
+        for dir_path, _, file_names in os.walk(raw_html_dir):
+            for file_name in file_names:
+                if not file_name.endswith(".txt"):
+                    continue
+                file_path = os.path.join(dir_path, file_name)
+                stat = os.stat(file_path)
+                version = f"{stat.st_mtime_ns}:{stat.st_size}"
+                yield get_html_key(data_dir, file_path), version, file_path, None
+
+
+def iter_segment_pages(segments_dir):
+    reader = HtmlSegmentReader(segments_dir)
+    for source, ts, html in reader.iter_pages():
+        yield source, repr(ts), None, html
+
+
+def extract(pages, manifest, batch_writer, max_workers=None, batch_size=5000):
+    """
+    Parse pages on a process pool and write their records in batches.
+    Only a bounded number of pages is in flight and only one batch of records
+    is held in memory. A page is marked in the manifest once its records are
+    written; a page that changed since is extracted again and its new rows
+    are appended, so readers should keep the last rows of each source.
+    """
+    max_workers = max_workers or os.cpu_count() or 1
+    max_pending = max_workers * 4
+    pending = {}
+    batch = {table: [] for table in TABLES}
+    batch_versions = []
+    batch_rows = 0
+    extracted = skipped = failed = 0
+
+    def flush():
+        nonlocal batch_rows
+        for table, records in batch.items():
+            batch_writer.write(table, records)
+            records.clear()
+        manifest.mark_extracted(batch_versions)
+        batch_versions.clear()
+        batch_rows = 0
+
+    def collect(done):
+        nonlocal batch_rows, extracted, failed
+        for future in done:
+            source, version = pending.pop(future)
+            try:
+                _, records = future.result()
+            except Exception as e:
+                failed += 1
+                logger.warning(f"could not extract {source}: {e}")
+                continue
+            for table, table_records in records.items():
+                batch[table].extend(table_records)
+                batch_rows += len(table_records)
+            batch_versions.append((source, version))
+            extracted += 1
+            if extracted % 10000 == 0:
+                logger.info(f"{extracted} pages extracted, {skipped} unchanged")
+        if batch_rows >= batch_size:
+            flush()
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+        for source, version, file_path, html in pages:
+            if manifest.is_extracted(source, version):
+                skipped += 1
+                continue
+            future = executor.submit(parse_saved_page, source, file_path, html)
+            pending[future] = (source, version)
+            if len(pending) >= max_pending:
+                done, _ = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                collect(done)
+        collect(concurrent.futures.wait(pending).done)
+    flush()
+    logger.info(f"{extracted} pages extracted, {skipped} unchanged, {failed} failed")
+    return extracted, skipped, failed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Extract cases, partes and resoluciones from the saved case pages"
+    )
+    parser.add_argument(
+        "--data-dir", dest="data_dir", default=os.path.join(BASE_DIR, "data")
+    )
+    parser.add_argument(
+        "--segments-dir",
+        dest="segments_dir",
+        default=None,
+        help=f"read pages from a segment store, e.g. data/{HTML_SEGMENTS_DIRNAME}",
+    )
+    parser.add_argument(
+        "--output-dir",
+        dest="output_dir",
+        default=os.path.join(BASE_DIR, "data_cleaned"),
+    )
+    parser.add_argument(
+        "--format",
+        dest="output_format",
+        choices=[FORMAT_CSV, FORMAT_PARQUET],
+        default=FORMAT_CSV,
+    )
+    parser.add_argument("--workers", dest="workers", type=int, default=None)
+    parser.add_argument("--batch-size", dest="batch_size", type=int, default=5000)
+    args = parser.parse_args()
+
+    if args.segments_dir:
+        pages = iter_segment_pages(args.segments_dir)
+    else:
+        pages = iter_raw_html_files(args.data_dir)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    manifest = ExtractManifest(os.path.join(args.output_dir, MANIFEST_FILENAME))
+    batch_writer = BatchWriter(args.output_dir, args.output_format)
+    try:
+        extract(pages, manifest, batch_writer, args.workers, args.batch_size)
+    finally:
+        batch_writer.close()
+        manifest.close()
@@ -0,0 +1,287 @@
+import argparse
+import json
+import os
+import socket
+import struct
+import threading
+import time
+import zlib
+
+from utils import logger
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+HTML_SEGMENTS_DIRNAME = "html_segments"
+SEGMENT_SUFFIX = ".seg"
+INDEX_SUFFIX = ".idx"
+DEFAULT_MAX_SEGMENT_BYTES = 256 * 1024 * 1024
+
+CODEC_ZLIB = 1
+CODEC_ZSTD = 2
+
+# key length, codec, timestamp, compressed length
+RECORD_HEADER = struct.Struct(">HBdI")
+
+
+def compress(data, level=None):
+    if zstandard is not None:
+        return CODEC_ZSTD, zstandard.ZstdCompressor(level=level or 10).compress(data)
+    return CODEC_ZLIB, zlib.compress(data, level or 6)
+
+
+def decompress(codec, data):
+    if codec == CODEC_ZSTD:
+        if zstandard is None:
+            raise RuntimeError("reading zstd segments requires zstandard")
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data)
+
+
+def get_segment_paths(root):
+    if not os.path.isdir(root):
+        return []
+    return sorted(
+        os.path.join(root, file_name)
+        for file_name in os.listdir(root)
+        if file_name.endswith(SEGMENT_SUFFIX)
+    )
+
+
+def read_segment(segment_path):
+    """
+    Yields (key, timestamp, codec, offset, compressed) for every complete
+    record of a segment, in the order they were written.
+    """
+    with open(segment_path, "rb") as fp:
+        while True:
+            offset = fp.tell()
+            header = fp.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                return
+            key_len, codec, ts, data_len = RECORD_HEADER.unpack(header)
+            key = fp.read(key_len)
+            data = fp.read(data_len)
+            if len(data) < data_len:
+                # a record cut short by a crash
+                return
+            yield key.decode("utf-8"), ts, codec, offset, data
+
+
+class HtmlSegmentWriter:
+    """
+    Append case pages to rolling segment files instead of one file each.
+    Args
+    ----
+    root : str
+        Directory holding the segments and their sidecar indexes.
+    max_segment_bytes : int
+        Size after which the next record starts a new segment.
+
+    Each record is (key, timestamp, compressed html). Next to every segment a
+    JSON lines index gives the offset of each key for random access. Segment
+    names carry the host and pid, so several worker processes can write to the
+    same root.
+    """
+
+    def __init__(self, root, max_segment_bytes=DEFAULT_MAX_SEGMENT_BYTES):
+        self.root = root
+        self.max_segment_bytes = max_segment_bytes
+        self._lock = threading.Lock()
+        self._segment = None
+        self._index = None
+        self._sequence = 0
+        os.makedirs(root, exist_ok=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _roll(self):
+        self._close_segment()
+        self._sequence += 1
+        name = "{}-{}-{}-{:05d}".format(
+            time.strftime("%Y%m%d%H%M%S"),
+            socket.gethostname(),
+            os.getpid(),
+            self._sequence,
+        )
+        self._segment = open(os.path.join(self.root, name + SEGMENT_SUFFIX), "ab")
+        self._index = open(os.path.join(self.root, name + INDEX_SUFFIX), "a")
+
+    def _close_segment(self):
+        if self._segment:
+            self._segment.close()
+            self._index.close()
+            self._segment = self._index = None
+
+    def put(self, key, html):
+        codec, data = compress(html.encode("utf-8"))
+        encoded_key = key.encode("utf-8")
+        ts = time.time()
+        with self._lock:
+            if self._segment is None or self._segment.tell() >= self.max_segment_bytes:
+                self._roll()
+            offset = self._segment.tell()
+            self._segment.write(
+                RECORD_HEADER.pack(len(encoded_key), codec, ts, len(data))
+            )
+            self._segment.write(encoded_key)
+            self._segment.write(data)
+            self._segment.flush()
+            self._index.write(
+                json.dumps(
+                    {
+                        "key": key,
+                        "ts": ts,
+                        "offset": offset,
+                        "codec": codec,
+                        "length": len(data),
+                    }
+                )
+                + "\n"
+            )
+            self._index.flush()
+
+    def close(self):
+        with self._lock:
+            self._close_segment()
+
+
+class HtmlSegmentReader:
+    """
+    Random access to the pages of a segment store by key.
+    The sidecar indexes are loaded once; when a key was written more than once
+    the latest record wins. A segment whose index is missing is scanned
+    instead.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self._index = {}
+        for segment_path in get_segment_paths(root):
+            index_path = segment_path[: -len(SEGMENT_SUFFIX)] + INDEX_SUFFIX
+            for key, ts, codec, offset, length in self._read_index(
+                segment_path, index_path
+            ):
+                current = self._index.get(key)
+                if current is None or current[1] <= ts:
+                    self._index[key] = (segment_path, ts, codec, offset, length)
+
+    def _read_index(self, segment_path, index_path):
+        if not os.path.exists(index_path):
+            logger.warning(f"{index_path} is missing, scanning its segment")
+            for key, ts, codec, offset, data in read_segment(segment_path):
+                yield key, ts, codec, offset, len(data)
+            return
+        with open(index_path) as fp:
+            for line in fp:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # last line of an index cut short by a crash
+                    continue
+                yield (
+                    entry["key"],
+                    entry["ts"],
+                    entry["codec"],
+                    entry["offset"],
+                    entry["length"],
+                )
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def keys(self):
+        return self._index.keys()
+
+    def get(self, key):
+        entry = self._index.get(key)
+        if entry is None:
+            return None
+        segment_path, _, codec, offset, length = entry
+        with open(segment_path, "rb") as fp:
+            fp.seek(offset)
+            key_len = RECORD_HEADER.unpack(fp.read(RECORD_HEADER.size))[0]
+            fp.seek(key_len, os.SEEK_CUR)
+            return decompress(codec, fp.read(length)).decode("utf-8")
+
+    def iter_pages(self):
+        """
+        Yields (key, timestamp, html) of every page, reading the segments
+        sequentially, the cheap way to process them all.
+        """
+        for segment_path in get_segment_paths(self.root):
+            for key, ts, codec, offset, data in read_segment(segment_path):
+                entry = self._index.get(key)
+                # skip records overwritten by a later put of the same key
+                if entry and entry[0] == segment_path and entry[3] == offset:
+                    yield key, ts, decompress(codec, data).decode("utf-8")
+
+
+def get_html_key(data_dir, file_path):
+    # the path the page has, or would have, in the raw_html tree
+    return os.path.relpath(file_path, data_dir).replace(os.sep, "/")
+
+
+def convert_tree(data_dir, root, delete=False):
+    """
+    Append every page under data_dir/<year>/raw_html to the segment store.
+    """
+    converted = 0
+    with HtmlSegmentWriter(root) as writer:
+        for year in sorted(os.listdir(data_dir)):
+            raw_html_dir = os.path.join(data_dir, year, "raw_html")
+            if not os.path.isdir(raw_html_dir):
+                continue
+            for dir_path, _, file_names in os.walk(raw_html_dir):
+                for file_name in file_names:
+                    if not file_name.endswith(".txt"):
+                        continue
+                    file_path = os.path.join(dir_path, file_name)
+                    with open(file_path) as fp:
+                        writer.put(get_html_key(data_dir, file_path), fp.read())
+                    if delete:
+                        os.remove(file_path)
+                    converted += 1
+                    if converted % 10000 == 0:
+                        logger.info(f"{converted} pages converted")
+    logger.info(f"{converted} pages converted into {root}")
+    return converted
+
+
+if __name__ == "__main__":
+    data_dir = os.path.join(os.path.realpath(os.path.dirname(__file__)), "data")
+    parser = argparse.ArgumentParser(
+        description="Convert raw_html trees into compressed segments and read them back"
+    )
+    parser.add_argument("command", choices=["convert", "get", "ls"])
+    parser.add_argument("key", nargs="?", help="page to print with get")
+    parser.add_argument("--data-dir", dest="data_dir", default=data_dir)
+    parser.add_argument(
+        "--root", dest="root", default=os.path.join(data_dir, HTML_SEGMENTS_DIRNAME)
+    )
+    parser.add_argument(
+        "--delete",
+        dest="delete",
+        action="store_true",
+        help="remove the .txt files once converted",
+    )
+    args = parser.parse_args()
+
+    if args.command == "convert":
+        convert_tree(args.data_dir, args.root, args.delete)
+    elif args.command == "get":
+        if not args.key:
+            parser.error("get needs a key")
+        print(HtmlSegmentReader(args.root).get(args.key))
+    else:
+        for key in sorted(HtmlSegmentReader(args.root).keys()):
+            print(key)
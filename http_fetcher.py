@@ -0,0 +1,160 @@
+import hashlib
+import requests
+from urllib.parse import urljoin
+
+from bs4 import BeautifulSoup
+
+from utils import logger
+
+
+class DetailFetchError(Exception):
+    pass
+
+
+class CaseDetailPage:
+    def __init__(self, html, case_fields, download_links):
+        self.html = html
+        self.case_fields = case_fields
+        self.download_links = download_links
+
+    @property
+    def expediente(self):
+        return self.case_fields[0] if self.case_fields else None
+
+
+def get_element_text(tag):
+    return " ".join(tag.get_text(" ").split())
+
+
+def session_from_driver(driver):
+    """
+    Build a requests session that shares the browser's server session.
+    The CEJ session (and therefore the solved captcha) lives in the cookies,
+    so once they are copied over every detail form can be posted directly.
+    """
+    session = requests.Session()
+    session.headers["User-Agent"] = driver.execute_script("return navigator.userAgent;")
+    session.headers["Referer"] = driver.current_url
+    for cookie in driver.get_cookies():
+        session.cookies.set(
+            cookie["name"],
+            cookie["value"],
+            domain=cookie.get("domain"),
+            path=cookie.get("path", "/"),
+        )
+    return session
+
+
+def parse_result_forms(page_source, base_url):
+    # same forms the browser path clicks: //div[@class="celdCentro"]/form/button
+    soup = BeautifulSoup(page_source, "html.parser")
+    forms = []
+    for cell in soup.find_all("div", attrs={"class": "celdCentro"}):
+        for form in cell.find_all("form", recursive=False):
+            button = form.find("button", recursive=False)
+            if button is None:
+                continue
+            data = {}
+            for field in form.find_all("input"):
+                if field.get("name"):
+                    data[field["name"]] = field.get("value", "")
+            if button.get("name"):
+                data[button["name"]] = button.get("value", "")
+            forms.append(
+                {
+                    "action": urljoin(base_url, form.get("action") or base_url),
+                    "method": (form.get("method") or "post").lower(),
+                    "data": data,
+                }
+            )
+    return forms
+
+
+def get_result_fingerprints(page_source):
+    """
+    One short hash per case of a results page, of the summary the site shows
+    for it, so a later search can tell which cases changed without opening
+    their detail pages.
+    """
+    soup = BeautifulSoup(page_source, "html.parser")
+    fingerprints = []
+    for cell in soup.find_all("div", attrs={"class": "celdCentro"}):
+        if cell.find("form", recursive=False) is None:
+            continue
+        summary = get_element_text(cell.parent or cell)
+        fingerprints.append(hashlib.sha1(summary.encode("utf-8")).hexdigest()[:16])
+    return fingerprints
+
+
+def parse_detail_page(html, base_url):
+    soup = BeautifulSoup(html, "html.parser")
+    if soup.find("div", attrs={"class": "partes"}) is None:
+        raise DetailFetchError("detail page has no partes section")
+
+    case_fields = [
+        get_element_text(tag)
+        for tag in soup.find_all("div", attrs={"class": "celdaGrid celdaGridXe"})
+    ]
+    if not case_fields:
+        raise DetailFetchError("detail page has no celdaGrid celdaGridXe fields")
+
+    download_links = []
+    if soup.find("div", attrs={"class": "panel panel-default divResolPar"}):
+        download_links = [
+            urljoin(base_url, a["href"])
+            for a in soup.find_all("a", class_="aDescarg")
+            if a.get("href")
+        ]
+    return CaseDetailPage(html, case_fields, download_links)
+
+
+class CaseDetailFetcher:
+    """
+    Fetch every case detail page of a results page over plain HTTP.
+    Args
+    ----
+    timeout : int
+        Seconds to wait for each detail request.
+
+    Raises DetailFetchError whenever the HTTP path cannot be trusted, so the
+    caller can fall back to clicking through the pages with Selenium.
+    """
+
+    def __init__(self, timeout=30):
+        self.timeout = timeout
+
+    def fetch_all(self, driver, indexes=None):
+        # indexes limits the fetch to some of the results, in page order
+        forms = parse_result_forms(driver.page_source, driver.current_url)
+        if indexes is not None:
+            forms = [form for index, form in enumerate(forms) if index in indexes]
+        if not forms:
+            return []
+
+        session = session_from_driver(driver)
+        pages = []
+        try:
+            for index, form in enumerate(forms):
+                pages.append(self.fetch_detail(session, form))
+                logger.info(f"{index} detail page fetched over http")
+        finally:
+            session.close()
+        return pages
+
+    def fetch_detail(self, session, form):
+        try:
+            if form["method"] == "get":
+                res = session.get(
+                    form["action"], params=form["data"], timeout=self.timeout
+                )
+            else:
+                res = session.post(
+                    form["action"], data=form["data"], timeout=self.timeout
+                )
+            res.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            raise DetailFetchError(e)
+
+        if "charset" not in res.headers.get("Content-Type", ""):
+            res.encoding = res.apparent_encoding
+        return parse_detail_page(res.text, res.url)
@@ -0,0 +1,285 @@
+import collections
+import http.server
+import json
+import math
+import os
+import threading
+import time
+
+from dotenv import load_dotenv
+
+from utils import logger
+
+load_dotenv()
+
+# append span events and periodic summaries to this JSON lines file
+METRICS_PATH = os.getenv("METRICS_PATH")
+# serve Prometheus text format on this port
+METRICS_PORT = int(os.getenv("METRICS_PORT", 0))
+METRICS_INTERVAL = int(os.getenv("METRICS_INTERVAL", 10))
+# durations kept per stage for the percentiles
+MAX_SAMPLES = 10000
+
+STATUS_OK = "ok"
+STATUS_FAILED = "failed"
+
+
+def percentile(values, q):
+    # nearest-rank percentile, q in [0, 100]
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, math.ceil(q / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+class StageStats:
+    def __init__(self):
+        self.count = 0
+        self.failures = 0
+        self.total = 0.0
+        self.samples = collections.deque(maxlen=MAX_SAMPLES)
+
+    def add(self, duration, status):
+        self.count += 1
+        self.total += duration
+        self.samples.append(duration)
+        if status == STATUS_FAILED:
+            self.failures += 1
+
+    def summary(self):
+        samples = list(self.samples)
+        return {
+            "count": self.count,
+            "failures": self.failures,
+            "total": round(self.total, 3),
+            "p50": percentile(samples, 50),
+            "p95": percentile(samples, 95),
+        }
+
+
+class Metrics:
+    """
+    Timing spans per scraping stage and plain counters.
+    Args
+    ----
+    path : str, defaults to None
+        JSON lines file receiving every span with its labels, and a summary
+        of all stages every interval seconds.
+    port : int, defaults to 0
+        When set, a /metrics endpoint in Prometheus text format.
+    interval : int
+        Seconds between two writes to path.
+
+    Spans carry labels such as year, combo and file_num in the JSON lines
+    file; the Prometheus endpoint aggregates by stage only.
+    """
+
+    def __init__(self, path=None, port=0, interval=METRICS_INTERVAL):
+        self.path = path
+        self.interval = interval
+        self.started = time.time()
+        self._lock = threading.Lock()
+        self._stages = collections.defaultdict(StageStats)
+        self._counters = collections.Counter()
+        self._events = []
+        self._closed = threading.Event()
+        self._server = None
+        if path:
+            parent_dir = os.path.dirname(path)
+            if parent_dir:
+                os.makedirs(parent_dir, exist_ok=True)
+            threading.Thread(
+                target=self._write_periodically, name="metrics-writer", daemon=True
+            ).start()
+        if port:
+            try:
+                self._server = http.server.ThreadingHTTPServer(
+                    ("", port), self._get_handler()
+                )
+            except OSError as e:
+                # e.g. worker processes started by a coordinator on the same host
+                logger.warning(f"metrics endpoint not started on :{port}: {e}")
+                return
+            threading.Thread(
+                target=self._server.serve_forever, name="metrics-http", daemon=True
+            ).start()
+            logger.info(f"metrics served on :{port}/metrics")
+
+    def observe(self, stage, duration, status=STATUS_OK, **labels):
+        with self._lock:
+            self._stages[stage].add(duration, status)
+            if self.path:
+                self._events.append(
+                    {
+                        "ts": time.time(),
+                        "stage": stage,
+                        "duration": round(duration, 4),
+                        "status": status,
+                        **labels,
+                    }
+                )
+
+    def incr(self, name, value=1):
+        with self._lock:
+            self._counters[name] += value
+
+    def span(self, stage, **labels):
+        return Span(self, stage, labels)
+
+    def stages(self, **labels):
+        return StageTimer(self, labels)
+
+    def get_summary(self):
+        with self._lock:
+            return {
+                "uptime": round(time.time() - self.started, 1),
+                "stages": {
+                    stage: stats.summary() for stage, stats in self._stages.items()
+                },
+                "counters": dict(self._counters),
+            }
+
+    def to_prometheus(self):
+        summary = self.get_summary()
+        lines = [
+            "# TYPE scraper_stage_seconds summary",
+            "# TYPE scraper_stage_failures_total counter",
+        ]
+        for stage, stats in sorted(summary["stages"].items()):
+            for quantile, key in (("0.5", "p50"), ("0.95", "p95")):
+                if stats[key] is not None:
+                    lines.append(
+                        f'scraper_stage_seconds{{stage="{stage}",'
+                        f'quantile="{quantile}"}} {stats[key]:.4f}'
+                    )
+            lines.append(
+                f'scraper_stage_seconds_sum{{stage="{stage}"}} {stats["total"]}'
+            )
+            lines.append(
+                f'scraper_stage_seconds_count{{stage="{stage}"}} {stats["count"]}'
+            )
+            lines.append(
+                f'scraper_stage_failures_total{{stage="{stage}"}} {stats["failures"]}'
+            )
+        for name, value in sorted(summary["counters"].items()):
+            lines.append(f"# TYPE scraper_{name}_total counter")
+            lines.append(f"scraper_{name}_total {value}")
+        return "\n".join(lines) + "\n"
+
+    def _get_handler(self):
+        metrics = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.to_prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def write(self):
+        with self._lock:
+            events, self._events = self._events, []
+        summary = self.get_summary()
+        with open(self.path, "a") as fp:
+            for event in events:
+                fp.write(json.dumps(event) + "\n")
+            fp.write(json.dumps({"ts": time.time(), "summary": summary}) + "\n")
+
+    def _write_periodically(self):
+        while not self._closed.wait(self.interval):
+            self.write()
+
+    def close(self):
+        self._closed.set()
+        if self.path:
+            self.write()
+        if self._server:
+            self._server.shutdown()
+        summary = self.get_summary()
+        if not summary["stages"]:
+            return
+        logger.info("stage               count  failed      p50      p95    total")
+        for stage, stats in sorted(
+            summary["stages"].items(), key=lambda item: -item[1]["total"]
+        ):
+            logger.info(
+                f"{stage:<18} {stats['count']:>6} {stats['failures']:>7} "
+                f"{stats['p50']:>8.2f} {stats['p95']:>8.2f} {stats['total']:>8.0f}"
+            )
+        if summary["counters"]:
+            logger.info(f"counters: {summary['counters']}")
+
+
+class Span:
+    # times a block, failed when it raises
+    def __init__(self, metrics, stage, labels):
+        self.metrics = metrics
+        self.stage = stage
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.metrics.observe(
+            self.stage,
+            time.time() - self.started,
+            STATUS_FAILED if exc_type else STATUS_OK,
+            **self.labels,
+        )
+
+
+class StageTimer:
+    """
+    Times consecutive stages of one sequence of steps: starting a stage ends
+    the previous one as a success, fail ends the current one as a failure.
+    """
+
+    def __init__(self, metrics, labels):
+        self.metrics = metrics
+        self.labels = labels
+        self.stage = None
+        self.started = None
+
+    def start(self, stage):
+        self.finish()
+        self.stage = stage
+        self.started = time.time()
+
+    def _end(self, status):
+        if self.stage is not None:
+            self.metrics.observe(
+                self.stage, time.time() - self.started, status, **self.labels
+            )
+            self.stage = None
+
+    def finish(self):
+        self._end(STATUS_OK)
+
+    def fail(self):
+        self._end(STATUS_FAILED)
+
+
+_metrics = None
+_metrics_lock = threading.Lock()
+
+
+def get_metrics():
+    # shared by every module of the process, configured from the environment
+    global _metrics
+    with _metrics_lock:
+        if _metrics is None:
+            _metrics = Metrics(METRICS_PATH, METRICS_PORT)
+    return _metrics
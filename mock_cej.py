@@ -0,0 +1,566 @@
+import argparse
+import base64
+import hashlib
+import html
+import http.cookies
+import http.server
+import io
+import json
+import random
+import string
+import threading
+import time
+import uuid
+from urllib.parse import parse_qs, urlparse
+
+from PIL import Image, ImageDraw
+
+from constants import list_all_comb
+from utils import logger
+
+PLACEHOLDER_TEXT = "--SELECCIONAR"
+SESSION_COOKIE = "JSESSIONID"
+
+CAPTCHA_CHARSET = string.ascii_lowercase + string.digits
+CAPTCHA_LENGTH = 4
+CAPTCHA_SIZE = (160, 60)
+# the answer is also painted as one grey block per character under the text,
+# so the mock solver can read it back from a browser screenshot
+CAPTCHA_GREY_STEP = 7
+CAPTCHA_BLOCKS_TOP = 40
+
+SEARCH_PAGE = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>CEJ mock</title></head>
+<body>
+<form id="busqueda" onsubmit="return false;">
+<select id="distritoJudicial"><option>{placeholder}</option>{districts}</select>
+<select id="anio"><option>{placeholder}</option>{years}</select>
+<select id="organoJurisdiccional"></select>
+<select id="especialidad"></select>
+<input id="numeroExpediente" type="text">
+<img id="captcha_image" src="/cej/Captcha.png?{now}" width="160" height="60">
+<button id="btnReload" type="button">Recargar</button>
+<input id="codigoCaptcha" type="text">
+<button id="consultarExpedientes" type="button">Consultar</button>
+</form>
+<div id="cargando" style="display:none">Cargando...</div>
+<div id="codCaptchaError" style="display:none">Código de captcha incorrecto</div>
+<div id="mensajeNoExisteExpedientes" style="display:none">No se encontraron expedientes</div>
+<div id="resultados"></div>
+<script>
+var COMBOS = {combos};
+var DELAY = {dropdown_delay_ms};
+var PLACEHOLDER = "{placeholder}";
+function byId(id) {{ return document.getElementById(id); }}
+function fill(select, options) {{
+  select.innerHTML = "<option>" + PLACEHOLDER + "</option>" +
+    options.map(function (o) {{ return "<option>" + o + "</option>"; }}).join("");
+}}
+byId("distritoJudicial").onchange = function () {{
+  var organos = Object.keys(COMBOS[this.value] || {{}});
+  setTimeout(function () {{ fill(byId("organoJurisdiccional"), organos); fill(byId("especialidad"), []); }}, DELAY);
+}};
+byId("organoJurisdiccional").onchange = function () {{
+  var especialidades = (COMBOS[byId("distritoJudicial").value] || {{}})[this.value] || [];
+  setTimeout(function () {{ fill(byId("especialidad"), especialidades); }}, DELAY);
+}};
+byId("btnReload").onclick = function () {{
+  byId("captcha_image").src = "/cej/Captcha.png?" + Date.now();
+  byId("codCaptchaError").style.display = "none";
+}};
+byId("consultarExpedientes").onclick = function () {{
+  byId("cargando").style.display = "block";
+  byId("mensajeNoExisteExpedientes").style.display = "none";
+  byId("codCaptchaError").style.display = "none";
+  var body = new URLSearchParams({{
+    distritoJudicial: byId("distritoJudicial").value,
+    anio: byId("anio").value,
+    organoJurisdiccional: byId("organoJurisdiccional").value,
+    especialidad: byId("especialidad").value,
+    numeroExpediente: byId("numeroExpediente").value,
+    codigoCaptcha: byId("codigoCaptcha").value
+  }});
+  fetch("/cej/forms/busquedaform.html", {{method: "POST", body: body}})
+    .then(function (res) {{ return res.json(); }})
+    .then(function (data) {{
+      if (data.status === "captcha") {{ byId("codCaptchaError").style.display = "block"; }}
+      else if (data.status === "empty") {{ byId("mensajeNoExisteExpedientes").style.display = "block"; }}
+      else {{ byId("resultados").innerHTML = data.html; }}
+    }})
+    .finally(function () {{ byId("cargando").style.display = "none"; }});
+}};
+</script>
+</body></html>
+"""
+
+RESULT_ROW = """<div class="divGLRE{parity}">
+<div class="divNroJuz"><b>{expediente}</b> {organo}</div>
+<div class="partesp">{partes}</div>
+<div class="celdCentro"><form action="/cej/forms/detalleform.html" method="post"><input type="hidden" name="nroRegistro" value="{token}"><button type="submit" title="Ver detalle de expediente">Ver</button></form></div>
+</div>"""
+
+DETAIL_PAGE = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>Detalle</title></head><body>
+<div id="gridRE">
+<div class="celdaGridN">Expediente N°:</div><div class="celdaGrid celdaGridXe"><b>{expediente}</b></div>
+<div class="celdaGridN">Órgano Jurisdiccional:</div><div class="celdaGrid">{organo}</div>
+<div class="celdaGridN">Distrito Judicial:</div><div class="celdaGrid">{distrito}</div>
+<div class="celdaGridN">Especialidad:</div><div class="celdaGrid">{especialidad}</div>
+<div class="celdaGridN">Fecha de Inicio:</div><div class="celdaGrid">{fecha}</div>
+<div class="celdaGridN">Estado:</div><div class="celdaGrid">{estado}</div>
+</div>
+<div class="panelGrupo">
+<div class="partes"><div>PARTE</div><div>TIPO DE PERSONA</div><div>APELLIDO PATERNO / RAZÓN SOCIAL</div><div>APELLIDO MATERNO</div><div>NOMBRES</div></div>
+{partes}
+</div>
+{resoluciones}
+</body></html>
+"""
+
+PARTE_ROW = '<div class="partes"><div>{parte}</div><div>NATURAL</div><div>{paterno}</div><div>{materno}</div><div>{nombres}</div></div>'
+
+RESOLUCION_PANEL = """<div class="panel panel-default {css}">
+<div class="row"><div class="celdaGridN">Fecha de Resolución:</div><div class="fleft">{fecha}</div></div>
+<div class="row"><div class="celdaGridN">Resolución:</div><div class="fleft">{numero}</div></div>
+<div class="row"><div class="celdaGridN">Acto:</div><div class="fleft">DECRETO</div></div>
+<div class="row"><div class="celdaGridN">Fojas:</div><div class="fleft">{fojas}</div></div>
+<a class="aDescarg" href="/cej/forms/documentoD.html?nid={nid}">Descargar</a>
+</div>"""
+
+NAMES = ["PEREZ", "GOMEZ", "QUISPE", "MAMANI", "FLORES", "TORRES", "RAMOS", "DIAZ"]
+
+
+def encode_token(*parts):
+    raw = "|".join(str(part) for part in parts).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii")
+
+
+def decode_token(token):
+    return base64.urlsafe_b64decode(token.encode("ascii")).decode("utf-8").split("|")
+
+
+def get_rng(*parts):
+    seed = hashlib.sha1("|".join(str(part) for part in parts).encode()).hexdigest()
+    return random.Random(seed)
+
+
+def render_captcha(text):
+    image = Image.new("RGB", CAPTCHA_SIZE, "white")
+    draw = ImageDraw.Draw(image)
+    draw.text((20, 12), " ".join(text), fill="black")
+    block_width = CAPTCHA_SIZE[0] // CAPTCHA_LENGTH
+    for index, char in enumerate(text):
+        grey = CAPTCHA_CHARSET.index(char) * CAPTCHA_GREY_STEP
+        draw.rectangle(
+            [
+                index * block_width,
+                CAPTCHA_BLOCKS_TOP,
+                (index + 1) * block_width - 1,
+                CAPTCHA_SIZE[1] - 1,
+            ],
+            fill=(grey, grey, grey),
+        )
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def read_captcha(image_bytes):
+    # inverse of render_captcha, also works on a scaled screenshot of it
+    image = Image.open(io.BytesIO(image_bytes)).convert("L")
+    width, height = image.size
+    y = int(height * (CAPTCHA_BLOCKS_TOP + CAPTCHA_SIZE[1]) / 2 / CAPTCHA_SIZE[1])
+    text = []
+    for index in range(CAPTCHA_LENGTH):
+        x = int((index + 0.5) * width / CAPTCHA_LENGTH)
+        char_index = round(image.getpixel((x, y)) / CAPTCHA_GREY_STEP)
+        if char_index >= len(CAPTCHA_CHARSET):
+            return None
+        text.append(CAPTCHA_CHARSET[char_index])
+    return "".join(text)
+
+
+class MockCej:
+    """
+    Fake cej.pj.gob.pe data, generated deterministically from the search.
+    Args
+    ----
+    file_nums : int
+        File numbers with results in every combo and year, from 1.
+    max_cases : int
+        Upper bound of cases behind one file number.
+    max_documents : int
+        Upper bound of downloadable resolutions of one case.
+    document_size : int
+        Bytes of every document.
+    """
+
+    def __init__(self, file_nums=10, max_cases=3, max_documents=3, document_size=50000):
+        self.file_nums = file_nums
+        self.max_cases = max_cases
+        self.max_documents = max_documents
+        self.document_size = document_size
+        self.combos = {}
+        for district, organo, especialidad in list_all_comb:
+            self.combos.setdefault(district, {}).setdefault(organo, []).append(
+                especialidad
+            )
+
+    def get_cases(self, district, year, organo, especialidad, file_num):
+        if not 1 <= file_num <= self.file_nums:
+            return []
+        rng = get_rng(district, year, organo, especialidad, file_num)
+        code = int(hashlib.sha1(district.encode()).hexdigest(), 16) % 9000 + 1000
+        cases = []
+        for index in range(1, rng.randint(1, self.max_cases) + 1):
+            cases.append(
+                {
+                    "expediente": f"{file_num:05d}-{year}-0-{code}-JR-CI-{index:02d}",
+                    "token": encode_token(
+                        district, year, organo, especialidad, file_num, index
+                    ),
+                    "partes": [
+                        (rng.choice(NAMES), rng.choice(NAMES), rng.choice(NAMES))
+                        for _ in range(rng.randint(1, 3))
+                    ],
+                    "documents": rng.randint(0, self.max_documents),
+                }
+            )
+        return cases
+
+    def get_case(self, token):
+        district, year, organo, especialidad, file_num, index = decode_token(token)
+        cases = self.get_cases(district, year, organo, especialidad, int(file_num))
+        case = cases[int(index) - 1]
+        return district, organo, especialidad, year, case
+
+    def render_results(self, cases, organo):
+        return "\n".join(
+            RESULT_ROW.format(
+                parity=index % 2,
+                expediente=case["expediente"],
+                organo=html.escape(organo),
+                partes=", ".join(" ".join(parte) for parte in case["partes"]),
+                token=case["token"],
+            )
+            for index, case in enumerate(cases)
+        )
+
+    def render_detail(self, token):
+        district, organo, especialidad, year, case = self.get_case(token)
+        partes = "\n".join(
+            PARTE_ROW.format(
+                parte="DEMANDANTE" if index == 0 else "DEMANDADO",
+                paterno=paterno,
+                materno=materno,
+                nombres=nombres,
+            )
+            for index, (paterno, materno, nombres) in enumerate(case["partes"])
+        )
+        resoluciones = "\n".join(
+            RESOLUCION_PANEL.format(
+                css="divResolPar" if number % 2 else "divResolImpar",
+                fecha=f"{number:02d}/03/{year} 10:00",
+                numero=number,
+                fojas=number * 3,
+                nid=f"{token}.{number}",
+            )
+            for number in range(1, case["documents"] + 1)
+        )
+        return DETAIL_PAGE.format(
+            expediente=case["expediente"],
+            organo=html.escape(organo),
+            distrito=html.escape(district),
+            especialidad=html.escape(especialidad),
+            fecha=f"15/01/{year}",
+            estado="EN TRAMITE",
+            partes=partes,
+            resoluciones=resoluciones,
+        )
+
+    def render_document(self, nid):
+        rng = get_rng(nid)
+        header = b"%PDF-1.4\n% mock resolution " + nid.encode("ascii") + b"\n"
+        body = bytes(rng.getrandbits(8) for _ in range(self.document_size))
+        return header + body + b"\n%%EOF\n"
+
+
+class MockCejServer(http.server.ThreadingHTTPServer):
+    """
+    HTTP server playing busquedaform.html, resumenform.html, the detail pages,
+    captchas and document downloads.
+    Args
+    ----
+    address : tuple
+        (host, port) to listen on, port 0 picks a free one.
+    cej : MockCej
+        The fake data.
+    latency : float
+        Mean seconds added to every response, uniformly from half to 1.5x.
+    error_rate : float
+        Share of search, detail and document requests answered with a 500.
+    captcha_error_rate : float
+        Share of correct captcha answers rejected anyway.
+    captcha_uses : int
+        Searches one solved captcha allows in its session, 0 for no limit.
+    dropdown_delay : float
+        Seconds each dropdown takes to fill after the previous one changes.
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        address,
+        cej,
+        latency=0.0,
+        error_rate=0.0,
+        captcha_error_rate=0.0,
+        captcha_uses=1,
+        dropdown_delay=0.2,
+    ):
+        super().__init__(address, MockCejHandler)
+        self.cej = cej
+        self.latency = latency
+        self.error_rate = error_rate
+        self.captcha_error_rate = captcha_error_rate
+        self.captcha_uses = captcha_uses
+        self.dropdown_delay = dropdown_delay
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self.stats = {"searches": 0, "details": 0, "documents": 0, "errors": 0}
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def count(self, key):
+        with self.lock:
+            self.stats[key] += 1
+
+
+class MockCejHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def get_session(self):
+        cookie = http.cookies.SimpleCookie(self.headers.get("Cookie", ""))
+        session_id = cookie[SESSION_COOKIE].value if SESSION_COOKIE in cookie else None
+        with self.server.lock:
+            if session_id not in self.server.sessions:
+                session_id = uuid.uuid4().hex
+                self.server.sessions[session_id] = {
+                    "captcha": None,
+                    "searches_left": 0,
+                    "results": "",
+                }
+            return session_id, self.server.sessions[session_id]
+
+    def send(self, status, body, content_type, session_id=None, headers=None):
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        if session_id:
+            self.send_header("Set-Cookie", f"{SESSION_COOKIE}={session_id}; Path=/")
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def wait_and_fail(self):
+        # simulated server latency, then True if this request gets an error
+        if self.server.latency:
+            time.sleep(self.server.latency * random.uniform(0.5, 1.5))
+        if random.random() < self.server.error_rate:
+            self.server.count("errors")
+            self.send(500, "Internal Server Error", "text/plain")
+            return True
+        return False
+
+    def read_form(self):
+        length = int(self.headers.get("Content-Length", 0))
+        data = parse_qs(self.rfile.read(length).decode("utf-8"))
+        return {key: values[0] for key, values in data.items()}
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        session_id, session = self.get_session()
+        cej = self.server.cej
+
+        if url.path == "/cej/forms/busquedaform.html":
+            page = SEARCH_PAGE.format(
+                placeholder=PLACEHOLDER_TEXT,
+                districts="".join(
+                    f"<option>{html.escape(d)}</option>" for d in sorted(cej.combos)
+                ),
+                years="".join(
+                    f"<option>{y}</option>"
+                    for y in range(time.localtime().tm_year, 2004, -1)
+                ),
+                combos=json.dumps(cej.combos),
+                dropdown_delay_ms=int(self.server.dropdown_delay * 1000),
+                now=time.time(),
+            )
+            self.send(200, page, "text/html; charset=utf-8", session_id)
+        elif url.path == "/cej/forms/resumenform.html":
+            if self.wait_and_fail():
+                return
+            page = f"<html><body><div id='resultados'>{session['results']}</div></body></html>"
+            self.send(200, page, "text/html; charset=utf-8", session_id)
+        elif url.path == "/cej/Captcha.png":
+            session["captcha"] = "".join(
+                random.choice(CAPTCHA_CHARSET) for _ in range(CAPTCHA_LENGTH)
+            )
+            self.send(200, render_captcha(session["captcha"]), "image/png", session_id)
+        elif url.path == "/cej/forms/documentoD.html":
+            if self.wait_and_fail():
+                return
+            nid = parse_qs(url.query).get("nid", [""])[0]
+            self.server.count("documents")
+            number = nid.rsplit(".", 1)[-1]
+            self.send(
+                200,
+                cej.render_document(nid),
+                "application/octet-stream",
+                session_id,
+                {
+                    "Content-Disposition": f'attachment; filename="resolucion_{number}.pdf"'
+                },
+            )
+        else:
+            self.send(404, "Not Found", "text/plain")
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        session_id, session = self.get_session()
+        form = self.read_form()
+        cej = self.server.cej
+
+        if url.path == "/cej/forms/busquedaform.html":
+            if self.wait_and_fail():
+                return
+            self.server.count("searches")
+            answer = form.get("codigoCaptcha", "").strip().lower()
+            if session["searches_left"] > 0:
+                session["searches_left"] -= 1
+            elif (
+                session["captcha"]
+                and answer == session["captcha"]
+                and random.random() >= self.server.captcha_error_rate
+            ):
+                # a solved captcha is spent, or good for captcha_uses searches
+                session["captcha"] = None
+                session["searches_left"] = (
+                    self.server.captcha_uses - 1
+                    if self.server.captcha_uses
+                    else float("inf")
+                )
+            else:
+                self.send(200, json.dumps({"status": "captcha"}), "application/json")
+                return
+            try:
+                file_num = int(form.get("numeroExpediente", ""))
+            except ValueError:
+                file_num = 0
+            cases = cej.get_cases(
+                form.get("distritoJudicial"),
+                form.get("anio"),
+                form.get("organoJurisdiccional"),
+                form.get("especialidad"),
+                file_num,
+            )
+            if not cases:
+                self.send(200, json.dumps({"status": "empty"}), "application/json")
+                return
+            session["results"] = cej.render_results(
+                cases, form.get("organoJurisdiccional")
+            )
+            self.send(
+                200,
+                json.dumps({"status": "ok", "html": session["results"]}),
+                "application/json",
+            )
+        elif url.path == "/cej/forms/detalleform.html":
+            if self.wait_and_fail():
+                return
+            self.server.count("details")
+            try:
+                page = cej.render_detail(form.get("nroRegistro", ""))
+            except (ValueError, IndexError):
+                self.send(404, "Not Found", "text/plain")
+                return
+            self.send(200, page, "text/html; charset=utf-8", session_id)
+        else:
+            self.send(404, "Not Found", "text/plain")
+
+
+def start_mock_server(host="127.0.0.1", port=0, **options):
+    """
+    Start a MockCejServer on a background thread and return it.
+    Options are those of MockCej and MockCejServer.
+    """
+    cej_options = {
+        key: options.pop(key)
+        for key in ("file_nums", "max_cases", "max_documents", "document_size")
+        if key in options
+    }
+    server = MockCejServer((host, port), MockCej(**cej_options), **options)
+    threading.Thread(target=server.serve_forever, name="mock-cej", daemon=True).start()
+    logger.info(f"mock CEJ serving on {server.base_url}")
+    return server
+
+
+def add_mock_arguments(parser):
+    parser.add_argument("--file-nums", dest="file_nums", type=int, default=10)
+    parser.add_argument("--max-cases", dest="max_cases", type=int, default=3)
+    parser.add_argument("--max-documents", dest="max_documents", type=int, default=3)
+    parser.add_argument("--latency", dest="latency", type=float, default=0.0)
+    parser.add_argument("--error-rate", dest="error_rate", type=float, default=0.0)
+    parser.add_argument(
+        "--captcha-error-rate", dest="captcha_error_rate", type=float, default=0.0
+    )
+    parser.add_argument(
+        "--captcha-uses",
+        dest="captcha_uses",
+        type=int,
+        default=1,
+        help="searches one solved captcha allows, 0 for no limit",
+    )
+    parser.add_argument(
+        "--dropdown-delay", dest="dropdown_delay", type=float, default=0.2
+    )
+
+
+def get_mock_options(args):
+    return {
+        "file_nums": args.file_nums,
+        "max_cases": args.max_cases,
+        "max_documents": args.max_documents,
+        "latency": args.latency,
+        "error_rate": args.error_rate,
+        "captcha_error_rate": args.captcha_error_rate,
+        "captcha_uses": args.captcha_uses,
+        "dropdown_delay": args.dropdown_delay,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Serve a local mock of cej.pj.gob.pe, use it with CEJ_BASE_URL and CAPTCHA_BACKEND=mock"
+    )
+    parser.add_argument("--host", dest="host", default="127.0.0.1")
+    parser.add_argument("--port", dest="port", type=int, default=8800)
+    add_mock_arguments(parser)
+    args = parser.parse_args()
+    server = start_mock_server(args.host, args.port, **get_mock_options(args))
+    try:
+        while True:
+            time.sleep(60)
+            logger.info(server.stats)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,152 @@
+import collections
+import os
+import threading
+import time
+
+from dotenv import load_dotenv
+
+from metrics import get_metrics
+from utils import logger
+
+load_dotenv()
+
+# 0 keeps every timeout at its base value, as before pacing existed
+ADAPTIVE_PACING = os.getenv("ADAPTIVE_PACING", "1") == "1"
+# page loads and searches answered faster than this bring the timeouts back down
+PACING_TARGET_LATENCY = float(os.getenv("PACING_TARGET_LATENCY", 3.0))
+PACING_MAX_FACTOR = float(os.getenv("PACING_MAX_FACTOR", 4.0))
+# seconds every worker pauses on a back off, times the pacing factor
+PACING_COOLDOWN = float(os.getenv("PACING_COOLDOWN", 10.0))
+# share of errors among the last PACING_WINDOW outcomes that triggers a back off
+PACING_ERROR_RATE = float(os.getenv("PACING_ERROR_RATE", 0.2))
+PACING_WINDOW = 20
+# outcomes needed in the window before its error rate counts
+MIN_OUTCOMES = 5
+LATENCY_SMOOTHING = 0.2
+SPEED_UP = 0.95
+SLOW_DOWN = 1.1
+BACK_OFF = 2.0
+
+ERROR_TIMEOUT = "timeout"
+ERROR_MAX_RETRIES = "max_retries"
+ERROR_CAPTCHA_RESET = "captcha_reset"
+ERROR_DETAIL_FETCH = "detail_fetch"
+
+
+class PacingController:
+    """
+    One pacing factor shared by every worker, applied to the base timeouts
+    of the scraper's waits. Waits end as soon as their condition holds, so
+    the factor never goes below 1: pacing only lengthens timeouts and pauses
+    every worker after a burst of errors.
+    Args
+    ----
+    target_latency : float
+        Seconds; while the smoothed response time stays under it and errors
+        are rare, the factor shrinks back towards 1 a little with every
+        response, and it grows when responses take more than twice as long.
+    max_factor : float
+        Upper bound of the factor.
+    cooldown : float
+        Seconds, times the factor, that every worker waits after a back off.
+    error_rate : float
+        Share of errors in the last window outcomes that doubles the factor
+        and starts a cooldown. Severe errors back off right away.
+    adaptive : bool
+        When False the factor stays at 1 and only the statistics are kept.
+    """
+
+    def __init__(
+        self,
+        target_latency=PACING_TARGET_LATENCY,
+        max_factor=PACING_MAX_FACTOR,
+        cooldown=PACING_COOLDOWN,
+        error_rate=PACING_ERROR_RATE,
+        window=PACING_WINDOW,
+        adaptive=ADAPTIVE_PACING,
+    ):
+        self.target_latency = target_latency
+        self.max_factor = max_factor
+        self.cooldown = cooldown
+        self.error_rate = error_rate
+        self.adaptive = adaptive
+        self.factor = 1.0
+        self.latency = None
+        self._outcomes = collections.deque(maxlen=window)
+        self._cooldown_until = 0.0
+        self._lock = threading.Lock()
+
+    def _get_error_rate(self):
+        if len(self._outcomes) < MIN_OUTCOMES:
+            return 0.0
+        return sum(self._outcomes) / len(self._outcomes)
+
+    def _set_factor(self, factor):
+        if self.adaptive:
+            self.factor = max(1.0, min(self.max_factor, factor))
+
+    def observe(self, duration):
+        # a successful response, taking duration seconds
+        with self._lock:
+            if self.latency is None:
+                self.latency = duration
+            else:
+                self.latency += LATENCY_SMOOTHING * (duration - self.latency)
+            self._outcomes.append(0)
+            if self.latency > 2 * self.target_latency:
+                self._set_factor(self.factor * SLOW_DOWN)
+            elif (
+                self.latency <= self.target_latency
+                and self._get_error_rate() < self.error_rate / 2
+            ):
+                self._set_factor(self.factor * SPEED_UP)
+
+    def record_error(self, kind, severe=False):
+        get_metrics().incr(f"pacing_{kind}")
+        with self._lock:
+            self._outcomes.append(1)
+            if severe or self._get_error_rate() >= self.error_rate:
+                self._back_off(kind)
+
+    def _back_off(self, kind):
+        if not self.adaptive:
+            # only the statistics are kept, workers are never paused
+            return
+        self._set_factor(self.factor * BACK_OFF)
+        pause = self.cooldown * self.factor
+        self._cooldown_until = max(self._cooldown_until, time.time() + pause)
+        # start a new window, one burst of errors is one back off
+        self._outcomes.clear()
+        logger.warning(
+            f"{kind} errors, pausing all workers for {pause:.0f}s, "
+            f"pacing factor now {self.factor:.2f}"
+        )
+
+    def timeout(self, base):
+        return base * self.factor
+
+    def wait_cooldown(self):
+        remaining = self._cooldown_until - time.time()
+        if remaining > 0:
+            time.sleep(remaining)
+
+    def get_summary(self):
+        with self._lock:
+            return {
+                "factor": round(self.factor, 3),
+                "latency": round(self.latency, 3) if self.latency else None,
+                "error_rate": round(self._get_error_rate(), 3),
+            }
+
+
+_pacer = None
+_pacer_lock = threading.Lock()
+
+
+def get_pacer():
+    # shared by every worker thread of the process
+    global _pacer
+    with _pacer_lock:
+        if _pacer is None:
+            _pacer = PacingController()
+    return _pacer
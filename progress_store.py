@@ -0,0 +1,482 @@
+import argparse
+import os
+import sqlite3
+import threading
+import time
+
+from utils import logger
+
+PROGRESS_DB_FILENAME = "progress.sqlite3"
+
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+
+FILE_NUM_MARKER = "_file_num_"
+MARKERS_IMPORTED_KEY = "markers_imported"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS file_progress (
+    year INTEGER NOT NULL,
+    combo TEXT NOT NULL,
+    file_num INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    error_class TEXT,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    fingerprint TEXT,
+    PRIMARY KEY (year, combo, file_num)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS combo_progress (
+    year INTEGER NOT NULL,
+    combo TEXT NOT NULL,
+    status TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (year, combo)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS year_progress (
+    year INTEGER PRIMARY KEY,
+    status TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS faulty_downloads (
+    key TEXT PRIMARY KEY,
+    error_class TEXT,
+    created_at REAL NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS combo_bounds (
+    year INTEGER NOT NULL,
+    combo TEXT NOT NULL,
+    last_file_num INTEGER NOT NULL,
+    probes INTEGER NOT NULL,
+    probed_at REAL NOT NULL,
+    PRIMARY KEY (year, combo)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+) WITHOUT ROWID;
+"""
+
+
+def get_combo_key(combo):
+    # same naming the old done markers used, e.g. LIMA_JUZGADO MIXTO_CIVIL
+    if isinstance(combo, str):
+        return combo
+    return "_".join(combo)
+
+
+class ProgressStore:
+    """
+    Scraping progress kept in a single SQLite database in WAL mode.
+    Args
+    ----
+    db_path : str
+        Path of the database file, created if it does not exist.
+    batch_size : int
+        Number of writes grouped in one commit.
+    max_delay : int
+        Seconds a write may wait for its batch before it is committed anyway.
+
+    One connection is shared by every thread of the process and guarded by a
+    lock. Reads go through the same connection, so they always see writes that
+    are still waiting for their batch to be committed.
+    """
+
+    def __init__(self, db_path, batch_size=20, max_delay=5):
+        self.db_path = db_path
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self._lock = threading.RLock()
+        self._pending = 0
+        self._closed = threading.Event()
+        self._conn = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+        self._migrate()
+        self._conn.commit()
+        self._flusher = threading.Thread(
+            target=self._flush_periodically, name="progress-flusher", daemon=True
+        )
+        self._flusher.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def _migrate(self):
+        # databases created before fingerprints were stored
+        columns = [
+            row[1] for row in self._conn.execute("PRAGMA table_info(file_progress)")
+        ]
+        if "fingerprint" not in columns:
+            self._conn.execute("ALTER TABLE file_progress ADD COLUMN fingerprint TEXT")
+
+    def close(self):
+        self._closed.set()
+        with self._lock:
+            self._conn.commit()
+            self._conn.close()
+
+    def flush(self):
+        with self._lock:
+            if self._pending:
+                self._conn.commit()
+                self._pending = 0
+
+    def _flush_periodically(self):
+        while not self._closed.wait(self.max_delay):
+            try:
+                self.flush()
+            except sqlite3.ProgrammingError:
+                # connection closed in between
+                break
+
+    def _write(self, sql, params=()):
+        with self._lock:
+            self._conn.execute(sql, params)
+            self._pending += 1
+            if self._pending >= self.batch_size:
+                self._conn.commit()
+                self._pending = 0
+
+    def _read(self, sql, params=()):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def get_meta(self, key):
+        rows = self._read("SELECT value FROM meta WHERE key = ?", (key,))
+        return rows[0][0] if rows else None
+
+    def set_meta(self, key, value):
+        self._write(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value)
+        )
+
+    def mark_file_num(
+        self, year, combo, file_num, status, error_class=None, fingerprint=None
+    ):
+        now = time.time()
+        self._write(
+            """
+            INSERT INTO file_progress
+                (year, combo, file_num, status, attempts, error_class, created_at, updated_at,
+                 fingerprint)
+            VALUES (?, ?, ?, ?, 1, ?, ?, ?, ?)
+            ON CONFLICT (year, combo, file_num) DO UPDATE SET
+                status = excluded.status,
+                attempts = file_progress.attempts + 1,
+                error_class = excluded.error_class,
+                updated_at = excluded.updated_at,
+                fingerprint = COALESCE(excluded.fingerprint, file_progress.fingerprint)
+            """,
+            (
+                int(year),
+                get_combo_key(combo),
+                int(file_num),
+                status,
+                error_class,
+                now,
+                now,
+                fingerprint,
+            ),
+        )
+
+    def get_file_num_status(self, year, combo, file_num):
+        rows = self._read(
+            "SELECT status FROM file_progress WHERE year = ? AND combo = ? AND file_num = ?",
+            (int(year), get_combo_key(combo), int(file_num)),
+        )
+        return rows[0][0] if rows else None
+
+    def get_fingerprint(self, year, combo, file_num):
+        # fingerprint of the results list the last time the file number was scraped
+        rows = self._read(
+            "SELECT fingerprint FROM file_progress WHERE year = ? AND combo = ? AND file_num = ?",
+            (int(year), get_combo_key(combo), int(file_num)),
+        )
+        return rows[0][0] if rows else None
+
+    def is_file_num_done(self, year, combo, file_num):
+        return self.get_file_num_status(year, combo, file_num) == STATUS_DONE
+
+    def completed_file_nums(self, year, combo=None):
+        # uses the primary key index, returns {combo_key: [file_num, ...]} in order
+        sql = "SELECT combo, file_num FROM file_progress WHERE year = ? AND status = ?"
+        params = [int(year), STATUS_DONE]
+        if combo is not None:
+            sql += " AND combo = ?"
+            params.append(get_combo_key(combo))
+        completed = {}
+        for combo_key, file_num in self._read(
+            sql + " ORDER BY combo, file_num", params
+        ):
+            completed.setdefault(combo_key, []).append(file_num)
+        return completed
+
+    def mark_combo_done(self, year, combo):
+        now = time.time()
+        self._write(
+            """
+            INSERT INTO combo_progress (year, combo, status, created_at, updated_at)
+            VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (year, combo) DO UPDATE SET
+                status = excluded.status, updated_at = excluded.updated_at
+            """,
+            (int(year), get_combo_key(combo), STATUS_DONE, now, now),
+        )
+
+    def is_combo_done(self, year, combo):
+        rows = self._read(
+            "SELECT status FROM combo_progress WHERE year = ? AND combo = ?",
+            (int(year), get_combo_key(combo)),
+        )
+        return bool(rows) and rows[0][0] == STATUS_DONE
+
+    def set_combo_bound(self, year, combo, last_file_num, probes):
+        # last populated file number found by probing, 0 for an empty combo
+        self._write(
+            """
+            INSERT OR REPLACE INTO combo_bounds (year, combo, last_file_num, probes, probed_at)
+            VALUES (?, ?, ?, ?, ?)
+            """,
+            (int(year), get_combo_key(combo), int(last_file_num), probes, time.time()),
+        )
+
+    def get_combo_bounds(self, year, max_age=None):
+        # {combo_key: last_file_num}, leaving out bounds probed more than max_age seconds ago
+        sql = "SELECT combo, last_file_num FROM combo_bounds WHERE year = ?"
+        params = [int(year)]
+        if max_age is not None:
+            sql += " AND probed_at >= ?"
+            params.append(time.time() - max_age)
+        return dict(self._read(sql, params))
+
+    def get_past_sizes(self, year):
+        """
+        {combo_key: highest done file number} of the latest other year each
+        combo was scraped to the end in, an estimate of its size in year.
+        """
+        sizes = {}
+        for combo_key, _, last_file_num in self._read(
+            """
+            SELECT f.combo, f.year, MAX(f.file_num)
+            FROM file_progress f JOIN combo_progress c
+                ON c.year = f.year AND c.combo = f.combo AND c.status = ?
+            WHERE f.year != ? AND f.status = ?
+            GROUP BY f.combo, f.year ORDER BY f.year
+            """,
+            (STATUS_DONE, int(year), STATUS_DONE),
+        ):
+            sizes[combo_key] = last_file_num
+        return sizes
+
+    def mark_year_done(self, year):
+        self._write(
+            "INSERT OR REPLACE INTO year_progress (year, status, updated_at) VALUES (?, ?, ?)",
+            (int(year), STATUS_DONE, time.time()),
+        )
+
+    def is_year_done(self, year):
+        rows = self._read(
+            "SELECT status FROM year_progress WHERE year = ?", (int(year),)
+        )
+        return bool(rows) and rows[0][0] == STATUS_DONE
+
+    def mark_faulty_download(self, key, error_class=None):
+        self._write(
+            "INSERT OR IGNORE INTO faulty_downloads (key, error_class, created_at) VALUES (?, ?, ?)",
+            (str(key), error_class, time.time()),
+        )
+
+    def is_faulty_download(self, key):
+        return bool(
+            self._read("SELECT 1 FROM faulty_downloads WHERE key = ?", (str(key),))
+        )
+
+    def import_marker_trees(self, final_data_folder, faulty_downloads_dir, force=False):
+        """
+        One-shot import of the touch-file markers written by older versions.
+        Args
+        ----
+        final_data_folder : str
+            The data folder holding <year>/done and <year>/raw_html/done/*.
+        faulty_downloads_dir : str
+            The folder holding the faulty_downloads/*.txt markers.
+        force : bool, defaults to False
+            Import again even if the markers were already imported.
+        """
+        if self.get_meta(MARKERS_IMPORTED_KEY) and not force:
+            return 0
+
+        now = time.time()
+        file_rows = []
+        combo_rows = []
+        year_rows = []
+        faulty_rows = []
+
+        if os.path.isdir(final_data_folder):
+            for year in os.listdir(final_data_folder):
+                if not year.isdigit():
+                    continue
+                if os.path.isfile(os.path.join(final_data_folder, year, "done")):
+                    year_rows.append((int(year), STATUS_DONE, now))
+
+                done_dir = os.path.join(final_data_folder, year, "raw_html", "done")
+                if not os.path.isdir(done_dir):
+                    continue
+                with os.scandir(done_dir) as entries:
+                    for entry in entries:
+                        combo_key, sep, file_num = entry.name.rpartition(
+                            FILE_NUM_MARKER
+                        )
+                        if sep and file_num.isdigit():
+                            file_rows.append(
+                                (
+                                    int(year),
+                                    combo_key,
+                                    int(file_num),
+                                    STATUS_DONE,
+                                    now,
+                                    now,
+                                )
+                            )
+                        else:
+                            combo_rows.append(
+                                (int(year), entry.name, STATUS_DONE, now, now)
+                            )
+
+        if os.path.isdir(faulty_downloads_dir):
+            with os.scandir(faulty_downloads_dir) as entries:
+                for entry in entries:
+                    if entry.name.endswith(".txt"):
+                        faulty_rows.append((entry.name[: -len(".txt")], None, now))
+
+        with self._lock:
+            self._conn.executemany(
+                """
+                INSERT OR IGNORE INTO file_progress
+                    (year, combo, file_num, status, attempts, created_at, updated_at)
+                VALUES (?, ?, ?, ?, 1, ?, ?)
+                """,
+                file_rows,
+            )
+            self._conn.executemany(
+                """
+                INSERT OR IGNORE INTO combo_progress
+                    (year, combo, status, created_at, updated_at)
+                VALUES (?, ?, ?, ?, ?)
+                """,
+                combo_rows,
+            )
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO year_progress (year, status, updated_at) VALUES (?, ?, ?)",
+                year_rows,
+            )
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO faulty_downloads (key, error_class, created_at) VALUES (?, ?, ?)",
+                faulty_rows,
+            )
+            self._conn.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                (MARKERS_IMPORTED_KEY, str(now)),
+            )
+            self._conn.commit()
+            self._pending = 0
+
+        imported = len(file_rows) + len(combo_rows) + len(year_rows) + len(faulty_rows)
+        logger.info(
+            f"imported {imported} markers: {len(file_rows)} file numbers, "
+            f"{len(combo_rows)} combos, {len(year_rows)} years, {len(faulty_rows)} faulty downloads"
+        )
+        return imported
+
+
+def to_ranges(file_nums):
+    # [1, 2, 3, 7, 8] -> [(1, 3), (7, 8)], file_nums must be sorted
+    ranges = []
+    for file_num in file_nums:
+        if ranges and file_num <= ranges[-1][1] + 1:
+            ranges[-1] = (ranges[-1][0], max(ranges[-1][1], file_num))
+        else:
+            ranges.append((file_num, file_num))
+    return ranges
+
+
+class ResumeIndex:
+    """
+    Completed file numbers of one year, as ranges per combo.
+    Args
+    ----
+    completed : dict
+        {combo_key: sorted completed file numbers}, as returned by
+        ProgressStore.completed_file_nums.
+
+    Built once at startup so workers can jump over completed file numbers
+    without asking the store about each of them.
+    """
+
+    def __init__(self, completed):
+        self._ranges = {}
+        self._skip_to = {}
+        for combo_key, file_nums in completed.items():
+            ranges = to_ranges(file_nums)
+            skip_to = {}
+            for start, end in ranges:
+                for file_num in range(start, end + 1):
+                    skip_to[file_num] = end + 1
+            self._ranges[combo_key] = ranges
+            self._skip_to[combo_key] = skip_to
+
+    @classmethod
+    def from_store(cls, store, year):
+        return cls(store.completed_file_nums(year))
+
+    def get_ranges(self, combo):
+        return self._ranges.get(get_combo_key(combo), [])
+
+    def get_gaps(self, combo):
+        # missing file numbers below the highest completed one
+        gaps = []
+        previous_end = 0
+        for start, end in self.get_ranges(combo):
+            if start > previous_end + 1:
+                gaps.append((previous_end + 1, start - 1))
+            previous_end = end
+        return gaps
+
+    def get_highest_completed(self, combo):
+        ranges = self.get_ranges(combo)
+        return ranges[-1][1] if ranges else 0
+
+    def next_missing(self, combo, file_num=1):
+        # first file number >= file_num that is not completed yet
+        skip_to = self._skip_to.get(get_combo_key(combo))
+        if not skip_to:
+            return file_num
+        return skip_to.get(file_num, file_num)
+
+
+if __name__ == "__main__":
+    base_dir = os.path.realpath(os.path.dirname(__file__))
+    parser = argparse.ArgumentParser(
+        description="Import the touch-file done markers into the progress database"
+    )
+    parser.add_argument(
+        "--data-dir", dest="data_dir", default=os.path.join(base_dir, "data")
+    )
+    parser.add_argument(
+        "--faulty-downloads-dir",
+        dest="faulty_downloads_dir",
+        default=os.path.join(base_dir, "faulty_downloads"),
+    )
+    parser.add_argument("--db", dest="db_path", default=None)
+    args = parser.parse_args()
+
+    db_path = args.db_path or os.path.join(args.data_dir, PROGRESS_DB_FILENAME)
+    with ProgressStore(db_path) as store:
+        store.import_marker_trees(args.data_dir, args.faulty_downloads_dir, force=True)
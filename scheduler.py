@@ -0,0 +1,368 @@
+import collections
+import datetime
+import fnmatch
+import heapq
+import itertools
+import threading
+import time
+
+from progress_store import get_combo_key
+from utils import logger
+
+Chunk = collections.namedtuple("Chunk", ["combo", "start", "end"])
+
+MAX_EMPTY_FILE_NUMS = 5
+MAX_FILE_NUM = 10**6
+
+
+def find_last_file_num(has_results, max_empty=MAX_EMPTY_FILE_NUMS, limit=MAX_FILE_NUM):
+    """
+    Find the last populated file number of a combo with few searches.
+    Args
+    ----
+    has_results : callable
+        Searches one file number, True when it has cases.
+    max_empty : int
+        Empty file numbers in a row after which the serial scraper stops, the
+        gaps shorter than that are stepped over.
+
+    Doubles the file number until a window of max_empty file numbers is
+    empty, then bisects between the last populated one and that window.
+    Returns (last file number, 0 for an empty combo; number of searches).
+    """
+    searched = {}
+
+    def search(file_num):
+        if file_num not in searched:
+            searched[file_num] = has_results(file_num)
+        return searched[file_num]
+
+    def first_populated(file_num):
+        for candidate in range(file_num, file_num + max_empty):
+            if search(candidate):
+                return candidate
+        return None
+
+    last = first_populated(1)
+    if last is None:
+        return 0, len(searched)
+    step = 1
+    upper = None
+    while upper is None and last + step <= limit:
+        found = first_populated(last + step)
+        if found is None:
+            upper = last + step
+        else:
+            last = found
+            step *= 2
+    if upper is None:
+        return last, len(searched)
+    # nothing populated in [upper, upper + max_empty), so found stays below upper
+    while upper - last > 1:
+        middle = (last + upper) // 2
+        found = first_populated(middle)
+        if found is None:
+            upper = middle
+        else:
+            last = found
+    return last, len(searched)
+
+
+def parse_priorities(spec):
+    """
+    Parse operator priorities like "LIMA=10,FAMILIA*=5,CALLAO" into
+    {pattern: weight}, a pattern without a weight has weight 1.
+    """
+    priorities = {}
+    for entry in (spec or "").split(","):
+        pattern, _, weight = entry.partition("=")
+        if not pattern.strip():
+            continue
+        try:
+            priorities[pattern.strip().upper()] = int(weight) if weight else 1
+        except ValueError:
+            raise ValueError(
+                f"priority of {pattern.strip()} is not an integer: {weight}"
+            )
+    return priorities
+
+
+def get_combo_priority(combo, priorities):
+    # highest weight among the patterns matching its district, court or specialty
+    return max(
+        (
+            weight
+            for pattern, weight in (priorities or {}).items()
+            if any(fnmatch.fnmatchcase(part.upper(), pattern) for part in combo)
+        ),
+        default=0,
+    )
+
+
+def estimate_sizes(combos, sizes):
+    """
+    {combo_key: estimated last file number} of every combo, from sizes
+    (probed bounds or earlier years), and the median of the known ones for
+    the others, 0 when none is known.
+    """
+    sizes = sizes or {}
+    known = sorted(sizes[key] for key in map(get_combo_key, combos) if key in sizes)
+    default = known[len(known) // 2] if known else 0
+    return {
+        get_combo_key(combo): sizes.get(get_combo_key(combo), default)
+        for combo in combos
+    }
+
+
+def order_combos(combos, sizes=None, priorities=None):
+    """
+    Operator priority first, then the longest estimated combos first, so the
+    big ones do not start last and stretch the tail of the run.
+    """
+    estimates = estimate_sizes(combos, sizes)
+    return sorted(
+        combos,
+        key=lambda combo: (
+            -get_combo_priority(combo, priorities),
+            -estimates[get_combo_key(combo)],
+        ),
+    )
+
+
+class ComboState:
+    """
+    Results of one combo's file numbers, possibly reported out of order.
+    The end of the combo is found by replaying them in file number order,
+    exactly like the serial loop in Scrapper.scrape_for_each_comb does: the
+    combo ends at the first "no more files" result, or at the file number
+    that brings the count of empty results to max_empty.
+    """
+
+    def __init__(
+        self,
+        combo,
+        first_file_num=1,
+        empty_num=0,
+        max_empty=MAX_EMPTY_FILE_NUMS,
+        priority=0,
+        size=0,
+    ):
+        self.combo = combo
+        self.max_empty = max_empty
+        self.priority = priority
+        self.size = size
+        self.next_start = first_file_num
+        self.end = None
+        self.in_flight = 0
+        self.queued = 0
+        self.completed_chunks = 0
+        self.reported = False
+        self.scan = first_file_num
+        self.empty_num = empty_num
+        self._results = {}
+
+    @property
+    def is_finished(self):
+        return self.end is not None
+
+    def record(self, file_num, is_empty, is_last):
+        self._results[file_num] = (is_empty, is_last)
+        while self.end is None and self.scan in self._results:
+            is_empty, is_last = self._results.pop(self.scan)
+            if is_empty:
+                self.empty_num += 1
+            if is_last or self.empty_num >= self.max_empty:
+                self.end = self.scan
+                self._results.clear()
+            self.scan += 1
+
+    def is_past_end(self, file_num):
+        return self.end is not None and file_num > self.end
+
+    def get_remaining(self, file_num):
+        # estimated file numbers from file_num to the end of the combo
+        return max(0, self.size - file_num + 1)
+
+
+class ChunkScheduler:
+    """
+    Hand out file number chunks of many combos to a pool of workers.
+    Args
+    ----
+    combos : list
+        The combos to scrape, ties in the order below keep this order.
+    chunk_size : int
+        Number of consecutive file numbers in one chunk.
+    max_chunks_per_combo : int
+        Upper bound of chunks of the same combo being scraped at once.
+    resume_index : ResumeIndex, defaults to None
+        Used to start every combo at its first missing file number.
+    on_combo_done : callable, defaults to None
+        Called with the combo once its end has been found.
+    bounds : dict, defaults to None
+        {combo_key: last populated file number} found by probing.
+    sizes : dict, defaults to None
+        {combo_key: estimated last file number}, e.g. from earlier years,
+        bounds take precedence.
+    priorities : dict, defaults to None
+        {pattern: weight} set by the operator, see parse_priorities.
+
+    Every combo starts with a single chunk. Each time one of its chunks
+    completes without finding the end, the combo is allowed one more chunk in
+    flight, so big combos spread over idle workers while small ones never
+    speculate past their last file number. A combo with a known bound gets
+    max_chunks_per_combo chunks at once up to that bound; its end is still
+    found from the results, the bound is only a hint, and it gives the ETA.
+
+    Queued chunks are handed out by operator priority, then by the estimated
+    file numbers left in their combo, largest first. Every chunk handed out
+    lowers its combo's estimate, so the biggest combos start right away and
+    interleave with the others instead of being left for the end.
+    """
+
+    def __init__(
+        self,
+        combos,
+        chunk_size,
+        max_chunks_per_combo,
+        resume_index=None,
+        on_combo_done=None,
+        bounds=None,
+        sizes=None,
+        priorities=None,
+    ):
+        self.chunk_size = chunk_size
+        self.max_chunks_per_combo = max_chunks_per_combo
+        self.on_combo_done = on_combo_done
+        self.bounds = bounds or {}
+        self.started = time.time()
+        self.recorded = 0
+        self._cond = threading.Condition()
+        self._queue = []
+        self._counter = itertools.count()
+        self._states = {}
+        estimates = estimate_sizes(combos, {**(sizes or {}), **self.bounds})
+        for combo in combos:
+            first_file_num = resume_index.next_missing(combo, 1) if resume_index else 1
+            state = ComboState(
+                combo,
+                first_file_num,
+                priority=get_combo_priority(combo, priorities),
+                size=estimates[get_combo_key(combo)],
+            )
+            self._states[get_combo_key(combo)] = state
+            self._enqueue(state)
+
+    def _push(self, state, chunk):
+        heapq.heappush(
+            self._queue,
+            (
+                -state.priority,
+                -state.get_remaining(chunk.start),
+                next(self._counter),
+                chunk,
+            ),
+        )
+        state.queued += 1
+
+    def _enqueue(self, state):
+        start = state.next_start
+        self._push(state, Chunk(state.combo, start, start + self.chunk_size - 1))
+        state.next_start += self.chunk_size
+
+    def _refill(self, state):
+        bound = self.bounds.get(get_combo_key(state.combo))
+        while not state.is_finished:
+            allowed = min(self.max_chunks_per_combo, state.completed_chunks + 1)
+            if bound is not None and state.next_start <= bound:
+                # the probed bound says this chunk is not speculative
+                allowed = self.max_chunks_per_combo
+            if state.in_flight + state.queued >= allowed:
+                break
+            self._enqueue(state)
+
+    def _has_work_left(self):
+        return any(
+            state.in_flight or not state.is_finished for state in self._states.values()
+        )
+
+    def next_chunk(self, should_stop=None, poll_interval=1):
+        # blocks while other workers may still open up more chunks, None when all is done
+        with self._cond:
+            while not (should_stop and should_stop()):
+                while self._queue:
+                    chunk = heapq.heappop(self._queue)[-1]
+                    state = self._states[get_combo_key(chunk.combo)]
+                    state.queued -= 1
+                    if state.is_past_end(chunk.start):
+                        continue
+                    state.in_flight += 1
+                    self._refill(state)
+                    return chunk
+                if not self._has_work_left():
+                    return None
+                self._cond.wait(poll_interval)
+            return None
+
+    def record(self, combo, file_num, is_empty, is_last, skipped=False):
+        # skipped: done by an earlier run, left out of the rate behind the ETA
+        with self._cond:
+            self._states[get_combo_key(combo)].record(file_num, is_empty, is_last)
+            if not skipped:
+                self.recorded += 1
+
+    def get_eta(self):
+        """
+        (file numbers left up to the bounds, seconds left at the rate so far),
+        None while a combo left has no bound or nothing was scraped yet.
+        """
+        with self._cond:
+            left = 0
+            for combo_key, state in self._states.items():
+                if state.is_finished:
+                    continue
+                if combo_key not in self.bounds:
+                    return None
+                left += max(0, self.bounds[combo_key] - state.scan + 1)
+            if not self.recorded:
+                return None
+            rate = self.recorded / (time.time() - self.started)
+            return left, left / rate
+
+    def is_past_end(self, combo, file_num):
+        with self._cond:
+            return self._states[get_combo_key(combo)].is_past_end(file_num)
+
+    def abandon_chunk(self, chunk, file_num):
+        """
+        Give back a chunk a worker could not finish, the file numbers from
+        file_num on are queued again for another worker.
+        """
+        with self._cond:
+            state = self._states[get_combo_key(chunk.combo)]
+            state.in_flight -= 1
+            if file_num <= chunk.end and not state.is_past_end(file_num):
+                self._push(state, Chunk(chunk.combo, file_num, chunk.end))
+            self._cond.notify_all()
+
+    def complete_chunk(self, chunk):
+        with self._cond:
+            state = self._states[get_combo_key(chunk.combo)]
+            state.in_flight -= 1
+            state.completed_chunks += 1
+            self._refill(state)
+            report = state.is_finished and not state.in_flight and not state.reported
+            if report:
+                state.reported = True
+            self._cond.notify_all()
+
+        if report:
+            logger.info(f"{chunk.combo} ends at file number {state.end}")
+            if self.on_combo_done:
+                self.on_combo_done(chunk.combo)
+        eta = self.get_eta()
+        if eta:
+            logger.info(
+                f"about {eta[0]} file numbers left, "
+                f"ETA {datetime.timedelta(seconds=round(eta[1]))}"
+            )
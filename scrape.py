@@ -1,8 +1,13 @@
 import argparse
 import datetime
+import json
 import os
 import shutil
 import signal
+import socket
+import subprocess
+import sys
+import threading
 import time
 import concurrent.futures
 from pathlib import Path
@@ -21,14 +26,69 @@ from selenium.webdriver.support import expected_conditions as EC
 from selenium.webdriver.support.ui import WebDriverWait, Select
 import urllib3
 
-from captcha_solver import azcaptcha_solver_post
+from captcha_service import CaptchaService
+from blob_store import BLOB_STORE_DIRNAME, BlobStore
+from captcha_dataset import CaptchaDataset
+from captcha_solver import get_captcha_solver
+from cej_metadata import (
+    DEFAULT_METADATA_TTL,
+    METADATA_FILENAME,
+    CejMetadata,
+    MetadataError,
+    crawl_combos,
+    crawl_metadata,
+    log_diff,
+)
 from constants import list_all_comb
+from download_pipeline import DownloadJob, DownloadPipeline
+from download_watcher import DownloadWatcher
+from html_store import HTML_SEGMENTS_DIRNAME, HtmlSegmentWriter, get_html_key
+from metrics import STATUS_FAILED as METRIC_FAILED
+from metrics import STATUS_OK as METRIC_OK
+from metrics import get_metrics
+from pacing import (
+    ERROR_CAPTCHA_RESET,
+    ERROR_DETAIL_FETCH,
+    ERROR_MAX_RETRIES,
+    ERROR_TIMEOUT,
+    get_pacer,
+)
+from http_fetcher import (
+    CaseDetailFetcher,
+    DetailFetchError,
+    get_result_fingerprints,
+)
+from progress_store import (
+    PROGRESS_DB_FILENAME,
+    STATUS_DONE,
+    STATUS_FAILED,
+    ProgressStore,
+    ResumeIndex,
+    get_combo_key,
+)
+from scheduler import (
+    ChunkScheduler,
+    find_last_file_num,
+    order_combos,
+    parse_priorities,
+)
+from work_queue import WORK_QUEUE_DB_FILENAME, LeaseHeartbeat, WorkQueue
+from waits import (
+    OUTCOME_CAPTCHA,
+    OUTCOME_NO_RESULTS,
+    clear_search_outcome,
+    no_results_displayed,
+    reload_captcha,
+    wait_for_detail_page,
+    wait_for_loader_hidden,
+    wait_for_results,
+    wait_for_search_outcome,
+)
 from utils import (
-    download_wait,
     is_element_present,
     kill_os_process,
-    setup_selenium_browser_driver,
-    kill_web_drivers,
+    is_driver_healthy,
+    WebDriverPool,
     clear_temp_folder,
     logger,
 )
@@ -36,9 +96,17 @@ from utils import (
 load_dotenv()
 
 
-LINK = "https://cej.pj.gob.pe/cej/forms/busquedaform.html"
+# point at a local mock_cej.py server to benchmark without touching the real site
+CEJ_BASE_URL = os.getenv("CEJ_BASE_URL", "https://cej.pj.gob.pe").rstrip("/")
+LINK = f"{CEJ_BASE_URL}/cej/forms/busquedaform.html"
+RESUMEN_LINK = f"{CEJ_BASE_URL}/cej/forms/resumenform.html"
 PLACEHOLDER_TEXT = "--SELECCIONAR"
 DONE_FLAG = "NO MORE FILES"
+# base timeouts in seconds, scaled by the pacing controller to the site's responsiveness
+WAIT_TIMEOUT = 10
+DOWNLOAD_TIMEOUT = 10
+# how long the search results may take to show up once the loader is gone
+RESULTS_TIMEOUT = 3
 
 default_temp_download_folder = os.path.join(
     os.path.realpath(os.path.dirname(__file__)), "temp_downloads"
@@ -47,7 +115,11 @@ default_temp_download_folder = os.path.join(
 faulty_downloads_dir = os.path.join(
     os.path.realpath(os.path.dirname(__file__)), "faulty_downloads"
 )
-final_data_folder = os.path.join(os.path.realpath(os.path.dirname(__file__)), "data")
+final_data_folder = os.getenv("DATA_DIR") or os.path.join(
+    os.path.realpath(os.path.dirname(__file__)), "data"
+)
+# case pages are staged here, on the same disk, before moving into raw_html
+partial_html_folder = os.path.join(final_data_folder, ".partial_html")
 
 if not os.path.exists(faulty_downloads_dir):
     p = Path(faulty_downloads_dir)
@@ -62,36 +134,276 @@ if not os.path.exists(final_data_folder):
     p.mkdir(parents=True)
 
 NUMBER_OF_WORKERS = int(os.getenv("NUMBER_OF_WORKERS", 5))
-drivers = []
-stop_threads = False
-threads = []
+# fetch case detail pages over http with the browser's session, selenium is the fallback
+USE_HTTP_DETAIL_FETCH = os.getenv("USE_HTTP_DETAIL_FETCH", "1") == "1"
+# hand document downloads to a thread pool instead of downloading them in the browser
+ASYNC_DOWNLOADS = os.getenv("ASYNC_DOWNLOADS", "1") == "1"
+DOWNLOAD_MAX_IN_FLIGHT = int(os.getenv("DOWNLOAD_MAX_IN_FLIGHT", 8))
+# keep each distinct document once in a content-addressed store and skip known hrefs
+DEDUPLICATE_DOWNLOADS = os.getenv("DEDUPLICATE_DOWNLOADS", "1") == "1"
+BLOB_STORE_PATH = os.getenv(
+    "BLOB_STORE_PATH", os.path.join(final_data_folder, BLOB_STORE_DIRNAME)
+)
+# split combos into chunks of file numbers shared by all workers, 0 scrapes one combo per worker
+DEFAULT_CHUNK_SIZE = 25
+CHUNK_SIZE = int(os.getenv("CHUNK_SIZE", DEFAULT_CHUNK_SIZE))
+# search the next file numbers on the same form while the server accepts the solved captcha
+REUSE_SEARCH_SESSION = os.getenv("REUSE_SEARCH_SESSION", "1") == "1"
+CAPTCHA_CONCURRENCY = int(os.getenv("CAPTCHA_CONCURRENCY", NUMBER_OF_WORKERS))
+# opt-in: keep every captcha with its answer and whether the site accepted it
+CAPTCHA_CAPTURE_PATH = os.getenv("CAPTCHA_CAPTURE_PATH")
+# "files" writes one .txt per case page, "segments" appends them to compressed segment files
+HTML_STORAGE_FILES = "files"
+HTML_STORAGE_SEGMENTS = "segments"
+HTML_STORAGE = os.getenv("HTML_STORAGE", HTML_STORAGE_FILES)
+HTML_SEGMENTS_PATH = os.getenv(
+    "HTML_SEGMENTS_PATH", os.path.join(final_data_folder, HTML_SEGMENTS_DIRNAME)
+)
+# dropdown options and combos crawled from the search form, read again after the TTL
+CEJ_METADATA_PATH = os.getenv("CEJ_METADATA_PATH") or os.path.join(
+    final_data_folder, METADATA_FILENAME
+)
+CEJ_METADATA_TTL = int(os.getenv("CEJ_METADATA_TTL", DEFAULT_METADATA_TTL))
+# probed last file numbers older than this are ignored for scheduling and ETA
+PROBE_TTL = int(os.getenv("PROBE_TTL", 7 * 24 * 3600))
+PROBE_MAX_TRIES = 3
+# e.g. LIMA=10,FAMILIA=5: combos matching higher weights are scraped first
+COMBO_PRIORITIES = os.getenv("COMBO_PRIORITIES", "")
+# seconds a worker process may go without a heartbeat before its work is handed out again
+LEASE_TTL = int(os.getenv("LEASE_TTL", 600))
+COORDINATOR_POLL_INTERVAL = 30
+
+ROLE_STANDALONE = "standalone"
+ROLE_COORDINATOR = "coordinator"
+ROLE_WORKER = "worker"
+DRIVER_MAX_USES = int(os.getenv("DRIVER_MAX_USES", 20))
+DRIVER_MAX_RSS_MB = int(os.getenv("DRIVER_MAX_RSS_MB", 1500))
+PROGRESS_DB_PATH = os.getenv(
+    "PROGRESS_DB_PATH", os.path.join(final_data_folder, PROGRESS_DB_FILENAME)
+)
+driver_pool = None
+captcha_service = None
+captcha_service_lock = threading.Lock()
+captcha_dataset = CaptchaDataset(CAPTCHA_CAPTURE_PATH) if CAPTCHA_CAPTURE_PATH else None
+driver_pool_lock = threading.Lock()
+# set by SIGINT/SIGTERM, workers stop at the next file number or case
+stop_event = threading.Event()
+stop_signal = None
 global_executor = None
+download_pipeline = None
+blob_store = None
+blob_store_lock = threading.Lock()
+html_writer = None
+html_writer_lock = threading.Lock()
+progress_store = None
+progress_store_lock = threading.Lock()
+resume_indexes = {}
+cej_metadata = None
+cej_metadata_lock = threading.Lock()
+
+
+def get_driver_pool():
+    global driver_pool
+    with driver_pool_lock:
+        if driver_pool is None:
+            driver_pool = WebDriverPool(
+                NUMBER_OF_WORKERS,
+                default_temp_download_folder,
+                warm_url=LINK,
+                max_uses=DRIVER_MAX_USES,
+                max_rss_mb=DRIVER_MAX_RSS_MB,
+            )
+    return driver_pool
+
+
+def get_captcha_service():
+    global captcha_service
+    with captcha_service_lock:
+        if captcha_service is None:
+            captcha_service = CaptchaService(CAPTCHA_CONCURRENCY, get_captcha_solver())
+    return captcha_service
+
+
+def record_captcha_answer(answer, accepted):
+    get_metrics().incr("captcha_accepted" if accepted else "captcha_rejected")
+    if captcha_dataset and answer is not None:
+        captcha_dataset.append(
+            answer.image, answer.text, accepted, answer.backend, answer.latency
+        )
 
 
-def mark_combo_file_num_done(combo, file_num, parent_dir):
-    done_dir = os.path.join(parent_dir, "done")
-    if not os.path.exists(done_dir):
-        Path(done_dir).mkdir(parents=True)
-    done_file_path = os.path.join(done_dir, get_done_filename(combo, file_num))
-    Path(done_file_path).touch()
+def get_blob_store():
+    global blob_store
+    if not DEDUPLICATE_DOWNLOADS:
+        return None
+    with blob_store_lock:
+        if blob_store is None:
+            blob_store = BlobStore(BLOB_STORE_PATH)
+    return blob_store
 
 
-def mark_combo_done(combo, parent_dir):
-    done_dir = os.path.join(parent_dir, "done")
-    if not os.path.exists(done_dir):
-        Path(done_dir).mkdir(parents=True)
-    done_file_path = os.path.join(done_dir, get_done_filename(combo))
-    Path(done_file_path).touch()
+def get_html_writer():
+    global html_writer
+    with html_writer_lock:
+        if html_writer is None:
+            html_writer = HtmlSegmentWriter(HTML_SEGMENTS_PATH)
+    return html_writer
 
 
-def is_combo_file_num_done(combo, file_num, parent_dir):
-    done_dir = os.path.join(parent_dir, "done")
-    done_file_path = os.path.join(done_dir, get_done_filename(combo, file_num))
-    return os.path.exists(done_file_path)
+def store_download(job, file_path):
+    if not get_blob_store():
+        return
+    try:
+        get_blob_store().add(file_path, job.expediente, job.index, job.href)
+    except OSError as e:
+        # the download itself is fine, it just stays out of the store
+        logger.warning(f"could not add {file_path} to the blob store: {e}")
+
+
+def get_progress_store():
+    global progress_store
+    with progress_store_lock:
+        if progress_store is None:
+            progress_store = ProgressStore(PROGRESS_DB_PATH)
+            # existing touch-file markers are imported once, on first use
+            progress_store.import_marker_trees(final_data_folder, faulty_downloads_dir)
+    return progress_store
+
+
+def get_resume_index(year):
+    with progress_store_lock:
+        resume_index = resume_indexes.get(year)
+    if resume_index is None:
+        resume_index = ResumeIndex.from_store(get_progress_store(), year)
+        with progress_store_lock:
+            resume_indexes[year] = resume_index
+    return resume_index
+
+
+def get_combo_sizes(year):
+    # estimated last file number of each combo, probed or from earlier years
+    return {
+        **get_progress_store().get_past_sizes(year),
+        **get_progress_store().get_combo_bounds(year, PROBE_TTL),
+    }
+
+
+def get_changed_results(combo, file_num, year, fingerprints):
+    # indexes of the results whose summary the last scrape did not see, wherever
+    # they were in the list, so an inserted or reordered case does not shift the rest
+    stored = get_progress_store().get_fingerprint(year, combo, file_num)
+    stored = set(json.loads(stored)) if stored else set()
+    return [
+        index
+        for index, fingerprint in enumerate(fingerprints)
+        if fingerprint not in stored
+    ]
+
+
+def mark_combo_file_num_done(combo, file_num, year, fingerprints=None):
+    get_metrics().incr("file_nums_done")
+    get_progress_store().mark_file_num(
+        year,
+        combo,
+        file_num,
+        STATUS_DONE,
+        fingerprint=json.dumps(fingerprints) if fingerprints is not None else None,
+    )
+
+
+def mark_combo_file_num_failed(combo, file_num, year, error):
+    get_metrics().incr("file_nums_failed")
+    get_progress_store().mark_file_num(
+        year, combo, file_num, STATUS_FAILED, type(error).__name__
+    )
+
+
+def mark_combo_done(combo, year):
+    get_progress_store().mark_combo_done(year, combo)
+
+
+def is_combo_file_num_done(combo, file_num, year):
+    return get_progress_store().is_file_num_done(year, combo, file_num)
+
+
+def mark_download_faulty(job, error):
+    logger.warning(f"giving up on {job.href} for {job.expediente}: {error}")
+    get_progress_store().mark_faulty_download(job.expediente, type(error).__name__)
+
+
+def get_cej_metadata(refresh=False):
+    """
+    The cached dropdown metadata, crawled again when it is missing, older
+    than CEJ_METADATA_TTL, from another site or refresh is set. A stale cache
+    is still used when the crawl fails.
+    """
+    global cej_metadata
+    with cej_metadata_lock:
+        if cej_metadata is not None and not refresh:
+            return cej_metadata
+        cached = CejMetadata.load(CEJ_METADATA_PATH)
+        if cached and not refresh and cached.is_fresh(CEJ_METADATA_TTL, CEJ_BASE_URL):
+            cej_metadata = cached
+            return cej_metadata
+        logger.info("crawling the search form dropdowns...")
+        try:
+            cej_metadata = crawl_metadata(
+                get_driver_pool(),
+                CEJ_BASE_URL,
+                LINK,
+                NUMBER_OF_WORKERS,
+                timeout=get_pacer().timeout(WAIT_TIMEOUT),
+            )
+        except (MetadataError, WebDriverException) as e:
+            if cached is None:
+                raise MetadataError(f"could not crawl the search form dropdowns: {e}")
+            logger.warning(
+                f"using metadata from {CEJ_METADATA_PATH}, crawl failed: {e}"
+            )
+            cej_metadata = cached
+            return cej_metadata
+        cej_metadata.save(CEJ_METADATA_PATH)
+        log_diff(cej_metadata)
+        return cej_metadata
+
+
+def get_year_combos(year):
+    """
+    The combos of year's dropdown cascade, crawled and added to the cache the
+    first time a year is needed, as courts and specialties differ by year.
+    """
+    metadata = get_cej_metadata()
+    with cej_metadata_lock:
+        if metadata.has_year(year):
+            return metadata.get_combos(year)
+        logger.info(f"crawling the dropdown cascade of {year}...")
+        try:
+            combos = crawl_combos(
+                get_driver_pool(),
+                LINK,
+                metadata.locations,
+                year,
+                NUMBER_OF_WORKERS,
+                timeout=get_pacer().timeout(WAIT_TIMEOUT),
+            )
+        except (MetadataError, WebDriverException) as e:
+            logger.warning(
+                f"could not crawl the combos of {year}, using those of the latest "
+                f"year crawled and constants.list_all_comb: {e}"
+            )
+            return metadata.get_combos(year)
+        metadata.set_combos(year, combos)
+        metadata.save(CEJ_METADATA_PATH)
+        return metadata.get_combos(year)
 
 
 def validate_locations_choice(value):
-    choices = list(c[0] for c in list_all_comb)
+    # cached locations when there are some, without crawling at argument parsing
+    metadata = CejMetadata.load(CEJ_METADATA_PATH)
+    if metadata:
+        choices = metadata.locations
+    else:
+        choices = list(c[0] for c in list_all_comb)
     if value in choices or value == "":
         return value
     raise argparse.ArgumentTypeError(
@@ -114,7 +426,6 @@ def parse_args():
         choices=list(range(2005, current_year + 1)),
         default=None,
         help="years to scrape, default to 2019",
-        required=True,
     )
     parser.add_argument(
         "-l" "--locations",
@@ -124,60 +435,76 @@ def parse_args():
         default=None,
         help="locations to scrape, default to all",
     )
+    parser.add_argument(
+        "--role",
+        dest="role",
+        choices=[ROLE_STANDALONE, ROLE_COORDINATOR, ROLE_WORKER],
+        default=ROLE_STANDALONE,
+        help="standalone scrapes in this process, a coordinator queues work for worker processes",
+    )
+    parser.add_argument(
+        "--processes",
+        dest="processes",
+        type=int,
+        default=0,
+        help="worker processes a coordinator starts on this host",
+    )
+    parser.add_argument(
+        "--refresh",
+        dest="refresh",
+        action="store_true",
+        help="search the file numbers already done again and only scrape the cases whose summary changed",
+    )
+    parser.add_argument(
+        "--probe",
+        dest="probe",
+        action="store_true",
+        help="only find the last file number of every combo left, for scheduling and the ETA",
+    )
+    parser.add_argument(
+        "--priority",
+        dest="priority",
+        default=COMBO_PRIORITIES,
+        help="comma separated PATTERN=WEIGHT, combos whose district, court or specialty match a higher weight are scraped first, e.g. LIMA*=10,FAMILIA=5",
+    )
+    parser.add_argument(
+        "--refresh-metadata",
+        dest="refresh_metadata",
+        action="store_true",
+        help="crawl the search form dropdowns again even if the cached ones are recent",
+    )
+    parser.add_argument(
+        "--queue-db",
+        dest="queue_db",
+        default=os.path.join(final_data_folder, WORK_QUEUE_DB_FILENAME),
+        help="work queue database shared by the coordinator and its workers",
+    )
     args = parser.parse_args()
+    if args.years is None and args.role != ROLE_WORKER:
+        parser.error("the following arguments are required: -y/--years")
+    if args.refresh and args.role != ROLE_STANDALONE:
+        parser.error("--refresh only runs in the standalone role")
+    if args.probe and (args.refresh or args.role != ROLE_STANDALONE):
+        parser.error("--probe only runs in the standalone role, without --refresh")
+    try:
+        args.priorities = parse_priorities(args.priority)
+    except ValueError as e:
+        parser.error(f"--priority: {e}")
     if args.locations:
         parsed_location_list = [s.strip() for s in ",".join(args.locations).split(",")]
         parsed_location_list = [
             validate_locations_choice(s) for s in parsed_location_list if s
         ]
-        return parsed_location_list, args.years
-    return None, args.years
+        return parsed_location_list, args.years, args
+    return None, args.years, args
 
 
 def get_latest_locations():
-    clear_temp_folder(default_temp_download_folder)
-    try:
-        logger.info("getting latest locations...")
-        driver = setup_selenium_browser_driver(default_temp_download_folder)
-        driver.get(LINK)
-        loc_dropdown = Select(driver.find_element(By.ID, "distritoJudicial"))
-        locations = set(option.text for option in loc_dropdown.options)
-        locations.remove(PLACEHOLDER_TEXT)
-        driver.quit()
-        return locations
-
-    except (
-        NoSuchElementException,
-        TimeoutException,
-        StaleElementReferenceException,
-        WebDriverException,
-    ) as e:
-        logger.error(e)
-        os._exit(2)
-
-
-def get_done_filename(combo, file_num=None):
-    arr = combo
-    if file_num is not None:
-        arr = combo + ["file_num", str(file_num)]
-    return "_".join(arr)
-
-
-def get_year_done_filename(year):
-    return os.path.join(final_data_folder, str(year), "done")
+    return set(get_cej_metadata().locations)
 
 
 def get_all_valid_years():
-    driver = setup_selenium_browser_driver(default_temp_download_folder)
-    driver.get(LINK)
-    element = WebDriverWait(driver, 10).until(
-        EC.text_to_be_present_in_element((By.ID, "anio"), PLACEHOLDER_TEXT)
-    )
-    loc_dropdown = Select(driver.find_element(By.ID, "anio"))
-    years = set(option.text for option in loc_dropdown.options)
-    years.remove(PLACEHOLDER_TEXT)
-    driver.quit()
-    return sorted([int(y) for y in years], reverse=True)
+    return list(get_cej_metadata().years)
 
 
 def get_parent_raw_html_dir(year):
@@ -185,33 +512,80 @@ def get_parent_raw_html_dir(year):
 
 
 def is_year_done(year):
-    return os.path.exists(get_year_done_filename(year))
+    return get_progress_store().is_year_done(year)
 
 
-def is_combo_done(combo, parent_dir):
-    done_file_path = os.path.join(parent_dir, "done", get_done_filename(combo))
-    return os.path.exists(done_file_path)
+def is_combo_done(combo, year):
+    return get_progress_store().is_combo_done(year, combo)
 
 
 def mark_year_done(year):
-    Path(get_year_done_filename(year)).touch()
+    get_progress_store().mark_year_done(year)
 
 
-def enable_download_in_headless_chrome(driver, download_dir):
-    driver.command_executor._commands["send_command"] = (
-        "POST",
-        "/session/$sessionId/chromium/send_command",
-    )
-    params = {
-        "cmd": "Page.setDownloadBehavior",
-        "params": {"behavior": "allow", "downloadPath": download_dir},
-    }
-    driver.execute("send_command", params)
+class ScrapeInterrupted(Exception):
+    pass
+
+
+def check_stop():
+    # raised between cases, the file number is left undone and scraped again next run
+    if stop_event.is_set():
+        raise ScrapeInterrupted()
+
+
+def remove_temp_downloads_dir(temp_downloads_dir):
+    # a stopped worker's half done browser downloads are discarded, never moved
+    if stop_event.is_set():
+        shutil.rmtree(temp_downloads_dir, ignore_errors=True)
+    elif not os.listdir(temp_downloads_dir):
+        os.rmdir(temp_downloads_dir)
+
+
+class SearchSession:
+    # a search form filled for one combo and year, whose captcha was accepted
+    def __init__(self, driver, combo, year):
+        self.session_id = driver.session_id
+        self.combo = list(combo)
+        self.year = year
+        self.searches = 1
+        get_metrics().incr("searches_new_captcha")
+
+    def matches(self, driver, combo, year):
+        # drivers go back to the pool between chunks, another worker may have
+        # searched another combo on this one since, so the form itself is read
+        if not (
+            self.session_id == driver.session_id
+            and self.combo == list(combo)
+            and self.year == year
+        ):
+            return False
+        try:
+            if not driver.current_url.startswith(LINK):
+                return False
+            selected = driver.execute_script(
+                "return arguments[0].map(function (id) {"
+                "  var select = document.getElementById(id);"
+                "  return select && select.selectedIndex >= 0"
+                "    ? select.options[select.selectedIndex].text : null;"
+                "});",
+                ["distritoJudicial", "anio", "organoJurisdiccional", "especialidad"],
+            )
+        except WebDriverException:
+            return False
+        expected = [combo[0], year, combo[1], combo[2]]
+        return [" ".join((text or "").split()) for text in selected] == [
+            " ".join(str(text).split()) for text in expected
+        ]
 
 
 class Scrapper:
-    def __init__(self) -> None:
-        pass
+    def __init__(self, refresh=False) -> None:
+        self.detail_fetcher = CaseDetailFetcher()
+        # in refresh mode only the cases whose summary changed are scraped again
+        self.refresh = refresh
+        self.search_session = None
+        # combos whose first search on a reused form asked for a new captcha
+        self.reuse_refused = set()
 
     def __enter__(self):
         return self
@@ -220,9 +594,57 @@ class Scrapper:
         pass
 
     def scrape_data(
-        self, driver, temp_downloads_dir
+        self, driver, temp_downloads_dir, indexes=None
     ):  # to scrape the insides of the site
-        time.sleep(2)
+        get_pacer().wait_cooldown()
+        wait_for_results(driver, get_pacer().timeout(RESULTS_TIMEOUT))
+        if USE_HTTP_DETAIL_FETCH:
+            try:
+                return self.scrape_data_http(driver, temp_downloads_dir, indexes)
+            except DetailFetchError as e:
+                get_pacer().record_error(ERROR_DETAIL_FETCH)
+                logger.warning(
+                    f"HTTP detail fetch failed, falling back to the browser: {e}"
+                )
+        return self.scrape_data_browser(driver, temp_downloads_dir, indexes)
+
+    def scrape_data_http(self, driver, temp_downloads_dir, indexes=None):
+        # fetch every detail page first so a failure falls back before any download
+        started = time.time()
+        pages = self.detail_fetcher.fetch_all(driver, indexes)
+        if pages:
+            get_pacer().observe((time.time() - started) / len(pages))
+        no_files_flag = len(pages) == 0
+        logger.info(f"button list: {len(pages)}")
+
+        table_html = []
+        case_names_list = []
+        for index, page in enumerate(pages):
+            logger.info("--" + str(index) + "--")
+            table_html.append(page.html)
+            case_names_list.extend(page.case_fields)
+        logger.info({"case_names_list:": case_names_list})
+
+        try:
+            for page in pages:
+                check_stop()
+                if page.download_links:
+                    self.download_documents(
+                        driver, page.expediente, page.download_links, temp_downloads_dir
+                    )
+        except (
+            TimeoutException,
+            StaleElementReferenceException,
+            WebDriverException,
+        ) as e:
+            logger.warning(
+                f"Error occurred in downloading files, restarting scraping from the current file "
+                f"number:\n: {e.msg}"
+            )
+            raise RuntimeError("Error Occurred")
+        return table_html, case_names_list, no_files_flag
+
+    def scrape_data_browser(self, driver, temp_downloads_dir, indexes=None):
         button_list = []  # To scrape the button type links of the documents
         try:
             button_list = driver.find_elements(
@@ -237,7 +659,6 @@ class Scrapper:
             logger.error(
                 "Error occurred in getting button links, restarting scraping from the current file number"
             )
-            driver.quit()
             raise RuntimeError("Error Occurred")
         table_html = []
         case_names_list = []
@@ -248,13 +669,18 @@ class Scrapper:
         logger.info(f"button list: {len(button_list)}")
 
         for index in range(len(button_list)):
+            if indexes is not None and index not in indexes:
+                continue
+            check_stop()
             logger.info(
                 "--" + str(index) + "--"
             )  # This will tell you which doc is being processed
 
             # wait 10 seconds before looking for element
             try:
-                element = WebDriverWait(driver, 10).until(
+                element = WebDriverWait(
+                    driver, get_pacer().timeout(WAIT_TIMEOUT)
+                ).until(
                     EC.presence_of_element_located(
                         (By.XPATH, '//div[@class="celdCentro"]/form/button')
                     )
@@ -265,7 +691,6 @@ class Scrapper:
                 StaleElementReferenceException,
                 WebDriverException,
             ):
-                driver.quit()
                 logger.warning(
                     "Error occurred in getting button links, restarting scraping from the current file number"
                 )
@@ -285,23 +710,21 @@ class Scrapper:
 
             ############################################################################################################
             # Important part of the code, while scraping htmls, it might not load after clicking just once, this way of doing it if it does not load solves the issue
-            link_1 = None
             attempts = 0
 
-            while not link_1:
-                try:
-                    link_1 = driver.find_element(By.XPATH, '//div[@class="partes"]')
-                except NoSuchElementException:
-                    button_list = []
-                    button_list = driver.find_elements(
-                        By.XPATH, '//div[@class="celdCentro"]/form/button'
-                    )
-                    if index < len(button_list):
-                        button_list[index].click()
+            while not wait_for_detail_page(
+                driver, get_pacer().timeout(RESULTS_TIMEOUT)
+            ):
+                button_list = []
+                button_list = driver.find_elements(
+                    By.XPATH, '//div[@class="celdCentro"]/form/button'
+                )
+                if index < len(button_list):
+                    button_list[index].click()
 
-                    attempts += 1
-                    if attempts >= 5:
-                        return None, None, None
+                attempts += 1
+                if attempts >= 5:
+                    return None, None, None
             #############################################################################################################
 
             html = driver.page_source
@@ -326,8 +749,6 @@ class Scrapper:
                 case_names_list.append(tags[tag_index].text)
 
             # for downloading the documents
-
-            elements_doc = []
             logger.info({"case_names_list:": case_names_list})
             try:
                 if is_element_present(
@@ -337,237 +758,371 @@ class Scrapper:
                     expediente_n = driver.find_element(
                         By.CLASS_NAME, "celdaGrid.celdaGridXe"
                     ).text
-                    expediente_year = expediente_n.split("-")[1]
-
-                    existing_faulty_files = os.listdir(faulty_downloads_dir)
-                    expediente_downloads_file = str(expediente_n) + ".txt"
+                    links = [el.get_attribute("href") for el in elements_doc]
+                    self.download_documents(
+                        driver, expediente_n, links, temp_downloads_dir
+                    )
 
-                    if expediente_downloads_file in existing_faulty_files:
-                        continue
+            except (
+                TimeoutException,
+                StaleElementReferenceException,
+                WebDriverException,
+            ) as e:
 
-                    for i in range(len(elements_doc)):
-                        subfolder = str(expediente_n) + "_" + str(i + 1)
+                logger.warning(
+                    f"Error occurred in getting links of download files, restarting scraping from the current file "
+                    f"number:\n: {e.msg}"
+                )
+                raise RuntimeError("Error Occurred")
 
-                        attributeValue_link = elements_doc[i].get_attribute("href")
+            finally:
+                driver.get(RESUMEN_LINK)
+        return table_html, case_names_list, no_files_flag
 
-                        target_download_dir = os.path.join(
-                            final_data_folder,
-                            expediente_year,
-                            "downloaded_files",
-                            subfolder,
-                        )
+    def download_documents(self, driver, expediente_n, links, temp_downloads_dir):
+        expediente_year = expediente_n.split("-")[1]
 
-                        if not os.path.exists(target_download_dir):
-                            p = Path(target_download_dir)
-                            p.mkdir(parents=True)
+        if get_progress_store().is_faulty_download(expediente_n):
+            return
 
-                        # WebDriverWait(driver, 30).until(
-                        #     EC.element_to_be_clickable(elements_doc[i])
-                        # ).click()
+        cookies = driver.get_cookies() if download_pipeline else None
+        for i in range(len(links)):
+            subfolder = str(expediente_n) + "_" + str(i + 1)
 
-                        driver.get(attributeValue_link)
+            attributeValue_link = links[i]
 
-                        link_path = target_download_dir + "/link.txt"
-                        with open(link_path, "w+") as f:
-                            f.write(str(attributeValue_link))
+            target_download_dir = os.path.join(
+                final_data_folder,
+                expediente_year,
+                "downloaded_files",
+                subfolder,
+            )
 
-                        f.close()
+            if not os.path.exists(target_download_dir):
+                p = Path(target_download_dir)
+                p.mkdir(parents=True)
 
-                        timeout_time = (
-                            10  # wait at max 10 seconds for a file to download
-                        )
-                        download_wait(temp_downloads_dir, timeout_time, driver, False)
+            link_path = target_download_dir + "/link.txt"
+            with open(link_path, "w+") as f:
+                f.write(str(attributeValue_link))
 
-                        file_names = os.listdir(temp_downloads_dir)
-                        if len(file_names) > 0:
-                            while len(file_names) > 0:
-                                temp_file_path = os.path.join(
-                                    temp_downloads_dir, file_names[0]
-                                )
-                                shutil.move(temp_file_path, target_download_dir)
-                                logger.info(f"{file_names[0]} downloaded")
-                                file_names = os.listdir(temp_downloads_dir)
+            f.close()
 
-                        else:
-                            logger.info("file not downloaded, will retry")
-                            success = self.retry_download(
-                                elements_doc[i],
-                                4,
-                                target_download_dir,
-                                temp_downloads_dir,
-                                driver,
-                            )
+            known_blob = get_blob_store() and get_blob_store().find(attributeValue_link)
+            if known_blob:
+                get_blob_store().materialize(
+                    known_blob,
+                    target_download_dir,
+                    expediente_n,
+                    i + 1,
+                    attributeValue_link,
+                )
+                logger.info(f"{known_blob.filename} already downloaded, linked")
+                continue
 
-                            if not success:
-                                faulty_downloads_path = os.path.join(
-                                    faulty_downloads_dir, f"{expediente_n}.txt"
-                                )
-                                Path(faulty_downloads_path).touch()
+            if download_pipeline:
+                download_pipeline.enqueue(
+                    attributeValue_link,
+                    target_download_dir,
+                    cookies,
+                    expediente_n,
+                    i + 1,
+                )
+                continue
 
-            except (
-                TimeoutException,
-                StaleElementReferenceException,
-                WebDriverException,
-            ) as e:
+            timeout_time = get_pacer().timeout(DOWNLOAD_TIMEOUT)
+            with DownloadWatcher(temp_downloads_dir) as watcher:
+                driver.get(attributeValue_link)
+                download = watcher.wait(timeout_time)
+            get_metrics().observe(
+                "download",
+                download.duration if download else timeout_time,
+                METRIC_OK if download else METRIC_FAILED,
+                expediente=expediente_n,
+            )
 
-                logger.warning(
-                    f"Error occurred in getting links of download files, restarting scraping from the current file "
-                    f"number:\n: {e.msg}"
+            if download:
+                for path in download.paths:
+                    file_path = shutil.move(path, target_download_dir)
+                    store_download(
+                        DownloadJob(
+                            attributeValue_link,
+                            target_download_dir,
+                            None,
+                            expediente_n,
+                            i + 1,
+                        ),
+                        file_path,
+                    )
+                logger.info(
+                    f"{', '.join(map(os.path.basename, download.paths))} downloaded, "
+                    f"{download.size} bytes in {download.duration:.2f}s"
                 )
-                raise RuntimeError("Error Occurred")
 
-            finally:
-                element_back = "https://cej.pj.gob.pe/cej/forms/resumenform.html"
-                driver.get(element_back)
-        return table_html, case_names_list, no_files_flag
+            else:
+                logger.info("file not downloaded, will retry")
+                success = self.retry_download(
+                    attributeValue_link,
+                    4,
+                    target_download_dir,
+                    temp_downloads_dir,
+                    driver,
+                    expediente_n,
+                    i + 1,
+                )
+                if not success:
+                    get_progress_store().mark_faulty_download(expediente_n)
 
     # This function saves the extracted data in CSV format
     def html_saver(self, case_names_list, path, table_html):
+        # files are written to a staging directory and moved into path at
+        # once, so a file number cut short never leaves a partial directory
         parent_dir = str(path) + "/"
+        # keyed by year too, workers of other processes may be on the same combo
+        # and file number of another year
+        staging_dir = os.path.join(
+            partial_html_folder, os.path.relpath(path, final_data_folder)
+        )
+        if HTML_STORAGE == HTML_STORAGE_FILES:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            Path(staging_dir).mkdir(parents=True)
         for index in range(len(table_html)):
             logger.info("--" + str(index) + "--")
 
             file = str(case_names_list[index]) + ".txt"
 
-            with open(os.path.join(parent_dir, file), "w") as fp:
+            if HTML_STORAGE == HTML_STORAGE_SEGMENTS:
+                get_html_writer().put(
+                    get_html_key(final_data_folder, os.path.join(parent_dir, file)),
+                    table_html[index],
+                )
+                continue
+
+            with open(os.path.join(staging_dir, file), "w") as fp:
                 fp.write(table_html[index])
 
+        if HTML_STORAGE == HTML_STORAGE_FILES:
+            if not os.path.exists(path):
+                os.replace(staging_dir, path)
+                return
+            # a refresh only rewrites the pages that changed
+            for file in os.listdir(staging_dir):
+                os.replace(os.path.join(staging_dir, file), os.path.join(path, file))
+            os.rmdir(staging_dir)
+
     # For entering the site and scraping everything inside
     # This is the master function
-    # Please do not tamper with the sleep timers anywhere in this code
+    # Waits are scaled by get_pacer(), set their base values at the top of this file
     def scraper(
-        self, file_num, list_comb, driver, year, temp_downloads_dir, attempts=0
+        self,
+        file_num,
+        list_comb,
+        driver,
+        year,
+        temp_downloads_dir,
+        attempts=0,
+        probe=False,
     ):
-
+        # with probe only searches, returns whether there are results, None on errors
+        timer = get_metrics().stages(
+            year=year, combo=get_combo_key(list_comb), file_num=file_num
+        )
+        pacer = get_pacer()
         try:
-            driver.get(LINK)
-            # driver.maximize_window()
-            # wait 10 seconds before looking for element
-
-            element = WebDriverWait(driver, 10).until(
-                EC.text_to_be_present_in_element(
-                    (By.ID, "distritoJudicial"), PLACEHOLDER_TEXT
+            check_stop()
+            pacer.wait_cooldown()
+            outcome = self.search_in_session(driver, list_comb, year, file_num, timer)
+            if outcome:
+                no_more_element_is_displayed = outcome == OUTCOME_NO_RESULTS
+            else:
+                timer.start("page_load")
+                started = time.time()
+                driver.get(LINK)
+                pacer.observe(time.time() - started)
+                # driver.maximize_window()
+                # wait 10 seconds before looking for element
+
+                element = WebDriverWait(
+                    driver, get_pacer().timeout(WAIT_TIMEOUT)
+                ).until(
+                    EC.text_to_be_present_in_element(
+                        (By.ID, "distritoJudicial"), PLACEHOLDER_TEXT
+                    )
                 )
-            )
-
-            # selecting LIMA
-            select = Select(driver.find_element(By.ID, "distritoJudicial"))
-            select.select_by_visible_text(str(list_comb[0]))
 
-            # wait 10 seconds before looking for element
-            element = WebDriverWait(driver, 10).until(
-                EC.text_to_be_present_in_element((By.ID, "anio"), PLACEHOLDER_TEXT)
-            )
+                # start solving the captcha while the dropdowns cascade
+                captcha_future = None
+                if is_element_present("id", "btnReload", driver):
+                    captcha_future = get_captcha_service().submit_from_driver(driver)
+
+                # selecting LIMA
+                timer.start("select_location")
+                select = Select(driver.find_element(By.ID, "distritoJudicial"))
+                select.select_by_visible_text(str(list_comb[0]))
+
+                # wait 10 seconds before looking for element
+                element = WebDriverWait(
+                    driver, get_pacer().timeout(WAIT_TIMEOUT)
+                ).until(
+                    EC.text_to_be_present_in_element((By.ID, "anio"), PLACEHOLDER_TEXT)
+                )
 
-            # selecting YEAR
-            select = Select(driver.find_element(By.ID, "anio"))
-            select.select_by_visible_text(str(year))
+                # selecting YEAR
+                timer.start("select_year")
+                select = Select(driver.find_element(By.ID, "anio"))
+                select.select_by_visible_text(str(year))
 
-            # For JUZGADO DE PAZ LETRADO
+                # For JUZGADO DE PAZ LETRADO
 
-            # wait 10 seconds before looking for element
+                # wait 10 seconds before looking for element
 
-            element = WebDriverWait(driver, 10).until(
-                EC.text_to_be_present_in_element(
-                    (By.ID, "organoJurisdiccional"), PLACEHOLDER_TEXT
+                element = WebDriverWait(
+                    driver, get_pacer().timeout(WAIT_TIMEOUT)
+                ).until(
+                    EC.text_to_be_present_in_element(
+                        (By.ID, "organoJurisdiccional"), PLACEHOLDER_TEXT
+                    )
                 )
-            )
 
-            # Selecting instance of the case as JUZGADO DE PAZ LETRADO
-            select = Select(driver.find_element(By.ID, "organoJurisdiccional"))
-            select.select_by_visible_text(str(list_comb[1]))
+                # Selecting instance of the case as JUZGADO DE PAZ LETRADO
+                timer.start("select_organo")
+                select = Select(driver.find_element(By.ID, "organoJurisdiccional"))
+                select.select_by_visible_text(str(list_comb[1]))
 
-            # Civil inside JUZGADO DE PAZ LETRADO
+                # Civil inside JUZGADO DE PAZ LETRADO
 
-            # wait 10 seconds before looking for element
-            element = WebDriverWait(driver, 10).until(
-                EC.text_to_be_present_in_element(
-                    (By.ID, "especialidad"), PLACEHOLDER_TEXT
+                # wait 10 seconds before looking for element
+                element = WebDriverWait(
+                    driver, get_pacer().timeout(WAIT_TIMEOUT)
+                ).until(
+                    EC.text_to_be_present_in_element(
+                        (By.ID, "especialidad"), PLACEHOLDER_TEXT
+                    )
                 )
-            )
 
-            select = Select(driver.find_element(By.ID, "especialidad"))
-            select.select_by_visible_text(
-                str(list_comb[2])
-            )  # Set to civil, can be changed to any other type depending on the requirements of the user
+                timer.start("select_especialidad")
+                select = Select(driver.find_element(By.ID, "especialidad"))
+                select.select_by_visible_text(
+                    str(list_comb[2])
+                )  # Set to civil, can be changed to any other type depending on the requirements of the user
 
-            # input case file num
-            inputElement = WebDriverWait(driver, 10).until(
-                EC.element_to_be_clickable((By.ID, "numeroExpediente"))
-            )
-            inputElement.send_keys(file_num)
-
-            # driver.find_element_by_tag_name('body').send_keys(Keys.CONTROL + Keys.HOME)
-            driver.execute_script(
-                "var scrollingElement = (document.scrollingElement || document.body);scrollingElement.scrollTop = scrollingElement.scrollHeight;"
-            )
+                # input case file num
+                inputElement = WebDriverWait(
+                    driver, get_pacer().timeout(WAIT_TIMEOUT)
+                ).until(EC.element_to_be_clickable((By.ID, "numeroExpediente")))
+                inputElement.send_keys(file_num)
 
-            no_more_element_is_displayed = False
-            sleep_time = 3
-            index = 0
-            while not is_element_present(
-                "xpath", '//div[@class="celdCentro"]/form/button', driver
-            ):
-                if index != 0:
-                    if is_element_present("id", "mensajeNoExisteExpedientes", driver):
-                        no_more_element_is_displayed = driver.find_element(
-                            By.ID, "mensajeNoExisteExpedientes"
-                        ).is_displayed()
-                    if no_more_element_is_displayed:
-                        break
-                    else:
-                        if is_element_present("id", "btnReload", driver):
-                            logger.warning("Captcha solved incorrectly, retrying...")
-
-                            if not inputElement.get_attribute("value"):
-                                # restart scraper since input values are empty
-                                return self.scraper(
-                                    file_num,
-                                    list_comb,
-                                    driver,
-                                    year,
-                                    temp_downloads_dir,
-                                )
+                # driver.find_element_by_tag_name('body').send_keys(Keys.CONTROL + Keys.HOME)
+                driver.execute_script(
+                    "var scrollingElement = (document.scrollingElement || document.body);scrollingElement.scrollTop = scrollingElement.scrollHeight;"
+                )
 
-                            driver.find_element(By.ID, "btnReload").click()
-                        time.sleep(3)
-                if is_element_present("id", "btnReload", driver):
-                    captcha_text = azcaptcha_solver_post(driver)
-                    captcha = driver.find_element(By.ID, "codigoCaptcha")
-                    captcha.clear()
-
-                    captcha.send_keys(captcha_text)
-                    driver.find_element(
-                        By.XPATH, '//*[@id="consultarExpedientes"]'
-                    ).click()
-                while True:
-                    try:
-                        loader_is_displayed = driver.find_element(
-                            By.ID, "cargando"
-                        ).is_displayed()
-                        if not loader_is_displayed:
+                timer.start("search")
+                no_more_element_is_displayed = False
+                captcha_answer = None
+                searched_at = None
+                index = 0
+                while not is_element_present(
+                    "xpath", '//div[@class="celdCentro"]/form/button', driver
+                ):
+                    check_stop()
+                    if index != 0:
+                        no_more_element_is_displayed = no_results_displayed(driver)
+                        if no_more_element_is_displayed:
                             break
-                    except Exception:
-                        break
-
-                time.sleep(sleep_time)
-
-                index += 1
-
-            logger.info("Captcha solved correctly")
+                        else:
+                            if is_element_present("id", "btnReload", driver):
+                                logger.warning(
+                                    "Captcha solved incorrectly, retrying..."
+                                )
+                                record_captcha_answer(captcha_answer, False)
+                                pacer.record_error(ERROR_CAPTCHA_RESET)
+                                captcha_answer = None
+
+                                if not inputElement.get_attribute("value"):
+                                    # restart scraper since input values are empty
+                                    timer.fail()
+                                    return self.scraper(
+                                        file_num,
+                                        list_comb,
+                                        driver,
+                                        year,
+                                        temp_downloads_dir,
+                                        probe=probe,
+                                    )
+
+                                reload_captcha(driver, pacer.timeout(WAIT_TIMEOUT))
+                            pacer.wait_cooldown()
+                    if is_element_present("id", "btnReload", driver):
+                        if captcha_future is None:
+                            captcha_future = get_captcha_service().submit_from_driver(
+                                driver
+                            )
+                        with get_metrics().span(
+                            "captcha_wait", year=year, file_num=file_num
+                        ):
+                            captcha_answer = captcha_future.result()
+                        captcha_future = None
+                        captcha = driver.find_element(By.ID, "codigoCaptcha")
+                        captcha.clear()
+
+                        captcha.send_keys(captcha_answer.text or "")
+                        clear_search_outcome(driver)
+                        driver.find_element(
+                            By.XPATH, '//*[@id="consultarExpedientes"]'
+                        ).click()
+                        searched_at = time.time()
+                    if not wait_for_loader_hidden(driver, pacer.timeout(WAIT_TIMEOUT)):
+                        pacer.record_error(ERROR_TIMEOUT)
+                    elif searched_at:
+                        pacer.observe(time.time() - searched_at)
+                    searched_at = None
+
+                    wait_for_search_outcome(driver, pacer.timeout(RESULTS_TIMEOUT))
+
+                    index += 1
+
+                logger.info("Captcha solved correctly")
+                record_captcha_answer(captcha_answer, True)
+                self.search_session = SearchSession(driver, list_comb, year)
+
+            if probe:
+                timer.finish()
+                return not no_more_element_is_displayed
 
             if not no_more_element_is_displayed:
+                fingerprints = get_result_fingerprints(driver.page_source)
+                indexes = None
+                if self.refresh:
+                    indexes = get_changed_results(
+                        list_comb, file_num, year, fingerprints
+                    )
+                    if not indexes:
+                        timer.finish()
+                        logger.info(f"file_num {file_num} for {list_comb} unchanged")
+                        mark_combo_file_num_done(
+                            list_comb, file_num, year, fingerprints
+                        )
+                        return "Combo Done"
+                    logger.info(
+                        f"file_num {file_num} for {list_comb}: "
+                        f"{len(indexes)} of {len(fingerprints)} cases changed"
+                    )
                 parent_dir = get_parent_raw_html_dir(year)
                 directory = "_".join(list_comb + ["file_num", str(file_num)])
                 path = os.path.join(parent_dir, directory)
-                if not os.path.exists(path):
-                    Path(path).mkdir(parents=True)
+                if HTML_STORAGE == HTML_STORAGE_FILES and not os.path.exists(
+                    parent_dir
+                ):
+                    Path(parent_dir).mkdir(parents=True)
+                timer.start("detail_fetch")
                 try:
                     logger.info(f"processing file_num: {file_num} for {list_comb}")
                     table_html, case_names_list, no_files = self.scrape_data(
-                        driver, temp_downloads_dir
+                        driver, temp_downloads_dir, indexes
                     )
                 except RuntimeError:
+                    timer.fail()
                     return self.scraper(
                         file_num, list_comb, driver, year, temp_downloads_dir
                     )
@@ -577,6 +1132,7 @@ class Scrapper:
                         f"Failed to click form button, restarting file_num {file_num}"
                     )
                     if attempts < 5:
+                        timer.fail()
                         return self.scraper(
                             file_num,
                             list_comb,
@@ -591,19 +1147,33 @@ class Scrapper:
                 if no_files:
                     logger.info("NO MORE FILES, DELAYED ERROR")
                     flag = "NO MORE FILES, DELAYED ERROR"
+                    timer.finish()
                     return flag
                 else:
+                    timer.start("html_save")
                     self.html_saver(case_names_list, path, table_html)
+                timer.finish()
 
-                mark_combo_file_num_done(list_comb, file_num, parent_dir)
+                mark_combo_file_num_done(list_comb, file_num, year, fingerprints)
                 combo_flag = "Combo Done"
                 return combo_flag
             else:
+                timer.finish()
                 logger.info(f"NO MORE FILES for {list_comb}")
                 return DONE_FLAG
         except Exception as e:
-            if isinstance(e, KeyboardInterrupt):
-                handle_keyboard_cancel(None, None)
+            timer.fail()
+            self.end_search_session()
+            if isinstance(e, ScrapeInterrupted):
+                logger.info(
+                    f"stopped before finishing file_num {file_num} of {list_comb}"
+                )
+                return None
+            if isinstance(e, TimeoutException):
+                pacer.record_error(ERROR_TIMEOUT)
+            if probe:
+                logger.warning(f"probe of file_num {file_num} failed: {e}")
+                return None
             elif isinstance(e, PermissionError):
                 logger.warning(
                     "restarting scraping from the current file number due to PermissionError"
@@ -613,31 +1183,97 @@ class Scrapper:
                 )
             elif isinstance(e, urllib3.connectionpool.MaxRetryError):
                 logger.warning(f"Max retries exceeded: {e.max_retries}")
+                pacer.record_error(ERROR_MAX_RETRIES, severe=True)
+                mark_combo_file_num_failed(list_comb, file_num, year, e)
             else:
 
                 failed_file = f"{year}-{'-'.join(list_comb)}-{file_num}"
-                faulty_downloads_path = os.path.join(
-                    faulty_downloads_dir, f"{failed_file}.txt"
-                )
-                logger.warning(f"adding failed_file {failed_file} to faulty downloads")
-                Path(faulty_downloads_path).touch()
+                logger.warning(f"marking {failed_file} as failed: {type(e).__name__}")
+                mark_combo_file_num_failed(list_comb, file_num, year, e)
+
+    def end_search_session(self):
+        if self.search_session:
+            logger.info(
+                f"solved captcha lasted {self.search_session.searches} searches"
+            )
+            self.search_session = None
+
+    def search_in_session(self, driver, list_comb, year, file_num, timer):
+        """
+        Search file_num on the form left by the previous search, without
+        reloading the page nor solving a captcha. Returns the search outcome,
+        or None when there is no such form or the server wants a new captcha.
+        """
+        session = self.search_session
+        if (
+            not REUSE_SEARCH_SESSION
+            or session is None
+            or get_combo_key(list_comb) in self.reuse_refused
+        ):
+            return None
+        if not session.matches(driver, list_comb, year):
+            self.end_search_session()
+            return None
+
+        pacer = get_pacer()
+        timer.start("search")
+        try:
+            clear_search_outcome(driver)
+            input_element = driver.find_element(By.ID, "numeroExpediente")
+            input_element.clear()
+            input_element.send_keys(file_num)
+            driver.find_element(By.XPATH, '//*[@id="consultarExpedientes"]').click()
+            searched_at = time.time()
+            if wait_for_loader_hidden(driver, pacer.timeout(WAIT_TIMEOUT)):
+                pacer.observe(time.time() - searched_at)
+            outcome = wait_for_search_outcome(driver, pacer.timeout(RESULTS_TIMEOUT))
+        except WebDriverException as e:
+            logger.warning(f"search on the previous form failed: {e.msg}")
+            outcome = None
+
+        if outcome == OUTCOME_CAPTCHA and session.searches == 1:
+            logger.info(f"the site wants a captcha per search of {list_comb}")
+            self.reuse_refused.add(get_combo_key(list_comb))
+        if outcome in (False, None, OUTCOME_CAPTCHA):
+            timer.fail()
+            self.end_search_session()
+            return None
+        session.searches += 1
+        get_metrics().incr("searches_reused_captcha")
+        return outcome
 
     def retry_download(
-        self, link_el, max_tries, target_download_dir, temp_downloads_dir, driver
+        self,
+        link,
+        max_tries,
+        target_download_dir,
+        temp_downloads_dir,
+        driver,
+        expediente_n=None,
+        index=None,
     ):
         tries = 1
-        timeout_time = 10  # wait at max 10 seconds for a file to download
+        timeout_time = get_pacer().timeout(DOWNLOAD_TIMEOUT)
         success = False
 
         while tries < max_tries and not success:
-            link_el.click()
-            download_wait(temp_downloads_dir, timeout_time, driver, False)
-            file_names = os.listdir(temp_downloads_dir)
-
-            if len(file_names) > 0:
-                temp_file_path = os.path.join(temp_downloads_dir, file_names[0])
-                shutil.move(temp_file_path, target_download_dir)
-                logger.info("downloaded on try : " + str(tries))
+            with DownloadWatcher(temp_downloads_dir) as watcher:
+                driver.get(link)
+                download = watcher.wait(timeout_time)
+
+            if download:
+                for path in download.paths:
+                    file_path = shutil.move(path, target_download_dir)
+                    store_download(
+                        DownloadJob(
+                            link, target_download_dir, None, expediente_n, index
+                        ),
+                        file_path,
+                    )
+                logger.info(
+                    f"{len(download.paths)} file(s) downloaded on try : {tries}, "
+                    f"{download.size} bytes in {download.duration:.2f}s"
+                )
                 success = True
 
             else:
@@ -652,16 +1288,19 @@ class Scrapper:
 
         return success
 
-    def scrape_for_each_comb(self, list_comb, year, parent_raw_html_directory):
+    def scrape_for_each_comb(self, list_comb, year):
+        if stop_event.is_set():
+            return f"Skipped {year} {list_comb}, stopping"
+        logger.info(f"Start processing {year} {list_comb}")
 
-        if not stop_threads:
-            logger.info(f"Start processing {year} {list_comb}")
-        else:
-            os._exit(1)
-
-        file_number = (
-            1  # reset case number to start from 1 for each location-court-type combo
-        )
+        # start each location-court-type combo at its first file number not done yet
+        resume_index = get_resume_index(year)
+        file_number = resume_index.next_missing(list_comb, 1)
+        if file_number > 1:
+            logger.info(
+                f"Resuming {year} {list_comb} from file number {file_number}, "
+                f"gaps left: {resume_index.get_gaps(list_comb)}"
+            )
         flag = ""
         empty_num = 0
         temp_downloads_dir = os.path.join(
@@ -671,23 +1310,18 @@ class Scrapper:
             p = Path(temp_downloads_dir)
             p.mkdir(parents=True)
 
-        web_driver = setup_selenium_browser_driver(temp_downloads_dir)
-        drivers.append(web_driver)
-
-        enable_download_in_headless_chrome(web_driver, temp_downloads_dir)
-
-        while flag != DONE_FLAG and empty_num < 5 and not stop_threads:
-            if is_combo_file_num_done(
-                list_comb, file_number, parent_raw_html_directory
-            ):
-                logger.info(f"Already done. Skipping {list_comb} {file_number}")
-                file_number = file_number + 1
-                continue
+        web_driver = get_driver_pool().acquire(temp_downloads_dir)
 
+        while flag != DONE_FLAG and empty_num < 5 and not stop_event.is_set():
             flag = self.scraper(
                 file_number, list_comb, web_driver, year, temp_downloads_dir
             )
+            if not is_driver_healthy(web_driver):
+                web_driver = get_driver_pool().replace(web_driver, temp_downloads_dir)
             logger.info(f"{list_comb} file no {file_number}'s flag: {flag}")
+            if stop_event.is_set():
+                # an interrupted file number is not empty, the combo is not done
+                break
             if flag == "NO MORE FILES, DELAYED ERROR" or not flag:
                 empty_num = empty_num + 1
                 logger.info(
@@ -695,94 +1329,553 @@ class Scrapper:
                     + str(5 - empty_num)
                     + " files are empty, next combination will start"
                 )
-            file_number = file_number + 1
-        web_driver.quit()
-
-        if not os.listdir(temp_downloads_dir):  # delete temp folder
-            os.rmdir(temp_downloads_dir)
+            file_number = resume_index.next_missing(list_comb, file_number + 1)
+        get_driver_pool().release(web_driver)
+        remove_temp_downloads_dir(temp_downloads_dir)
 
-        mark_combo_done(list_comb, parent_raw_html_directory)
+        if stop_event.is_set():
+            return f"Stopped processing {year} {list_comb} at file number {file_number}"
+        mark_combo_done(list_comb, year)
         return f"Done processing {year} {list_comb}"
 
+    def probe_combo(self, list_comb, year):
+        """
+        Find the last populated file number of a combo by searching, without
+        scraping anything, and store it as the combo's bound.
+        """
+        if stop_event.is_set():
+            return f"Skipped probing {year} {list_comb}, stopping"
 
-def handle_keyboard_cancel(signal, frame):
-    logger.warning("Stopping threads...")
-    # Handle the keyboard interrupt signal by setting the global flag
-    global stop_threads
-    stop_threads = True
-    os._exit(1)
+        temp_downloads_dir = os.path.join(
+            default_temp_download_folder, "_".join(list_comb)
+        )
+        if not os.path.exists(temp_downloads_dir):
+            p = Path(temp_downloads_dir)
+            p.mkdir(parents=True)
 
+        web_driver = get_driver_pool().acquire(temp_downloads_dir)
+
+        def has_results(file_number):
+            nonlocal web_driver
+            for _ in range(PROBE_MAX_TRIES):
+                if stop_event.is_set():
+                    raise RuntimeError("stopped while probing")
+                found = self.scraper(
+                    file_number,
+                    list_comb,
+                    web_driver,
+                    year,
+                    temp_downloads_dir,
+                    probe=True,
+                )
+                if not is_driver_healthy(web_driver):
+                    web_driver = get_driver_pool().replace(
+                        web_driver, temp_downloads_dir
+                    )
+                if found is not None:
+                    return found
+            raise RuntimeError(f"could not search file_num {file_number}")
 
-if __name__ == "__main__":
-    kill_os_process("chrome")
-    kill_os_process("chromedriver")
-    # Register the keyboard interrupt signal handler
-    signal.signal(signal.SIGINT, handle_keyboard_cancel)
+        try:
+            last_file_num, searches = find_last_file_num(has_results)
+        except RuntimeError as e:
+            logger.warning(f"giving up probing {year} {list_comb}: {e}")
+            return f"Probe of {year} {list_comb} failed"
+        finally:
+            get_driver_pool().release(web_driver)
+            remove_temp_downloads_dir(temp_downloads_dir)
+
+        get_progress_store().set_combo_bound(year, list_comb, last_file_num, searches)
+        return (
+            f"{year} {list_comb} ends at file number {last_file_num}, "
+            f"found in {searches} searches"
+        )
 
-    locations, years = parse_args()
-    valid_locations = get_latest_locations()
-    logger.info(
-        f"All valid locations according to the current location dropdown menu: {valid_locations}"
-    )
+    def refresh_combo(self, list_comb, file_nums, year):
+        if stop_event.is_set():
+            return f"Skipped refreshing {year} {list_comb}, stopping"
 
-    if not years:
-        years = get_all_valid_years()
+        temp_downloads_dir = os.path.join(
+            default_temp_download_folder, "_".join(list_comb)
+        )
+        if not os.path.exists(temp_downloads_dir):
+            p = Path(temp_downloads_dir)
+            p.mkdir(parents=True)
 
-    for scrape_year in years:
-        if is_year_done(scrape_year):
-            logger.info(f"Skipping {scrape_year} as it is already done")
-            continue
+        web_driver = get_driver_pool().acquire(temp_downloads_dir)
+        for file_number in file_nums:
+            if stop_event.is_set():
+                break
+            flag = self.scraper(
+                file_number, list_comb, web_driver, year, temp_downloads_dir
+            )
+            logger.info(f"{list_comb} file no {file_number}'s refresh flag: {flag}")
+            if not is_driver_healthy(web_driver):
+                web_driver = get_driver_pool().replace(web_driver, temp_downloads_dir)
+        get_driver_pool().release(web_driver)
+        remove_temp_downloads_dir(temp_downloads_dir)
+
+        return f"Done refreshing {year} {list_comb}"
 
-        # try:
-        locations_to_use = list_all_comb
-        if locations and len(locations) > 0:
-            locations_to_use = [
-                x for x in list_all_comb if x[0] in locations
-            ]  # only use parsed locations
-
-        max_workers = (
-            NUMBER_OF_WORKERS
-            if NUMBER_OF_WORKERS <= len(locations_to_use)
-            else NUMBER_OF_WORKERS - (NUMBER_OF_WORKERS - len(locations_to_use))
+    def scrape_chunks(self, scheduler, year, worker_id):
+
+        temp_downloads_dir = os.path.join(
+            default_temp_download_folder, f"worker_{worker_id}"
         )
-        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
-            for location_list in locations_to_use:
-                parent_raw_html_dir = get_parent_raw_html_dir(scrape_year)
+        if not os.path.exists(temp_downloads_dir):
+            p = Path(temp_downloads_dir)
+            p.mkdir(parents=True)
 
-                if is_combo_done(location_list, parent_raw_html_dir):
-                    logger.info(
-                        f"Skipping {scrape_year} {location_list} as it is already done"
+        resume_index = get_resume_index(year)
+
+        chunk = scheduler.next_chunk(should_stop=stop_event.is_set)
+        while chunk is not None:
+            list_comb = chunk.combo
+            logger.info(
+                f"worker {worker_id} processing {year} {list_comb} "
+                f"file numbers {chunk.start}-{chunk.end}"
+            )
+            web_driver = None
+            file_number = chunk.start
+            try:
+                web_driver = get_driver_pool().acquire(temp_downloads_dir)
+                for file_number in range(chunk.start, chunk.end + 1):
+                    if stop_event.is_set() or scheduler.is_past_end(
+                        list_comb, file_number
+                    ):
+                        break
+                    if resume_index.next_missing(list_comb, file_number) != file_number:
+                        scheduler.record(
+                            list_comb, file_number, False, False, skipped=True
+                        )
+                        continue
+
+                    flag = self.scraper(
+                        file_number, list_comb, web_driver, year, temp_downloads_dir
                     )
-                    continue
+                    logger.info(f"{list_comb} file no {file_number}'s flag: {flag}")
+                    if not is_driver_healthy(web_driver):
+                        web_driver = get_driver_pool().replace(
+                            web_driver, temp_downloads_dir
+                        )
+                    if flag is None and stop_event.is_set():
+                        # cut short, neither empty nor done
+                        break
+                    scheduler.record(
+                        list_comb,
+                        file_number,
+                        flag == "NO MORE FILES, DELAYED ERROR" or not flag,
+                        flag == DONE_FLAG,
+                    )
+            except BaseException:
+                # e.g. chrome failed to start, other workers take the rest of the chunk
+                scheduler.abandon_chunk(chunk, file_number)
+                raise
+            finally:
+                if web_driver is not None:
+                    get_driver_pool().release(web_driver)
+            scheduler.complete_chunk(chunk)
+            chunk = scheduler.next_chunk(should_stop=stop_event.is_set)
 
-                if locations and location_list[0] not in locations:
-                    continue
+        remove_temp_downloads_dir(temp_downloads_dir)
 
-                if location_list[0] not in valid_locations:
-                    logger.warning(
-                        f"Skipping {location_list} as {location_list[0]} is not found in the current location dropdown menu"
+        return f"Worker {worker_id} done processing {year}"
+
+    def scrape_work_items(self, work_queue, worker_id):
+        temp_downloads_dir = os.path.join(
+            default_temp_download_folder, f"worker_{worker_id}"
+        )
+        if not os.path.exists(temp_downloads_dir):
+            p = Path(temp_downloads_dir)
+            p.mkdir(parents=True)
+
+        item = work_queue.wait_for_lease(
+            worker_id, LEASE_TTL, should_stop=stop_event.is_set
+        )
+        while item is not None:
+            year, list_comb = item.year, item.combo
+            logger.info(
+                f"worker {worker_id} leased {year} {list_comb} "
+                f"file numbers {item.start}-{item.end}"
+            )
+            heartbeat = LeaseHeartbeat(work_queue, item, worker_id, LEASE_TTL)
+            heartbeat.start()
+            web_driver = None
+            finished = False
+            try:
+                web_driver = get_driver_pool().acquire(temp_downloads_dir)
+                resume_index = get_resume_index(year)
+                results = []
+                for file_number in range(item.start, item.end + 1):
+                    if (
+                        stop_event.is_set()
+                        or heartbeat.lost
+                        or work_queue.is_past_end(item, file_number)
+                    ):
+                        break
+                    if resume_index.next_missing(list_comb, file_number) != file_number:
+                        results.append((file_number, False, False))
+                        continue
+
+                    flag = self.scraper(
+                        file_number, list_comb, web_driver, year, temp_downloads_dir
+                    )
+                    logger.info(f"{list_comb} file no {file_number}'s flag: {flag}")
+                    if not is_driver_healthy(web_driver):
+                        web_driver = get_driver_pool().replace(
+                            web_driver, temp_downloads_dir
+                        )
+                    if flag is None and stop_event.is_set():
+                        break
+                    results.append(
+                        (
+                            file_number,
+                            flag == "NO MORE FILES, DELAYED ERROR" or not flag,
+                            flag == DONE_FLAG,
+                        )
                     )
-                    continue
+                heartbeat.stop()
+                if not stop_event.is_set() and not heartbeat.lost:
+                    combo_done = work_queue.complete(item, worker_id, results)
+                    finished = True
+                    if combo_done:
+                        mark_combo_done(list_comb, year)
+                        logger.info(f"Done processing {year} {list_comb}")
+            finally:
+                heartbeat.stop()
+                if web_driver is not None:
+                    get_driver_pool().release(web_driver)
+                if not finished and not heartbeat.lost:
+                    # stopped or failed, another worker leases the item again and
+                    # skips the file numbers done so far
+                    work_queue.release(item, worker_id)
+            item = work_queue.wait_for_lease(
+                worker_id, LEASE_TTL, should_stop=stop_event.is_set
+            )
 
+        remove_temp_downloads_dir(temp_downloads_dir)
+
+        return f"Worker {worker_id} has no work left"
+
+
+def get_combos_to_scrape(scrape_year, locations, valid_locations):
+    locations_to_use = get_year_combos(scrape_year)
+    if locations and len(locations) > 0:
+        locations_to_use = [
+            x for x in locations_to_use if x[0] in locations
+        ]  # only use parsed locations
+
+    combos_to_scrape = []
+    for location_list in locations_to_use:
+        if is_combo_done(location_list, scrape_year):
+            logger.info(f"Skipping {scrape_year} {location_list} as it is already done")
+            continue
+
+        if locations and location_list[0] not in locations:
+            continue
+
+        if location_list[0] not in valid_locations:
+            logger.warning(
+                f"Skipping {location_list} as {location_list[0]} is not found in the current location dropdown menu"
+            )
+            continue
+
+        combos_to_scrape.append(location_list)
+    return combos_to_scrape
+
+
+def log_results(futures):
+    # a worker that fails stops the others at their next file number
+    try:
+        for future in concurrent.futures.as_completed(futures):
+            logger.info(future.result())
+    except BaseException:
+        stop_event.set()
+        raise
+
+
+def scrape_year_in_threads(scrape_year, combos_to_scrape, priorities=None):
+    if CHUNK_SIZE > 0:
+        max_workers = NUMBER_OF_WORKERS
+    else:
+        max_workers = min(NUMBER_OF_WORKERS, max(len(combos_to_scrape), 1))
+    futures = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        if CHUNK_SIZE > 0:
+            scheduler = ChunkScheduler(
+                combos_to_scrape,
+                CHUNK_SIZE,
+                max_workers,
+                resume_index=get_resume_index(scrape_year),
+                on_combo_done=lambda combo: mark_combo_done(combo, scrape_year),
+                bounds=get_progress_store().get_combo_bounds(scrape_year, PROBE_TTL),
+                sizes=get_combo_sizes(scrape_year),
+                priorities=priorities,
+            )
+            for worker_id in range(max_workers):
+                scrapper_thread = Scrapper()
+                futures.append(
+                    executor.submit(
+                        scrapper_thread.scrape_chunks,
+                        scheduler,
+                        scrape_year,
+                        worker_id,
+                    )
+                )
+        else:
+            # the pool takes combos in submission order, longest first
+            for location_list in order_combos(
+                combos_to_scrape, get_combo_sizes(scrape_year), priorities
+            ):
                 scrapper_thread = Scrapper()
-                threads.append(
+                futures.append(
                     executor.submit(
                         scrapper_thread.scrape_for_each_comb,
                         location_list,
                         scrape_year,
-                        parent_raw_html_dir,
                     )
                 )
-            try:
+        log_results(futures)
+
+
+def probe_year_in_threads(probe_year, combos_to_probe):
+    max_workers = min(NUMBER_OF_WORKERS, max(len(combos_to_probe), 1))
+    futures = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for combo in combos_to_probe:
+            scrapper_thread = Scrapper()
+            futures.append(
+                executor.submit(scrapper_thread.probe_combo, combo, probe_year)
+            )
+        log_results(futures)
+    bounds = get_progress_store().get_combo_bounds(probe_year)
+    logger.info(
+        f"{probe_year}: {len(bounds)} combos probed, "
+        f"{sum(bounds.values())} file numbers in total"
+    )
+
+
+def refresh_year_in_threads(refresh_year, locations):
+    # every combo with done file numbers, in the order of the form's dropdowns
+    completed = get_progress_store().completed_file_nums(refresh_year)
+    combos = [
+        combo
+        for combo in get_year_combos(refresh_year)
+        if get_combo_key(combo) in completed
+        and (not locations or combo[0] in locations)
+    ]
+    logger.info(f"refreshing {len(combos)} combos of {refresh_year}")
+    max_workers = min(NUMBER_OF_WORKERS, max(len(combos), 1))
+    futures = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for combo in combos:
+            scrapper_thread = Scrapper(refresh=True)
+            futures.append(
+                executor.submit(
+                    scrapper_thread.refresh_combo,
+                    combo,
+                    completed[get_combo_key(combo)],
+                    refresh_year,
+                )
+            )
+        log_results(futures)
+
+
+def run_worker(work_queue):
+    worker_prefix = f"{socket.gethostname()}-{os.getpid()}"
+    logger.info(f"worker {worker_prefix} leasing from {work_queue.db_path}")
+    futures = []
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=NUMBER_OF_WORKERS
+    ) as executor:
+        for index in range(NUMBER_OF_WORKERS):
+            scrapper_thread = Scrapper()
+            futures.append(
+                executor.submit(
+                    scrapper_thread.scrape_work_items,
+                    work_queue,
+                    f"{worker_prefix}-{index}",
+                )
+            )
+        log_results(futures)
+
+
+def run_coordinator(work_queue, processes):
+    workers = [
+        subprocess.Popen(
+            [
+                sys.executable,
+                os.path.realpath(__file__),
+                "--role",
+                ROLE_WORKER,
+                "--queue-db",
+                work_queue.db_path,
+            ]
+        )
+        for _ in range(processes)
+    ]
+    logger.info(f"started {len(workers)} local worker processes")
+
+    while not work_queue.is_finished() and not stop_event.is_set():
+        logger.info(f"work queue: {work_queue.get_summary()}")
+        if workers and all(worker.poll() is not None for worker in workers):
+            logger.warning("every local worker process has exited")
+            break
+        stop_event.wait(COORDINATOR_POLL_INTERVAL)
+
+    for worker in workers:
+        if stop_event.is_set() and worker.poll() is None:
+            # a SIGTERM sent to the coordinator alone still reaches its workers
+            worker.terminate()
+        worker.wait()
+    logger.info(f"work queue: {work_queue.get_summary()}")
+
+
+def handle_stop_signal(signum, frame):
+    """
+    Ask every worker to stop after its current file number or case, their
+    progress is flushed and their drivers quit on the way out. A second
+    ctrl-c exits right away, without any of that.
+    """
+    global stop_signal
+    if stop_event.is_set():
+        if signum == signal.SIGINT:
+            logger.warning("Exiting without waiting for the workers")
+            os._exit(1)
+        return
+    stop_signal = signum
+    logger.warning(
+        f"{signal.Signals(signum).name} received, stopping workers, "
+        "press ctrl-c again to exit right away"
+    )
+    stop_event.set()
+
+
+if __name__ == "__main__":
+    locations, years, args = parse_args()
+    metrics = get_metrics()
+    signal.signal(signal.SIGINT, handle_stop_signal)
+    signal.signal(signal.SIGTERM, handle_stop_signal)
+
+    if args.role != ROLE_WORKER:
+        # worker processes may share the host with other workers
+        kill_os_process("chrome")
+        kill_os_process("chromedriver")
+
+    if ASYNC_DOWNLOADS:
+        download_pipeline = DownloadPipeline(
+            max_in_flight=DOWNLOAD_MAX_IN_FLIGHT,
+            on_failure=mark_download_faulty,
+            on_success=store_download,
+        )
+
+    work_queue = None
+    if args.role != ROLE_STANDALONE:
+        work_queue = WorkQueue(
+            args.queue_db, CHUNK_SIZE or DEFAULT_CHUNK_SIZE, NUMBER_OF_WORKERS
+        )
 
-                while not stop_threads:
-                    for thread in concurrent.futures.as_completed(threads):
-                        thread.result()
-            except KeyboardInterrupt:
-                executor.shutdown(wait=False)
-                handle_keyboard_cancel(None, None)
+    exit_code = 0
+    try:
+        if args.role == ROLE_WORKER:
+            run_worker(work_queue)
+        else:
+            clear_temp_folder(default_temp_download_folder)
+            shutil.rmtree(partial_html_folder, ignore_errors=True)
+            if args.role == ROLE_STANDALONE:
+                get_driver_pool().warm_up()
+            get_cej_metadata(refresh=args.refresh_metadata)
+            valid_locations = get_latest_locations()
+            logger.info(
+                f"All valid locations according to the current location dropdown menu: {valid_locations}"
+            )
 
-    if not locations and not stop_threads:
-        mark_year_done(scrape_year)
+            if not years:
+                years = get_all_valid_years()
 
-    kill_web_drivers(drivers)
+            if args.refresh:
+                for scrape_year in years:
+                    if stop_event.is_set():
+                        break
+                    refresh_year_in_threads(scrape_year, locations)
+            elif args.probe:
+                for probe_year in years:
+                    if stop_event.is_set():
+                        break
+                    probe_year_in_threads(
+                        probe_year,
+                        get_combos_to_scrape(probe_year, locations, valid_locations),
+                    )
+            else:
+                for scrape_year in years:
+                    if stop_event.is_set():
+                        break
+                    if is_year_done(scrape_year):
+                        logger.info(f"Skipping {scrape_year} as it is already done")
+                        continue
+                    get_resume_index(scrape_year)
+
+                    combos_to_scrape = get_combos_to_scrape(
+                        scrape_year, locations, valid_locations
+                    )
+                    if args.role == ROLE_COORDINATOR:
+                        work_queue.populate(
+                            scrape_year,
+                            combos_to_scrape,
+                            get_resume_index(scrape_year),
+                            bounds=get_progress_store().get_combo_bounds(
+                                scrape_year, PROBE_TTL
+                            ),
+                            sizes=get_combo_sizes(scrape_year),
+                            priorities=args.priorities,
+                        )
+                    else:
+                        scrape_year_in_threads(
+                            scrape_year, combos_to_scrape, args.priorities
+                        )
+
+                if args.role == ROLE_COORDINATOR:
+                    # the coordinator only needed a browser to read the dropdowns
+                    get_driver_pool().close_all()
+                    run_coordinator(work_queue, args.processes)
+
+                if not locations and not stop_event.is_set():
+                    if args.role == ROLE_STANDALONE or work_queue.is_finished(
+                        scrape_year
+                    ):
+                        mark_year_done(scrape_year)
+    except MetadataError as e:
+        logger.error(e)
+        exit_code = 2
+    finally:
+        # also on a stop: finish queued downloads, quit the drivers, flush progress
+        if driver_pool:
+            driver_pool.close_all()
+        if captcha_service:
+            captcha_service.close()
+        if download_pipeline:
+            download_pipeline.close()
+        if work_queue:
+            work_queue.close()
+        if blob_store:
+            blob_store.close()
+        if html_writer:
+            html_writer.close()
+        if progress_store:
+            progress_store.close()
+    logger.info(f"pacing: {get_pacer().get_summary()}")
+    searches = metrics.get_summary()["counters"]
+    if searches.get("searches_new_captcha"):
+        logger.info(
+            "searches per solved captcha: {:.2f}".format(
+                (
+                    searches["searches_new_captcha"]
+                    + searches.get("searches_reused_captcha", 0)
+                )
+                / searches["searches_new_captcha"]
+            )
+        )
+    metrics.close()
+    if stop_signal is not None:
+        exit_code = 128 + stop_signal
+    sys.exit(exit_code)
@@ -1,8 +1,11 @@
+import concurrent.futures
 import os
 from pathlib import Path
+import queue
 import shutil
 import subprocess
 import sys
+import threading
 import time
 import coloredlogs
 import logging
@@ -19,7 +22,6 @@ from selenium.webdriver.firefox.options import Options as FirefoxOptions
 from selenium.webdriver.firefox.service import Service as FirefoxService
 from selenium.webdriver.chrome.options import Options as ChromeOptions
 
-
 load_dotenv()
 logging.basicConfig(
     format="%(asctime)s [%(levelname)s] %(message)s", level=logging.INFO
@@ -88,7 +90,7 @@ def get_chrome_options(download_path, is_headless):
 def setup_selenium_browser_driver(
     download_path, is_headless=True, browser_type=CHROME_BROWSER_TYPE
 ):
-    if browser_type == CHROME_BROWSER_TYPE:        
+    if browser_type == CHROME_BROWSER_TYPE:
         if not DRIVER_EXECUTABLE_PATH:
             logger.error("The following env are requied: DRIVER_EXECUTABLE_PATH")
             sys.exit()
@@ -113,6 +115,155 @@ def setup_selenium_browser_driver(
     return driver
 
 
+def enable_download_in_headless_chrome(driver, download_dir):
+    driver.command_executor._commands["send_command"] = (
+        "POST",
+        "/session/$sessionId/chromium/send_command",
+    )
+    params = {
+        "cmd": "Page.setDownloadBehavior",
+        "params": {"behavior": "allow", "downloadPath": download_dir},
+    }
+    driver.execute("send_command", params)
+
+
+def get_driver_rss_mb(driver):
+    # resident memory of the driver service and every browser process it started
+    try:
+        process = psutil.Process(driver.service.process.pid)
+        processes = [process] + process.children(recursive=True)
+    except (AttributeError, psutil.Error):
+        return 0
+    rss = 0
+    for proc in processes:
+        try:
+            rss += proc.memory_info().rss
+        except psutil.Error:
+            pass
+    return rss / (1024 * 1024)
+
+
+def is_driver_healthy(driver):
+    try:
+        return driver.execute_script("return 1;") == 1 and bool(driver.window_handles)
+    except Exception:
+        return False
+
+
+class WebDriverPool:
+    """
+    Keep browsers alive between combos instead of starting one for each.
+    Args
+    ----
+    size : int
+        How many drivers warm_up starts ahead of time.
+    download_path : str
+        The download folder the drivers are created with. Each caller sets its
+        own folder when acquiring a driver.
+    warm_url : str, defaults to None
+        Page loaded by fresh drivers, so the first search hits a warm cache.
+    max_uses : int
+        Number of acquire/release cycles after which a driver is recycled.
+    max_rss_mb : int
+        Memory of the driver and its browser processes above which a released
+        driver is recycled.
+    """
+
+    def __init__(
+        self,
+        size,
+        download_path,
+        warm_url=None,
+        max_uses=20,
+        max_rss_mb=1500,
+        is_headless=True,
+        browser_type=CHROME_BROWSER_TYPE,
+    ):
+        self.size = size
+        self.download_path = download_path
+        self.warm_url = warm_url
+        self.max_uses = max_uses
+        self.max_rss_mb = max_rss_mb
+        self.is_headless = is_headless
+        self.browser_type = browser_type
+        self._idle = queue.LifoQueue()
+        self._uses = {}
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def warm_up(self):
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.size) as executor:
+            for driver in executor.map(lambda _: self._create(), range(self.size)):
+                self._idle.put(driver)
+        logger.info(f"{self.size} web drivers warmed up")
+
+    def _create(self):
+        driver = setup_selenium_browser_driver(
+            self.download_path, self.is_headless, self.browser_type
+        )
+        with self._lock:
+            self._uses[driver] = 0
+        if self.warm_url:
+            try:
+                driver.get(self.warm_url)
+            except WebDriverException as e:
+                logger.warning(f"failed to warm up web driver: {e.msg}")
+        return driver
+
+    def acquire(self, download_dir=None):
+        driver = None
+        while driver is None:
+            try:
+                driver = self._idle.get_nowait()
+            except queue.Empty:
+                driver = self._create()
+                break
+            if not is_driver_healthy(driver):
+                logger.warning("discarding unhealthy web driver")
+                self.discard(driver)
+                driver = None
+
+        if download_dir and self.browser_type == CHROME_BROWSER_TYPE:
+            enable_download_in_headless_chrome(driver, download_dir)
+        return driver
+
+    def release(self, driver):
+        with self._lock:
+            if driver not in self._uses:
+                return
+            self._uses[driver] += 1
+            uses = self._uses[driver]
+
+        if self._closed or not is_driver_healthy(driver):
+            self.discard(driver)
+        elif uses >= self.max_uses:
+            logger.info(f"recycling web driver after {uses} uses")
+            self.discard(driver)
+        elif get_driver_rss_mb(driver) > self.max_rss_mb:
+            logger.info(f"recycling web driver using over {self.max_rss_mb} MB")
+            self.discard(driver)
+        else:
+            self._idle.put(driver)
+
+    def replace(self, driver, download_dir=None):
+        # for drivers that crashed while in use
+        logger.warning("replacing crashed web driver")
+        self.discard(driver)
+        return self.acquire(download_dir)
+
+    def discard(self, driver):
+        with self._lock:
+            self._uses.pop(driver, None)
+        kill_web_drivers([driver])
+
+    def close_all(self):
+        self._closed = True
+        with self._lock:
+            drivers = list(self._uses)
+            self._uses.clear()
+        kill_web_drivers(drivers)
+
+
 def is_windows_process_running(process_name):
     for proc in psutil.process_iter(["name"]):
         if proc.info["name"] == process_name:
@@ -135,12 +286,11 @@ def kill_os_process(process):
 
 
 def kill_web_drivers(drivers):
-    try:
-        for driver in drivers:
-            driver.close()
+    for driver in drivers:
+        try:
             driver.quit()
-    except Exception as e:
-        pass
+        except Exception as e:
+            pass
 
 
 def download_wait(directory, timeout, driver, nfiles=False):
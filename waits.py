@@ -0,0 +1,128 @@
+from selenium.common.exceptions import (
+    StaleElementReferenceException,
+    TimeoutException,
+    WebDriverException,
+)
+from selenium.webdriver.common.by import By
+from selenium.webdriver.support import expected_conditions as EC
+from selenium.webdriver.support.ui import WebDriverWait
+
+# readiness conditions of the CEJ search and detail pages, each wait returns
+# True once its condition holds and False when timeout seconds pass first
+
+LOADER = (By.ID, "cargando")
+RESULT_BUTTONS = (By.XPATH, '//div[@class="celdCentro"]/form/button')
+NO_RESULTS_MESSAGE = (By.ID, "mensajeNoExisteExpedientes")
+CAPTCHA_ERROR_MESSAGE = (By.ID, "codCaptchaError")
+CAPTCHA_IMAGE = (By.ID, "captcha_image")
+CAPTCHA_RELOAD = (By.ID, "btnReload")
+DETAIL_PARTES = (By.XPATH, '//div[@class="partes"]')
+POLL_FREQUENCY = 0.1
+
+OUTCOME_RESULTS = "results"
+OUTCOME_NO_RESULTS = "no_results"
+OUTCOME_CAPTCHA = "captcha"
+
+
+def wait_until(driver, condition, timeout):
+    try:
+        return WebDriverWait(
+            driver,
+            timeout,
+            poll_frequency=POLL_FREQUENCY,
+            ignored_exceptions=[StaleElementReferenceException],
+        ).until(condition)
+    except TimeoutException:
+        return False
+
+
+def results_rendered(driver):
+    return len(driver.find_elements(*RESULT_BUTTONS)) > 0
+
+
+def no_results_displayed(driver):
+    elements = driver.find_elements(*NO_RESULTS_MESSAGE)
+    return bool(elements) and elements[0].is_displayed()
+
+
+def captcha_error_displayed(driver):
+    elements = driver.find_elements(*CAPTCHA_ERROR_MESSAGE)
+    return bool(elements) and elements[0].is_displayed()
+
+
+def search_outcome(driver):
+    # what a search ended with, False while none of them is on the page
+    if results_rendered(driver):
+        return OUTCOME_RESULTS
+    if no_results_displayed(driver):
+        return OUTCOME_NO_RESULTS
+    if captcha_error_displayed(driver):
+        return OUTCOME_CAPTCHA
+    return False
+
+
+class captcha_reloaded:
+    """
+    The captcha image shows a different picture than previous_src, and has
+    finished loading.
+    """
+
+    def __init__(self, previous_src):
+        self.previous_src = previous_src
+
+    def __call__(self, driver):
+        return driver.execute_script(
+            "var img = document.getElementById(arguments[1]);"
+            "return !!img && img.src !== arguments[0]"
+            " && img.complete && img.naturalWidth > 0;",
+            self.previous_src,
+            CAPTCHA_IMAGE[1],
+        )
+
+
+def clear_search_outcome(driver):
+    # drop the previous results and messages, so a new search is not mistaken for them
+    driver.execute_script(
+        "document.querySelectorAll('div.celdCentro').forEach("
+        "function (cell) { cell.remove(); });"
+        "for (var i = 0; i < arguments.length; i++) {"
+        "  var message = document.getElementById(arguments[i]);"
+        "  if (message) { message.style.display = 'none'; }"
+        "}",
+        NO_RESULTS_MESSAGE[1],
+        CAPTCHA_ERROR_MESSAGE[1],
+    )
+
+
+def wait_for_loader_hidden(driver, timeout):
+    # also True when the page has no loader at all
+    return wait_until(driver, EC.invisibility_of_element_located(LOADER), timeout)
+
+
+def wait_for_results(driver, timeout):
+    return wait_until(driver, results_rendered, timeout)
+
+
+def wait_for_search_outcome(driver, timeout):
+    """
+    Returns OUTCOME_RESULTS, OUTCOME_NO_RESULTS or OUTCOME_CAPTCHA, when the
+    site rejected the captcha, as soon as the page shows one of them, False if
+    it shows none in time.
+    """
+    return wait_until(driver, search_outcome, timeout)
+
+
+def wait_for_detail_page(driver, timeout):
+    return wait_until(driver, EC.presence_of_element_located(DETAIL_PARTES), timeout)
+
+
+def reload_captcha(driver, timeout):
+    """
+    Click the captcha reload button and wait for the new image to load.
+    """
+    try:
+        previous_src = driver.find_element(*CAPTCHA_IMAGE).get_attribute("src")
+        driver.find_element(*CAPTCHA_RELOAD).click()
+    except WebDriverException:
+        return False
+    return wait_until(driver, captcha_reloaded(previous_src), timeout)
@@ -0,0 +1,481 @@
+import collections
+import json
+import sqlite3
+import threading
+import time
+
+from progress_store import get_combo_key
+from scheduler import ComboState, estimate_sizes, get_combo_priority
+from utils import logger
+
+WORK_QUEUE_DB_FILENAME = "work_queue.sqlite3"
+
+STATUS_PENDING = "pending"
+STATUS_LEASED = "leased"
+STATUS_DONE = "done"
+
+WorkItem = collections.namedtuple(
+    "WorkItem", ["id", "year", "combo", "start", "end", "lease_expires"]
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS combos (
+    year INTEGER NOT NULL,
+    combo TEXT NOT NULL,
+    combo_json TEXT NOT NULL,
+    next_start INTEGER NOT NULL,
+    scan INTEGER NOT NULL,
+    empty_num INTEGER NOT NULL DEFAULT 0,
+    end_file_num INTEGER,
+    completed_chunks INTEGER NOT NULL DEFAULT 0,
+    reported INTEGER NOT NULL DEFAULT 0,
+    last_file_num INTEGER,
+    priority INTEGER NOT NULL DEFAULT 0,
+    size_estimate INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (year, combo)
+);
+CREATE TABLE IF NOT EXISTS work_items (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    year INTEGER NOT NULL,
+    combo TEXT NOT NULL,
+    start INTEGER NOT NULL,
+    end INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    owner TEXT,
+    lease_expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    priority INTEGER NOT NULL DEFAULT 0,
+    remaining INTEGER NOT NULL DEFAULT 0,
+    updated_at REAL NOT NULL,
+    UNIQUE (year, combo, start)
+);
+CREATE INDEX IF NOT EXISTS work_items_status ON work_items (status, id);
+CREATE TABLE IF NOT EXISTS file_results (
+    year INTEGER NOT NULL,
+    combo TEXT NOT NULL,
+    file_num INTEGER NOT NULL,
+    is_empty INTEGER NOT NULL,
+    is_last INTEGER NOT NULL,
+    PRIMARY KEY (year, combo, file_num)
+) WITHOUT ROWID;
+"""
+
+
+class WorkQueue:
+    """
+    Work queue of (year, combo, file number range) items shared by processes.
+    Args
+    ----
+    db_path : str
+        SQLite file on a local disk of the host running every worker process,
+        WAL mode does not work over network filesystems.
+    chunk_size : int
+        Number of consecutive file numbers in one work item.
+    max_chunks_per_combo : int
+        Upper bound of items of the same combo leased or pending at once.
+
+    Workers lease items for a limited time and keep the lease alive with
+    heartbeats, so items of crashed workers are handed out again once their
+    lease expires. Combos grow one item at a time with the same rule as
+    scheduler.ChunkScheduler, and end where the serial scraper would end them.
+    Items are leased in the same order as its chunks too: operator priority,
+    then the estimated file numbers left in their combo, largest first.
+    """
+
+    def __init__(self, db_path, chunk_size=25, max_chunks_per_combo=4):
+        self.db_path = db_path
+        self.chunk_size = chunk_size
+        self.max_chunks_per_combo = max_chunks_per_combo
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(
+            db_path, timeout=60, isolation_level=None, check_same_thread=False
+        )
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.executescript(SCHEMA)
+        self._migrate()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _migrate(self):
+        # queues created before probed bounds and priorities were stored
+        for table, column, definition in (
+            ("combos", "last_file_num", "INTEGER"),
+            ("combos", "priority", "INTEGER NOT NULL DEFAULT 0"),
+            ("combos", "size_estimate", "INTEGER NOT NULL DEFAULT 0"),
+            ("work_items", "priority", "INTEGER NOT NULL DEFAULT 0"),
+            ("work_items", "remaining", "INTEGER NOT NULL DEFAULT 0"),
+        ):
+            columns = [
+                row[1] for row in self._conn.execute(f"PRAGMA table_info({table})")
+            ]
+            if column not in columns:
+                self._conn.execute(
+                    f"ALTER TABLE {table} ADD COLUMN {column} {definition}"
+                )
+        self._conn.execute("""
+            CREATE INDEX IF NOT EXISTS work_items_order
+            ON work_items (status, priority DESC, remaining DESC, id)
+            """)
+
+    def _transaction(self, func, *args):
+        # BEGIN IMMEDIATE takes the write lock up front, which serialises processes
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                result = func(*args)
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+            return result
+
+    def _enqueue(self, year, combo_key):
+        start, priority, size_estimate = self._conn.execute(
+            """
+            SELECT next_start, priority, size_estimate
+            FROM combos WHERE year = ? AND combo = ?
+            """,
+            (year, combo_key),
+        ).fetchone()
+        self._conn.execute(
+            """
+            INSERT OR IGNORE INTO work_items
+                (year, combo, start, end, status, priority, remaining, updated_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            (
+                year,
+                combo_key,
+                start,
+                start + self.chunk_size - 1,
+                STATUS_PENDING,
+                priority,
+                max(0, size_estimate - start + 1),
+                time.time(),
+            ),
+        )
+        self._conn.execute(
+            "UPDATE combos SET next_start = ? WHERE year = ? AND combo = ?",
+            (start + self.chunk_size, year, combo_key),
+        )
+
+    def _refill(self, year, combo_key):
+        end_file_num, completed_chunks, next_start, last_file_num = self._conn.execute(
+            """
+            SELECT end_file_num, completed_chunks, next_start, last_file_num
+            FROM combos WHERE year = ? AND combo = ?
+            """,
+            (year, combo_key),
+        ).fetchone()
+        if end_file_num is not None:
+            return
+        open_items = self._conn.execute(
+            "SELECT COUNT(*) FROM work_items WHERE year = ? AND combo = ? AND status != ?",
+            (year, combo_key, STATUS_DONE),
+        ).fetchone()[0]
+        while True:
+            allowed = min(self.max_chunks_per_combo, completed_chunks + 1)
+            if last_file_num is not None and next_start <= last_file_num:
+                # the probed bound says this chunk is not speculative
+                allowed = self.max_chunks_per_combo
+            if open_items >= allowed:
+                break
+            self._enqueue(year, combo_key)
+            next_start += self.chunk_size
+            open_items += 1
+
+    def populate(
+        self, year, combos, resume_index=None, bounds=None, sizes=None, priorities=None
+    ):
+        """
+        Add the combos of year that are not queued yet.
+        Args
+        ----
+        bounds : dict, defaults to None
+            {combo_key: last populated file number} found by probing.
+        sizes : dict, defaults to None
+            {combo_key: estimated last file number}, bounds take precedence.
+        priorities : dict, defaults to None
+            {pattern: weight} set by the operator, also applied to the combos
+            and pending items already queued.
+        """
+        bounds = bounds or {}
+        estimates = estimate_sizes(combos, {**(sizes or {}), **bounds})
+
+        def populate_combos():
+            added = 0
+            for combo in combos:
+                combo_key = get_combo_key(combo)
+                priority = get_combo_priority(combo, priorities)
+                first_file_num = (
+                    resume_index.next_missing(combo, 1) if resume_index else 1
+                )
+                cursor = self._conn.execute(
+                    """
+                    INSERT OR IGNORE INTO combos (
+                        year, combo, combo_json, next_start, scan, last_file_num,
+                        priority, size_estimate
+                    )
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                    """,
+                    (
+                        int(year),
+                        combo_key,
+                        json.dumps(combo),
+                        first_file_num,
+                        first_file_num,
+                        bounds.get(combo_key),
+                        priority,
+                        estimates[combo_key],
+                    ),
+                )
+                if cursor.rowcount:
+                    self._refill(int(year), combo_key)
+                    added += 1
+                else:
+                    self._conn.execute(
+                        "UPDATE combos SET priority = ? WHERE year = ? AND combo = ?",
+                        (priority, int(year), combo_key),
+                    )
+                    self._conn.execute(
+                        """
+                        UPDATE work_items SET priority = ?
+                        WHERE year = ? AND combo = ? AND status != ?
+                        """,
+                        (priority, int(year), combo_key, STATUS_DONE),
+                    )
+            return added
+
+        added = self._transaction(populate_combos)
+        logger.info(f"queued {added} new combos for {year}")
+        return added
+
+    def lease(self, worker_id, ttl):
+        def lease_item():
+            now = time.time()
+            row = self._conn.execute(
+                """
+                SELECT w.id, w.year, w.combo, w.start, w.end, c.combo_json
+                FROM work_items w JOIN combos c ON c.year = w.year AND c.combo = w.combo
+                WHERE (w.status = ? OR (w.status = ? AND w.lease_expires < ?))
+                    AND (c.end_file_num IS NULL OR w.start <= c.end_file_num)
+                ORDER BY w.priority DESC, w.remaining DESC, w.id LIMIT 1
+                """,
+                (STATUS_PENDING, STATUS_LEASED, now),
+            ).fetchone()
+            if row is None:
+                return None
+            item_id, year, combo_key, start, end, combo_json = row
+            self._conn.execute(
+                """
+                UPDATE work_items SET status = ?, owner = ?, lease_expires = ?,
+                    attempts = attempts + 1, updated_at = ?
+                WHERE id = ?
+                """,
+                (STATUS_LEASED, worker_id, now + ttl, now, item_id),
+            )
+            self._refill(year, combo_key)
+            return WorkItem(
+                item_id, year, json.loads(combo_json), start, end, now + ttl
+            )
+
+        return self._transaction(lease_item)
+
+    def wait_for_lease(self, worker_id, ttl, poll_interval=5, should_stop=None):
+        # None once every combo in the queue has been finished
+        while not (should_stop and should_stop()):
+            item = self.lease(worker_id, ttl)
+            if item is not None:
+                return item
+            if self.is_finished():
+                return None
+            time.sleep(poll_interval)
+        return None
+
+    def heartbeat(self, item, worker_id, ttl):
+        def extend_lease():
+            cursor = self._conn.execute(
+                """
+                UPDATE work_items SET lease_expires = ?, updated_at = ?
+                WHERE id = ? AND owner = ? AND status = ?
+                """,
+                (time.time() + ttl, time.time(), item.id, worker_id, STATUS_LEASED),
+            )
+            return cursor.rowcount == 1
+
+        return self._transaction(extend_lease)
+
+    def release(self, item, worker_id):
+        # hand an unfinished item back without waiting for its lease to expire
+        def release_item():
+            self._conn.execute(
+                """
+                UPDATE work_items SET status = ?, owner = NULL, lease_expires = NULL,
+                    updated_at = ?
+                WHERE id = ? AND owner = ? AND status = ?
+                """,
+                (STATUS_PENDING, time.time(), item.id, worker_id, STATUS_LEASED),
+            )
+
+        self._transaction(release_item)
+
+    def complete(self, item, worker_id, results):
+        """
+        Record the results of a leased item and mark it done.
+        Args
+        ----
+        results : list
+            (file_num, is_empty, is_last) of every file number processed.
+
+        Returns True when this completion finished the combo. That happens at
+        most once per combo, so the caller can mark it done in the progress store.
+        """
+
+        def complete_item():
+            combo_key = get_combo_key(item.combo)
+            cursor = self._conn.execute(
+                """
+                UPDATE work_items SET status = ?, lease_expires = NULL, updated_at = ?
+                WHERE id = ? AND owner = ? AND status = ?
+                """,
+                (STATUS_DONE, time.time(), item.id, worker_id, STATUS_LEASED),
+            )
+            if cursor.rowcount != 1:
+                logger.warning(f"lease of work item {item.id} was lost, dropping it")
+                return False
+
+            self._conn.executemany(
+                """
+                INSERT OR REPLACE INTO file_results (year, combo, file_num, is_empty, is_last)
+                VALUES (?, ?, ?, ?, ?)
+                """,
+                [
+                    (item.year, combo_key, file_num, int(is_empty), int(is_last))
+                    for file_num, is_empty, is_last in results
+                ],
+            )
+            scan, empty_num, end_file_num = self._conn.execute(
+                "SELECT scan, empty_num, end_file_num FROM combos WHERE year = ? AND combo = ?",
+                (item.year, combo_key),
+            ).fetchone()
+            state = ComboState(item.combo, scan, empty_num)
+            state.end = end_file_num
+            for file_num, is_empty, is_last in self._conn.execute(
+                """
+                SELECT file_num, is_empty, is_last FROM file_results
+                WHERE year = ? AND combo = ? AND file_num >= ? ORDER BY file_num
+                """,
+                (item.year, combo_key, scan),
+            ).fetchall():
+                state.record(file_num, bool(is_empty), bool(is_last))
+            self._conn.execute(
+                """
+                UPDATE combos SET scan = ?, empty_num = ?, end_file_num = ?,
+                    completed_chunks = completed_chunks + 1
+                WHERE year = ? AND combo = ?
+                """,
+                (state.scan, state.empty_num, state.end, item.year, combo_key),
+            )
+            self._refill(item.year, combo_key)
+
+            if state.end is None:
+                return False
+            # speculative items past the end will never be scraped
+            self._conn.execute(
+                """
+                UPDATE work_items SET status = ?, updated_at = ?
+                WHERE year = ? AND combo = ? AND status = ? AND start > ?
+                """,
+                (
+                    STATUS_DONE,
+                    time.time(),
+                    item.year,
+                    combo_key,
+                    STATUS_PENDING,
+                    state.end,
+                ),
+            )
+            leased = self._conn.execute(
+                """
+                SELECT COUNT(*) FROM work_items
+                WHERE year = ? AND combo = ? AND status = ? AND start <= ?
+                """,
+                (item.year, combo_key, STATUS_LEASED, state.end),
+            ).fetchone()[0]
+            if leased:
+                return False
+            cursor = self._conn.execute(
+                "UPDATE combos SET reported = 1 WHERE year = ? AND combo = ? AND reported = 0",
+                (item.year, combo_key),
+            )
+            return cursor.rowcount == 1
+
+        return self._transaction(complete_item)
+
+    def is_past_end(self, item, file_num):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT end_file_num FROM combos WHERE year = ? AND combo = ?",
+                (item.year, get_combo_key(item.combo)),
+            ).fetchone()
+        return row is not None and row[0] is not None and file_num > row[0]
+
+    def is_finished(self, year=None):
+        sql = "SELECT COUNT(*) FROM combos WHERE reported = 0"
+        params = ()
+        if year is not None:
+            sql += " AND year = ?"
+            params = (int(year),)
+        with self._lock:
+            return self._conn.execute(sql, params).fetchone()[0] == 0
+
+    def get_summary(self):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT status, COUNT(*) FROM work_items GROUP BY status"
+            ).fetchall()
+            combos_left, unbounded, file_nums_left = self._conn.execute("""
+                SELECT COUNT(*), COUNT(*) - COUNT(last_file_num),
+                    SUM(MAX(0, last_file_num - scan + 1))
+                FROM combos WHERE reported = 0
+                """).fetchone()
+        summary = dict(rows)
+        summary["combos_left"] = combos_left
+        if combos_left and not unbounded:
+            summary["file_nums_left"] = file_nums_left
+        return summary
+
+
+class LeaseHeartbeat(threading.Thread):
+    """Keep the lease of a work item alive while a worker scrapes it."""
+
+    def __init__(self, work_queue, item, worker_id, ttl):
+        super().__init__(name=f"heartbeat-{worker_id}", daemon=True)
+        self.work_queue = work_queue
+        self.item = item
+        self.worker_id = worker_id
+        self.ttl = ttl
+        self.lost = False
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.ttl / 3):
+            try:
+                if not self.work_queue.heartbeat(self.item, self.worker_id, self.ttl):
+                    logger.warning(f"lease of work item {self.item.id} was lost")
+                    self.lost = True
+                    return
+            except sqlite3.Error as e:
+                logger.warning(f"heartbeat failed for work item {self.item.id}: {e}")
+
+    def stop(self):
+        self._stopped.set()
+        self.join()